@@ -0,0 +1,134 @@
+"""Loopback test of controller/agent distribution against the fake firewall shims.
+
+Starts several agents (distribution.py agent) on 127.0.0.1, each with its own app.db,
+zone directory and fake kernel, then runs a controller in this process that builds the
+artifact from a synthetic database and pushes it. Checks that every agent loaded exactly
+the pushed entries, that a repeated push is a no-op and that a new selection bumps the version.
+
+    python3 bench/agents.py --agents 4 --rows 20000
+"""
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import contextlib
+import tempfile
+import shutil
+import subprocess
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+from gen_db import generate
+from run import make_shim_dir, init_app_db, serve, kernel_entries
+
+TOKEN = "bench-token"
+STARTUP_TIMEOUT = 10
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def bench_env(root, work):
+    return dict(os.environ,
+                PATH=os.path.join(root, 'shims') + os.pathsep + os.environ['PATH'],
+                GEOBLOCK_HOME=work,
+                GEOBLOCK_ZONE_DIR=os.path.join(work, 'zone'),
+                GEOBLOCK_BENCH_LOG=os.path.join(work, 'calls.log'),
+                GEOBLOCK_BENCH_STATE=os.path.join(work, 'kernel.json'))
+
+
+def start_agent(root, number, backend):
+    work = os.path.join(root, f"agent{number}")
+    os.makedirs(work)
+    init_app_db(os.path.join(work, 'app.db'), [], backend)
+    port = free_port()
+    log = open(os.path.join(work, 'agent.log'), 'w')
+    process = subprocess.Popen([sys.executable, os.path.join(REPO_DIR, 'distribution.py'), 'agent', '--listen', f"127.0.0.1:{port}", '--token', TOKEN],
+                               env=bench_env(root, work), stdout=log, stderr=subprocess.STDOUT)
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while True:
+        try:
+            requests.get(f"{url}/status", headers={'X-Geoblock-Token': TOKEN}, timeout=1)
+            break
+        except requests.ConnectionError:
+            if time.monotonic() > deadline or process.poll() is not None:
+                raise RuntimeError(f"Agent {number} did not start, see {log.name}")
+            time.sleep(0.1)
+    return {'url': url, 'work': work, 'process': process, 'backend': backend}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Push a compiled artifact to several loopback agents.")
+    parser.add_argument('--agents', type=int, default=4)
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--keep', action='store_true', help="keep the working directory")
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='geoblock-agents-')
+    make_shim_dir(os.path.join(root, 'shims'))
+    data_dir = os.path.join(root, 'data')
+    os.makedirs(data_dir)
+    generate(os.path.join(data_dir, 'db4.zip'), os.path.join(data_dir, 'db6.zip'), args.rows)
+    server = serve(data_dir)
+    agents = []
+    try:
+        # Agent 0 runs nftables, the rest iptables
+        agents = [start_agent(root, number, 'nftables' if number == 0 else 'iptables') for number in range(args.agents)]
+
+        controller = os.path.join(root, 'controller')
+        os.makedirs(controller)
+        init_app_db(os.path.join(controller, 'app.db'), ['CN', 'RU'], 'iptables')
+        os.environ.update(bench_env(root, controller))
+        sys.path.insert(0, REPO_DIR)
+        import updater
+        import distribution
+        base = f"http://127.0.0.1:{server.server_address[1]}"
+        for family, name in (('inet', 'db4.zip'), ('inet6', 'db6.zip')):
+            updater.FAMILIES[family].update(url=f"{base}/{name}", zip=os.path.join(controller, name), index=os.path.join(controller, f"{family}.idx"))
+        for agent in agents:
+            distribution.register_agent(agent['url'], TOKEN)
+
+        report = []
+        for step, countries in (('initial', None), ('repeat', None), ('new selection', ['CN', 'RU', 'US'])):
+            if countries:
+                with distribution.transaction() as cursor:
+                    cursor.executemany('INSERT INTO countries (code, name, picked) VALUES (?, ?, ?)', [(code, code, True) for code in countries])
+            # The controller's progress output goes to stderr, the JSON report to stdout
+            with contextlib.redirect_stdout(sys.stderr):
+                started = time.perf_counter()
+                payload, body, sha256 = distribution.build_artifact()
+                built = time.perf_counter()
+                results = distribution.push(payload['version'], body, sha256)
+                pushed = time.perf_counter()
+
+            expected = {'iptables': sum(len(cidrs) for cidrs in payload['cidrs'].values()),
+                        'nftables': sum(len(updater.cidrs_to_ranges(cidrs)) for cidrs in payload['cidrs'].values())}
+            for agent, result in zip(agents, results):
+                result['entries_in_kernel'] = kernel_entries(os.path.join(agent['work'], 'kernel.json'))
+                result['consistent'] = result['entries_in_kernel'] == expected[agent['backend']]
+            report.append({'step': step, 'version': payload['version'], 'artifact_bytes': len(body),
+                           'build_seconds': round(built - started, 3), 'push_seconds': round(pushed - built, 3), 'agents': results})
+        json.dump(report, sys.stdout, indent=2)
+        print()
+        ok = all(result['ok'] and result['consistent'] for step in report for result in step['agents'])
+        print("All agents consistent." if ok else "Some agents are inconsistent.", file=sys.stderr)
+        return 0 if ok else 1
+    finally:
+        for agent in agents:
+            agent['process'].terminate()
+            agent['process'].wait()
+        server.shutdown()
+        if not args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,91 @@
+"""Generate synthetic IP2Location LITE DB1 archives (IPv4 and IPv6 editions).
+
+Rows cover the whole address space contiguously like the real files, with `-` for
+unassigned space. Range sizes are log-normal, aligned to /24 (IPv4) or /48 (IPv6)
+boundaries, and countries are drawn from a weighted mix. The same rows can also be
+written as ipdeny-style per-country zone files.
+"""
+import io
+import os
+import csv
+import random
+import zipfile
+import argparse
+import ipaddress
+
+DEFAULT_MIX = "US:0.25,CN:0.15,RU:0.08,DE:0.06,GB:0.05,FR:0.05,JP:0.05,BR:0.04,IN:0.04,-:0.1,NL:0.03,UA:0.03,PL:0.02,CA:0.02,AU:0.02,KR:0.01"
+COUNTRY_NAMES = {'-': '-'}
+ALIGN_BITS = {32: 8, 128: 80}
+
+
+def parse_mix(mix):
+    weights = {}
+    for item in mix.split(','):
+        code, weight = item.split(':')
+        weights[code.strip()] = float(weight)
+    return weights
+
+
+def generate_rows(rows, bits, mix, seed=0):
+    """Yield (start, end, code) covering 0..2**bits-1 in roughly `rows` ranges."""
+    rng = random.Random(seed)
+    codes, weights = zip(*mix.items())
+    align = ALIGN_BITS[bits]
+    units = 1 << (bits - align)
+    mean_size = units / max(rows, 1)
+    start = 0
+    while start < units:
+        size = max(1, int(mean_size * rng.lognormvariate(-1.0, 1.4)))
+        end = min(units, start + size)
+        yield start << align, (end << align) - 1, rng.choices(codes, weights)[0]
+        start = end
+
+
+def write_zip(path, member, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, quoting=csv.QUOTE_ALL, lineterminator='\n')
+    for start, end, code in rows:
+        writer.writerow([start, end, code, COUNTRY_NAMES.get(code, code)])
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zip_ref:
+        zip_ref.writestr(member, buffer.getvalue())
+
+
+def write_zone_files(directory, rows, bits):
+    """Write `<directory>/<cc>.zone` with each country's ranges as CIDRs, like ipdeny.com publishes them."""
+    address = ipaddress.IPv4Address if bits == 32 else ipaddress.IPv6Address
+    zones = {}
+    for start, end, code in rows:
+        if code != '-':
+            zones.setdefault(code, []).extend(ipaddress.summarize_address_range(address(start), address(end)))
+    os.makedirs(directory, exist_ok=True)
+    for code, networks in zones.items():
+        with open(os.path.join(directory, f"{code.lower()}.zone"), 'w') as f:
+            f.writelines(f"{network}\n" for network in networks)
+
+
+def generate(ipv4_path, ipv6_path, rows=200000, ipv6_rows=None, mix=DEFAULT_MIX, seed=0, zone_dir=None):
+    """Write both archives and return the number of rows in each.
+
+    With `zone_dir`, also write zone files to its ipv4/ and ipv6/ subdirectories."""
+    weights = parse_mix(mix)
+    ipv4 = list(generate_rows(rows, 32, weights, seed))
+    ipv6 = list(generate_rows(ipv6_rows or rows * 2, 128, weights, seed + 1))
+    write_zip(ipv4_path, "IP2LOCATION-LITE-DB1.CSV", ipv4)
+    write_zip(ipv6_path, "IP2LOCATION-LITE-DB1.IPV6.CSV", ipv6)
+    if zone_dir:
+        write_zone_files(os.path.join(zone_dir, 'ipv4'), ipv4, 32)
+        write_zone_files(os.path.join(zone_dir, 'ipv6'), ipv6, 128)
+    return len(ipv4), len(ipv6)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=200000, help="approximate IPv4 row count")
+    parser.add_argument('--ipv6-rows', type=int, help="approximate IPv6 row count (default: twice --rows)")
+    parser.add_argument('--mix', default=DEFAULT_MIX, help="comma separated CODE:weight country mix")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--ipv4', default="IP2LOCATION-LITE-DB1.CSV.ZIP")
+    parser.add_argument('--ipv6', default="IP2LOCATION-LITE-DB1.IPV6.CSV.ZIP")
+    parser.add_argument('--zones', help="also write ipdeny-style zone files under this directory")
+    args = parser.parse_args()
+    print(generate(args.ipv4, args.ipv6, args.rows, args.ipv6_rows, args.mix, args.seed, args.zones))
@@ -0,0 +1,206 @@
+"""Packet-rate comparison of the enforcement points in two network namespaces (needs root).
+
+A sender and a receiver namespace are joined by a veth pair. For each backend and enforcement
+point the receiver gets a fresh namespace with the real rules (one blocked /24 and one
+whitelisted address inside it) and a single stateful rule, as any real host has, so conntrack
+is active. The sender floods UDP from a blocked address, every packet a new port pair and so
+a new conntrack flow, while two probe streams from the blocked and the whitelisted address
+check that blocking and whitelist precedence still hold.
+
+Reported per mode: the flood rate the sender reached, conntrack entries left on the receiver,
+softirq CPU time spent during the flood and the probe packets received from each address.
+
+    sudo python3 bench/netns.py --seconds 5
+    sudo python3 bench/netns.py --modes iptables:input iptables:raw nftables:ingress
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+from compiler import cidrs_to_ranges
+from firewall import BACKENDS, IPSET_NAME
+
+SENDER_NS = "geoblock-bench-tx"
+RECEIVER_NS = "geoblock-bench-rx"
+SENDER_LINK = "gb-tx"
+RECEIVER_LINK = "gb-rx"
+SENDER_ADDRESS = "10.203.0.2/24"
+RECEIVER_ADDRESS = "10.203.0.1"
+BLOCKED_RANGE = "203.0.113.0/24"
+FLOOD_SOURCE = "203.0.113.10"
+WHITELISTED_SOURCE = "203.0.113.20"
+# Outside the flood's destination ports (1024-61023)
+PROBE_PORT = 62000
+PROBE_RATE = 500
+MODES = ['iptables:input', 'iptables:raw', 'nftables:input', 'nftables:raw', 'nftables:ingress']
+
+# Each packet leaves from one of 256 sockets to a rotating destination port, so every packet is a new flow
+FLOOD_SCRIPT = '''
+import socket, sys, time
+source, target, seconds = sys.argv[1], sys.argv[2], float(sys.argv[3])
+sockets = []
+for _ in range(256):
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.bind((source, 0))
+    s.setblocking(False)
+    sockets.append(s)
+payload = b"x" * 32
+sent = 0
+deadline = time.monotonic() + seconds
+while time.monotonic() < deadline:
+    for s in sockets:
+        try:
+            s.sendto(payload, (target, 1024 + sent % 60000))
+            sent += 1
+        except BlockingIOError:
+            pass
+print(sent)
+'''
+PROBE_SCRIPT = '''
+import socket, sys, time
+source, target, port, rate, seconds = sys.argv[1], sys.argv[2], int(sys.argv[3]), float(sys.argv[4]), float(sys.argv[5])
+s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+s.bind((source, 0))
+sent = 0
+started = time.monotonic()
+while time.monotonic() - started < seconds:
+    s.sendto(b"probe", (target, port))
+    sent += 1
+    time.sleep(max(0.0, started + sent / rate - time.monotonic()))
+print(sent)
+'''
+RECEIVER_SCRIPT = '''
+import json, socket, sys, time
+address, port, seconds = sys.argv[1], int(sys.argv[2]), float(sys.argv[3])
+s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+s.bind((address, port))
+s.settimeout(0.2)
+counts = {}
+deadline = time.monotonic() + seconds
+while time.monotonic() < deadline:
+    try:
+        _, (source, _) = s.recvfrom(64)
+    except socket.timeout:
+        continue
+    counts[source] = counts.get(source, 0) + 1
+print(json.dumps(counts))
+'''
+
+
+def ip(*args, check=True):
+    return subprocess.run(['ip', *args], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, check=check)
+
+
+def in_netns(namespace, args):
+    return ['ip', 'netns', 'exec', namespace, *args]
+
+
+def netns_runner(namespace):
+    """A firewall runner that executes commands inside `namespace` instead of through sudo."""
+    def runner(args, input_lines=None, check=True):
+        stdin = ''.join(input_lines) if input_lines is not None else None
+        return subprocess.run(in_netns(namespace, args), input=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, check=check)
+    return runner
+
+
+def teardown_namespaces():
+    for namespace in (SENDER_NS, RECEIVER_NS):
+        ip('netns', 'del', namespace, check=False)
+
+
+def setup_namespaces():
+    teardown_namespaces()
+    for namespace in (SENDER_NS, RECEIVER_NS):
+        ip('netns', 'add', namespace)
+        ip('-n', namespace, 'link', 'set', 'lo', 'up')
+    ip('link', 'add', SENDER_LINK, 'netns', SENDER_NS, 'type', 'veth', 'peer', 'name', RECEIVER_LINK, 'netns', RECEIVER_NS)
+    for address in (SENDER_ADDRESS, f"{FLOOD_SOURCE}/32", f"{WHITELISTED_SOURCE}/32"):
+        ip('-n', SENDER_NS, 'addr', 'add', address, 'dev', SENDER_LINK)
+    ip('-n', RECEIVER_NS, 'addr', 'add', f"{RECEIVER_ADDRESS}/24", 'dev', RECEIVER_LINK)
+    ip('-n', SENDER_NS, 'link', 'set', SENDER_LINK, 'up')
+    ip('-n', RECEIVER_NS, 'link', 'set', RECEIVER_LINK, 'up')
+    # Replies to the blocked range must leave through the veth for rp_filter to accept its packets
+    ip('-n', RECEIVER_NS, 'route', 'add', BLOCKED_RANGE, 'dev', RECEIVER_LINK)
+
+
+def install_rules(backend_name, enforcement):
+    runner = netns_runner(RECEIVER_NS)
+    backend = BACKENDS[backend_name](runner, enforcement=enforcement, interfaces=[RECEIVER_LINK])
+    whitelist = [f"{WHITELISTED_SOURCE}/32"]
+    if backend_name == 'nftables':
+        backend.apply({'inet': cidrs_to_ranges([BLOCKED_RANGE])}, whitelist, [])
+    else:
+        backend.sync_whitelist(whitelist)
+        backend.setup_set(IPSET_NAME)
+        backend.load_set(IPSET_NAME, [BLOCKED_RANGE])
+        backend.setup_rules('inet', [])
+    runner(['iptables', '-A', 'INPUT', '-m', 'conntrack', '--ctstate', 'INVALID', '-j', 'DROP'])
+
+
+def softirq_seconds():
+    with open('/proc/stat') as f:
+        fields = f.readline().split()
+    return int(fields[7]) / os.sysconf('SC_CLK_TCK')
+
+
+def run_mode(mode, seconds):
+    backend_name, enforcement = mode.split(':')
+    setup_namespaces()
+    install_rules(backend_name, enforcement)
+
+    python = sys.executable
+    receiver = subprocess.Popen(in_netns(RECEIVER_NS, [python, '-c', RECEIVER_SCRIPT, RECEIVER_ADDRESS, str(PROBE_PORT), str(seconds + 1)]),
+                                stdout=subprocess.PIPE, text=True)
+    time.sleep(0.3)
+    probes = {source: subprocess.Popen(in_netns(SENDER_NS, [python, '-c', PROBE_SCRIPT, source, RECEIVER_ADDRESS, str(PROBE_PORT), str(PROBE_RATE), str(seconds)]),
+                                       stdout=subprocess.PIPE, text=True)
+              for source in (FLOOD_SOURCE, WHITELISTED_SOURCE)}
+    softirq = softirq_seconds()
+    flood = subprocess.run(in_netns(SENDER_NS, [python, '-c', FLOOD_SCRIPT, FLOOD_SOURCE, RECEIVER_ADDRESS, str(seconds)]),
+                           stdout=subprocess.PIPE, text=True, check=True)
+    softirq = softirq_seconds() - softirq
+    probes_sent = {source: int(probe.communicate()[0]) for source, probe in probes.items()}
+    received = json.loads(receiver.communicate()[0] or '{}')
+    conntrack = netns_runner(RECEIVER_NS)(['cat', '/proc/sys/net/netfilter/nf_conntrack_count'], check=False).stdout.strip()
+
+    return {
+        'mode': mode,
+        'flood_pps': round(int(flood.stdout) / seconds),
+        'conntrack_entries': int(conntrack) if conntrack.isdigit() else None,
+        'softirq_seconds': round(softirq, 3),
+        'blocked_probes': {'sent': probes_sent[FLOOD_SOURCE], 'received': received.get(FLOOD_SOURCE, 0)},
+        'whitelisted_probes': {'sent': probes_sent[WHITELISTED_SOURCE], 'received': received.get(WHITELISTED_SOURCE, 0)},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare enforcement points under a UDP flood in network namespaces.")
+    parser.add_argument('--seconds', type=float, default=5.0, help="flood duration per mode")
+    parser.add_argument('--modes', nargs='+', default=MODES, choices=MODES, help="backend:enforcement pairs to run")
+    args = parser.parse_args()
+    if os.geteuid() != 0:
+        parser.error("network namespaces need root")
+
+    results = []
+    try:
+        for mode in args.modes:
+            result = run_mode(mode, args.seconds)
+            results.append(result)
+            print(f"{mode:18} flood {result['flood_pps']:9} pps  conntrack {result['conntrack_entries']}  "
+                  f"softirq {result['softirq_seconds']:.2f}s  blocked probes {result['blocked_probes']['received']}/{result['blocked_probes']['sent']}  "
+                  f"whitelisted probes {result['whitelisted_probes']['received']}/{result['whitelisted_probes']['sent']}", file=sys.stderr)
+    finally:
+        teardown_namespaces()
+    json.dump(results, sys.stdout, indent=2)
+    print()
+    ok = all(result['blocked_probes']['received'] == 0 and result['whitelisted_probes']['received'] > 0 for result in results)
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
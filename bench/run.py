@@ -0,0 +1,225 @@
+"""Offline benchmark for updater.update().
+
+Each scenario runs in a fresh worker process against a synthetic IP2Location database
+served from a loopback HTTP server, with fake ipset/iptables/nft/sudo executables first
+on PATH. Every scenario is run cold (empty state) and then warm (unchanged inputs).
+Results are written as JSON: wall time per phase (as recorded by update()), subprocess count,
+peak RSS and the number of entries loaded into the fake kernel.
+
+    python3 bench/run.py --rows 50000 200000 --output bench_results.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import argparse
+import platform
+import resource
+import tempfile
+import functools
+import threading
+import subprocess
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+SHIM = os.path.join(BENCH_DIR, 'shims', 'fake_command.py')
+SHIM_NAMES = ['sudo', 'ping', 'ipset', 'iptables', 'ip6tables', 'iptables-save', 'ip6tables-save',
+              'iptables-restore', 'ip6tables-restore', 'nft']
+SELECTIONS = {'small': ['CN', 'RU'], 'large': ['CN', 'RU', 'US', 'BR', 'IN']}
+SCENARIOS = [
+    # (name, backend, engine, selection, extra settings)
+    ('iptables-python-small', 'iptables', 'python', 'small', {}),
+    ('iptables-numpy-small', 'iptables', 'numpy', 'small', {}),
+    ('iptables-python-large', 'iptables', 'python', 'large', {}),
+    ('iptables-numpy-large', 'iptables', 'numpy', 'large', {}),
+    ('iptables-per-country-large', 'iptables', 'auto', 'large', {'set_layout': 'per_country'}),
+    ('iptables-ipdeny-small', 'iptables', 'auto', 'small', {'data_source': 'ipdeny'}),
+    ('iptables-ipdeny-large', 'iptables', 'auto', 'large', {'data_source': 'ipdeny'}),
+    ('iptables-allow-only-small', 'iptables', 'auto', 'small', {'selection_mode': 'allow'}),
+    ('nftables-small', 'nftables', 'auto', 'small', {}),
+    ('nftables-large', 'nftables', 'auto', 'large', {}),
+    ('nftables-ipdeny-large', 'nftables', 'auto', 'large', {'data_source': 'ipdeny'}),
+    ('nftables-allow-only-small', 'nftables', 'auto', 'small', {'selection_mode': 'allow'}),
+]
+APP_SCHEMA = [
+    'CREATE TABLE countries (id INTEGER PRIMARY KEY, code TEXT, name TEXT, picked BOOLEAN)',
+    'CREATE TABLE whitelisted_ips (id INTEGER PRIMARY KEY, cidr TEXT)',
+    'CREATE TABLE port_rules (id INTEGER PRIMARY KEY, port_number INTEGER, protocol TEXT)',
+    'CREATE TABLE system_info (last_update_date DATETIME)',
+    'CREATE TABLE settings (key TEXT PRIMARY KEY, value TEXT)',
+]
+
+
+def make_shim_dir(path):
+    os.makedirs(path, exist_ok=True)
+    for name in SHIM_NAMES:
+        target = os.path.join(path, name)
+        if not os.path.exists(target):
+            os.symlink(SHIM, target)
+
+
+def init_app_db(path, countries, backend, settings=None):
+    with sqlite3.connect(path) as conn:
+        for statement in APP_SCHEMA:
+            conn.execute(statement)
+        conn.executemany('INSERT INTO countries (code, name, picked) VALUES (?, ?, ?)', [(code, code, True) for code in countries])
+        conn.executemany('INSERT INTO whitelisted_ips (cidr) VALUES (?)', [('192.0.2.0/24',), ('2001:db8::/32',)])
+        conn.executemany('INSERT INTO port_rules (port_number, protocol) VALUES (?, ?)', [(22, 'tcp'), (443, 'tcp'), (53, 'udp')])
+        conn.executemany('INSERT INTO settings (key, value) VALUES (?, ?)', [('firewall_backend', backend), *(settings or {}).items()])
+
+
+def peak_rss_kb():
+    """Peak RSS of this process alone; ru_maxrss keeps the parent's high-water mark across fork and exec."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_worker(config):
+    """Run one update() inside this process and print its measurements as JSON."""
+    sys.path.insert(0, REPO_DIR)
+    import updater
+    import sources
+
+    work = config['work_dir']
+    updater.ZONE_DIR = work
+    updater.BACKUP_ZONE_DIR = os.path.join(work, 'backup')
+    updater.STATE_DIR = os.path.join(work, 'state')
+    updater.CIDR_CACHE_DIR = os.path.join(work, 'cidr_cache')
+    updater.IPDENY_CACHE_DIR = os.path.join(work, 'ipdeny')
+    sources.IPDENY_URLS.update(config['zone_urls'])
+    for family, url in config['urls'].items():
+        updater.FAMILIES[family].update(url=url, zip=os.path.join(work, os.path.basename(url)),
+                                        index=os.path.join(work, f"{family}.idx"))
+
+    started = time.perf_counter()
+    updater.update(engine=config['engine'])
+    wall = time.perf_counter() - started
+    run = updater.current_run
+    phases = {phase: round(seconds, 4) for phase, seconds in run.phases.items()}
+    phases['other'] = round(wall - sum(run.phases.values()), 4)
+    return {'wall': round(wall, 4), 'phases': phases, 'rows_scanned': run.rows_scanned,
+            'bytes_downloaded': run.bytes_downloaded, 'entries_loaded': run.entries_loaded,
+            'peak_rss_kb': peak_rss_kb()}
+
+
+def kernel_entries(state_path):
+    with open(state_path) as f:
+        state = json.load(f)
+    block_sets = {'GEO_BLOCK', 'GEO_BLOCK6'}
+    lists = state.get('lists', {})
+    # A per-country list:set counts the entries of its member sets
+    entries = sum(sum(state['sets'].get(member, 0) for member in lists[name]) if name in lists else count
+                  for name, count in state['sets'].items() if name in block_sets)
+    for counts in state['nft'].values():
+        entries += sum(count for name, count in counts.items() if name.startswith('block'))
+    return entries
+
+
+def run_scenario(name, backend, engine, selection, settings, urls, zone_urls, root):
+    work = os.path.join(root, name)
+    os.makedirs(work)
+    init_app_db(os.path.join(work, 'app.db'), SELECTIONS[selection], backend, settings)
+    env = dict(os.environ,
+               PATH=os.path.join(root, 'shims') + os.pathsep + os.environ['PATH'],
+               GEOBLOCK_HOME=work,
+               GEOBLOCK_BENCH_LOG=os.path.join(work, 'calls.log'),
+               GEOBLOCK_BENCH_STATE=os.path.join(work, 'kernel.json'))
+    config = {'work_dir': work, 'urls': urls, 'zone_urls': zone_urls, 'engine': engine}
+
+    results = []
+    for run in ('cold', 'warm'):
+        open(env['GEOBLOCK_BENCH_LOG'], 'w').close()
+        worker = subprocess.run([sys.executable, os.path.abspath(__file__), '--worker', json.dumps(config)],
+                                env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        if worker.returncode != 0:
+            raise RuntimeError(f"Scenario {name} ({run}) failed:\n{worker.stderr}")
+        result = json.loads(worker.stdout.strip().splitlines()[-1])
+        with open(env['GEOBLOCK_BENCH_LOG']) as log:
+            result['subprocesses'] = sum(1 for _ in log)
+        result.update(scenario=name, run=run, backend=backend, engine=engine, settings=settings, countries=SELECTIONS[selection],
+                      entries=kernel_entries(env['GEOBLOCK_BENCH_STATE']))
+        results.append(result)
+        print(f"{name:24} {run:5} wall {result['wall']:8.3f}s  subprocesses {result['subprocesses']:4}  "
+              f"entries {result['entries']:8}  rss {result['peak_rss_kb'] // 1024} MB", file=sys.stderr)
+    return results
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(directory):
+    handler = functools.partial(QuietHandler, directory=directory)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark updater.update() offline.")
+    parser.add_argument('--rows', type=int, nargs='+', default=[50000, 200000], help="IPv4 row counts of the synthetic databases")
+    parser.add_argument('--scenarios', nargs='+', help="only run scenarios whose name contains one of these strings")
+    parser.add_argument('--output', default='-', help="where to write the JSON results (default: stdout)")
+    parser.add_argument('--keep', action='store_true', help="keep the working directory")
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        result = run_worker(json.loads(args.worker))
+        print(json.dumps(result))
+        return
+
+    sys.path.insert(0, BENCH_DIR)
+    from gen_db import generate
+
+    root = tempfile.mkdtemp(prefix='geoblock-bench-')
+    make_shim_dir(os.path.join(root, 'shims'))
+    data_dir = os.path.join(root, 'data')
+    os.makedirs(data_dir)
+    server = serve(data_dir)
+    results = []
+    try:
+        for rows in args.rows:
+            ipv4, ipv6 = f"db4-{rows}.zip", f"db6-{rows}.zip"
+            generated = generate(os.path.join(data_dir, ipv4), os.path.join(data_dir, ipv6), rows, zone_dir=os.path.join(data_dir, f"zones-{rows}"))
+            print(f"Generated {generated[0]} IPv4 and {generated[1]} IPv6 rows", file=sys.stderr)
+            base = f"http://127.0.0.1:{server.server_address[1]}"
+            urls = {'inet': f"{base}/{ipv4}", 'inet6': f"{base}/{ipv6}"}
+            zone_urls = {'inet': f"{base}/zones-{rows}/ipv4", 'inet6': f"{base}/zones-{rows}/ipv6"}
+            for name, backend, engine, selection, settings in SCENARIOS:
+                if args.scenarios and not any(pattern in name for pattern in args.scenarios):
+                    continue
+                for result in run_scenario(f"{name}-{rows}", backend, engine, selection, settings, urls, zone_urls, root):
+                    result['rows'] = rows
+                    results.append(result)
+    finally:
+        server.shutdown()
+        if not args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+    if args.output == '-':
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
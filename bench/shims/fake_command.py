@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""Stand-in for sudo, ping, ipset, iptables, ip6tables and nft used by the benchmark.
+
+Installed under each command's name (see run.py), it records every call as a JSON line in
+$GEOBLOCK_BENCH_LOG and keeps just enough fake kernel state in $GEOBLOCK_BENCH_STATE
+(existing sets, their entry counts, list:set members with counters, chains and rules)
+for the updater's checks to behave.
+"""
+import os
+import sys
+import json
+
+def load_state(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {'sets': {}, 'lists': {}, 'rules': [], 'nft': {}}
+
+
+def ipset_list(sets, lists, args):
+    names = [arg for arg in args[1:] if not arg.startswith('-')]
+    if not names:
+        print('\n'.join(sets))
+        return 0
+    name = names[0]
+    if name not in sets:
+        return 1
+    if '-n' in args:
+        print(name)
+        return 0
+    print(f"Name: {name}\nType: {'list:set' if name in lists else 'hash:net'}")
+    if '-t' not in args:
+        print("Members:")
+        for member, (packets, bytes_) in lists.get(name, {}).items():
+            print(f"{member} packets {packets} bytes {bytes_}")
+    return 0
+
+
+def ipset(state, args, lines):
+    sets = state['sets']
+    lists = state.setdefault('lists', {})
+    if args[0] == '-exist':
+        args = args[1:]
+    command = args[0]
+    if command == 'list':
+        return ipset_list(sets, lists, args)
+    if command == 'create':
+        sets.setdefault(args[1], 0)
+    elif command == 'destroy':
+        lists.pop(args[1], None)
+        return 0 if sets.pop(args[1], None) is not None else 1
+    elif command == 'swap':
+        sets[args[1]], sets[args[2]] = sets[args[2]], sets[args[1]]
+        a, b = lists.pop(args[1], None), lists.pop(args[2], None)
+        if a is not None:
+            lists[args[2]] = a
+        if b is not None:
+            lists[args[1]] = b
+    elif command == 'add':
+        sets[args[1]] = sets.get(args[1], 0) + 1
+    elif command == 'restore':
+        for line in lines:
+            parts = line.split()
+            if parts and parts[0] in ('create', 'add', 'del'):
+                name = parts[1]
+                delta = {'create': 0, 'add': 1, 'del': -1}[parts[0]]
+                sets[name] = sets.get(name, 0) + delta
+                if parts[0] == 'create' and parts[2] == 'list:set':
+                    lists[name] = {}
+                elif name in lists and parts[0] == 'add':
+                    lists[name][parts[2]] = [0, 0]
+                elif name in lists:
+                    lists[name].pop(parts[2], None)
+    return 0
+
+
+def iptables(state, name, args, lines):
+    chains = state.setdefault('chains', [])
+    command = name.split('-')[0]
+    if name.endswith('-restore'):
+        table = 'filter'
+        for line in lines:
+            if line.startswith('*'):
+                table = line[1:].strip()
+            elif line.startswith(':') and f"{command} {table} {line[1:].split()[0]}" not in chains:
+                chains.append(f"{command} {table} {line[1:].split()[0]}")
+        return 0
+    table = 'filter'
+    if args[0] == '-t':
+        table, args = args[1], args[2:]
+    if args[:2] == ['-n', '-L']:
+        return 0 if f"{command} {table} {args[2]}" in chains else 1
+    if args[0] == '-X':
+        if f"{command} {table} {args[1]}" not in chains:
+            return 1
+        chains.remove(f"{command} {table} {args[1]}")
+        return 0
+    rule = ' '.join([command, table, *args[1:]])
+    if args[0] == '-C':
+        return 0 if rule in state['rules'] else 1
+    if args[0] in ('-I', '-A'):
+        state['rules'].append(rule.replace(' 1 -j ', ' -j '))
+    elif args[0] == '-D':
+        if rule not in state['rules']:
+            return 1
+        state['rules'].remove(rule)
+    return 0
+
+
+def nft(state, args, lines):
+    tables = state['nft']
+    if args[:2] == ['list', 'table']:
+        return 0 if args[-1] in tables else 1
+    if args[:2] == ['delete', 'table']:
+        return 0 if tables.pop(args[-1], None) is not None else 1
+    if args[0] == '-f':
+        current, counts, table = None, {}, None
+        for line in lines:
+            stripped = line.strip()
+            if stripped.startswith('table ') and stripped.endswith('{'):
+                table = stripped.split()[2]
+            elif stripped.startswith('set '):
+                current = stripped.split()[1]
+                counts[current] = 0
+            elif current and (stripped.startswith('elements = {') or line.startswith(' ' * 12)):
+                counts[current] += 1
+            elif stripped == '}':
+                current = None
+        if table:
+            tables[table] = counts
+    return 0
+
+
+def main():
+    name = os.path.basename(sys.argv[0])
+    args = sys.argv[1:]
+    if name == 'sudo':
+        os.execvp(args[0], args)
+
+    reads_stdin = 'restore' in args or name.endswith('-restore') or (name == 'nft' and '-f' in args)
+    lines = sys.stdin.readlines() if reads_stdin else []
+    with open(os.environ['GEOBLOCK_BENCH_LOG'], 'a') as log:
+        log.write(json.dumps({'cmd': name, 'args': args, 'stdin_lines': len(lines)}) + '\n')
+
+    state_path = os.environ['GEOBLOCK_BENCH_STATE']
+    state = load_state(state_path)
+    if name == 'ipset':
+        code = ipset(state, args, lines)
+    elif name in ('iptables', 'ip6tables', 'iptables-restore', 'ip6tables-restore'):
+        code = iptables(state, name, args, lines)
+    elif name == 'nft':
+        code = nft(state, args, lines)
+    else:
+        code = 0
+    with open(state_path, 'w') as f:
+        json.dump(state, f)
+    return code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
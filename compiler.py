@@ -0,0 +1,172 @@
+import bisect
+import socket
+import ipaddress
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def merge_ranges(ranges):
+    """Merge overlapping and touching (start, end) integer ranges."""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            if end > merged[-1][1]:
+                merged[-1][1] = end
+        else:
+            merged.append([start, end])
+    return [(start, end) for start, end in merged]
+
+
+def range_to_cidrs(start, end, bits=32):
+    """Return the exact minimal list of (network, prefixlen) blocks covering start..end."""
+    blocks = []
+    while start <= end:
+        size = (start & -start).bit_length() - 1 if start else bits
+        span = (end - start + 1).bit_length() - 1
+        size = min(size, span)
+        blocks.append((start, bits - size))
+        start += 1 << size
+    return blocks
+
+
+def format_cidr(network, prefixlen, bits=32):
+    if bits == 32:
+        address = socket.inet_ntop(socket.AF_INET, network.to_bytes(4, 'big'))
+    elif network >> 48:
+        address = socket.inet_ntop(socket.AF_INET6, network.to_bytes(16, 'big'))
+    else:
+        # inet_ntop writes IPv4-compatible and IPv4-mapped addresses in dotted form, ipaddress does not
+        address = ipaddress.IPv6Address(network)
+    return f"{address}/{prefixlen}"
+
+
+def compile_ranges(ranges, bits=32):
+    """Merge all selected ranges and emit the minimal exact CIDR cover as strings."""
+    cidrs = []
+    for start, end in merge_ranges(ranges):
+        for network, prefixlen in range_to_cidrs(start, end, bits):
+            cidrs.append(format_cidr(network, prefixlen, bits))
+    return cidrs
+
+
+def cidr_bounds(cidr, bits=32):
+    """Return the (start, end) integers of a CIDR string; inet_pton is far cheaper than ipaddress here."""
+    address, _, prefixlen = cidr.partition('/')
+    start = int.from_bytes(socket.inet_pton(socket.AF_INET if bits == 32 else socket.AF_INET6, address), 'big')
+    size = 1 << (bits - int(prefixlen or bits))
+    start &= ~(size - 1)
+    return start, start + size - 1
+
+
+def cidrs_to_ranges(cidrs):
+    """Return the merged (start, end) integer ranges covered by CIDR strings."""
+    return merge_ranges(cidr_bounds(cidr, 128 if ':' in cidr else 32) for cidr in cidrs)
+
+
+def complement_ranges(ranges, space, excluded=()):
+    """Return the merged parts of the `space` (start, end) range covered by neither `ranges` nor `excluded`."""
+    low, high = space
+    gaps = []
+    cursor = low
+    for start, end in merge_ranges([*ranges, *excluded]):
+        if start > high:
+            break
+        if start > cursor:
+            gaps.append((cursor, start - 1))
+        cursor = max(cursor, end + 1)
+    if cursor <= high:
+        gaps.append((cursor, high))
+    return gaps
+
+
+def subtract_ranges(cidrs, removed, bits=32):
+    """Take the merged `removed` ranges out of a list of CIDR strings.
+
+    Returns (to_del, to_add): the entries that overlap `removed`, and the CIDRs covering
+    the parts of those entries that lie outside it."""
+    starts = [start for start, _ in removed]
+    to_del, remaining = [], []
+    for cidr in cidrs:
+        low, high = cidr_bounds(cidr, bits)
+        position = bisect.bisect_right(starts, high) - 1
+        if position < 0 or removed[position][1] < low:
+            continue
+        while position > 0 and removed[position - 1][1] >= low:
+            position -= 1
+        to_del.append(cidr)
+        cursor = low
+        for start, end in removed[position:]:
+            if start > high:
+                break
+            if start > cursor:
+                remaining.append((cursor, start - 1))
+            cursor = max(cursor, end + 1)
+        if cursor <= high:
+            remaining.append((cursor, high))
+    return to_del, compile_ranges(remaining, bits)
+
+
+def merge_ranges_np(starts, ends):
+    """Vectorized merge_ranges over uint64 arrays; returns merged (starts, ends) arrays."""
+    if not len(starts):
+        return starts, ends
+    order = np.argsort(starts, kind='stable')
+    starts, ends = starts[order], ends[order]
+    reach = np.maximum.accumulate(ends)
+    new_group = np.ones(len(starts), dtype=bool)
+    new_group[1:] = starts[1:] > reach[:-1] + 1
+    group_starts = np.flatnonzero(new_group)
+    group_ends = np.append(group_starts[1:], len(starts)) - 1
+    return starts[group_starts], reach[group_ends]
+
+
+def range_to_cidrs_np(starts, ends, bits=32):
+    """Vectorized range_to_cidrs for IPv4; returns (networks, prefixlens) sorted by network."""
+    networks, prefixlens = [], []
+    starts, ends = starts.astype(np.uint64), ends.astype(np.uint64)
+    while len(starts):
+        lowbit = starts & (~starts + np.uint64(1))
+        lowbit[starts == 0] = np.uint64(1) << np.uint64(bits)
+        _, exponent = np.frexp((ends - starts + np.uint64(1)).astype(np.float64))
+        span = np.uint64(1) << (exponent - 1).astype(np.uint64)
+        size = np.minimum(lowbit, span)
+        networks.append(starts)
+        prefixlens.append(bits - np.frexp(size.astype(np.float64))[1] + 1)
+        starts = starts + size
+        remaining = starts <= ends
+        starts, ends = starts[remaining], ends[remaining]
+    if not networks:
+        return np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.int64)
+    networks, prefixlens = np.concatenate(networks), np.concatenate(prefixlens)
+    order = np.argsort(networks, kind='stable')
+    return networks[order], prefixlens[order]
+
+
+def compile_index_np(index, codes):
+    """Select, merge and split the countries' IPv4 ranges from a RangeIndex with NumPy.
+
+    Produces the same list as compile_ranges(index.ranges(codes)). Returns (cidrs, rows)."""
+    numbers = [number for number, code in enumerate(index.codes) if code in codes]
+    country_numbers = np.frombuffer(index.country_numbers, dtype=np.uint16)
+    mask = np.isin(country_numbers, numbers)
+    starts = np.frombuffer(index.starts, dtype=np.uint32)[mask].astype(np.uint64)
+    ends = np.frombuffer(index.ends, dtype=np.uint32)[mask].astype(np.uint64)
+    del country_numbers
+    rows = len(starts)
+
+    return format_cidrs_np(*range_to_cidrs_np(*merge_ranges_np(starts, ends))), rows
+
+
+def compile_ranges_np(ranges):
+    """Vectorized compile_ranges for merged IPv4 (start, end) ranges."""
+    starts = np.array([start for start, _ in ranges], dtype=np.uint64)
+    ends = np.array([end for _, end in ranges], dtype=np.uint64)
+    return format_cidrs_np(*range_to_cidrs_np(starts, ends))
+
+
+def format_cidrs_np(networks, prefixlens):
+    octets = [(networks >> np.uint64(shift)) & np.uint64(0xFF) for shift in (24, 16, 8, 0)]
+    return [f"{a}.{b}.{c}.{d}/{p}" for a, b, c, d, p in zip(*(o.tolist() for o in octets), prefixlens.tolist())]
@@ -0,0 +1,316 @@
+"""Resident geoblock process: scheduled updates, immediate apply of app.db changes and a control socket.
+
+Replaces the cron entries that started a fresh updater.py twice a month and at reboot, and
+removes them at startup; the @reboot one only once --install has set up the systemd unit. The
+range indexes and applied sets stay in memory between runs, full updates are scheduled every
+update_interval_hours with random jitter and retried with exponential backoff when they fail,
+any change to the selection, ports, whitelist or firewall settings in app.db is applied as
+soon as it is committed, and every verify_interval_minutes the kernel is checked against the
+fingerprint of the last apply and any drift is repaired. The UI talks to the daemon over a
+unix socket with one JSON request and one JSON reply per connection. Every run holds
+updater.LOCK_PATH, so a manual updater.py or the UI's own jobs wait for it instead of racing it.
+
+    sudo python3 daemon.py --install    # start at boot through systemd
+    sudo python3 daemon.py
+    python3 daemon.py --send status
+"""
+import os
+import json
+import time
+import random
+import signal
+import socket
+import sqlite3
+import argparse
+import subprocess
+import threading
+import socketserver
+from datetime import datetime
+import db
+import updater
+from updater import get_setting, get_from_db
+from db import transaction
+from jobs import JobManager, run_job, JOB_KINDS, FULL_UPDATE, HOT_APPLY, VERIFY, WHITELIST, ROLLBACK
+
+CONTROL_SOCKET = os.environ.get("GEOBLOCK_SOCKET", os.path.join(updater.GEOBLOCK_HOME, "geoblock.sock"))
+CONTROL_TIMEOUT = 5
+UNIT_PATH = "/etc/systemd/system/geoblock.service"
+UNIT = """[Unit]
+Description=geoblock daemon
+Wants=network-online.target
+After=network-online.target
+
+[Service]
+ExecStart=/usr/bin/python3 {script}
+WorkingDirectory={home}
+Restart=on-failure
+
+[Install]
+WantedBy=multi-user.target
+"""
+# Entries of the cron schedule that the daemon replaced; the @reboot one is only removed once
+# the systemd unit starts the daemon at boot, so the rules still come back after a reboot
+LEGACY_CRON_JOBS = ['0 5 1,15 * * /usr/bin/python3 /opt/hosting/geoblock/updater.py']
+LEGACY_BOOT_CRON_JOB = '@reboot /usr/bin/python3 /opt/hosting/geoblock/updater.py'
+# Seconds between PRAGMA data_version polls of app.db
+WATCH_INTERVAL = 1.0
+UPDATE_INTERVAL_HOURS_DEFAULT = 336
+UPDATE_JITTER_MINUTES_DEFAULT = 60
+VERIFY_INTERVAL_MINUTES_DEFAULT = 5
+RETRY_BASE_SECONDS = 60
+RETRY_MAX_SECONDS = 6 * 3600
+# What each part of the configuration needs when it changes; the rest of app.db is ignored
+WATCHED = [
+    ('countries', 'SELECT code FROM countries WHERE picked == True ORDER BY code', HOT_APPLY),
+    ('whitelist', 'SELECT cidr FROM whitelisted_ips ORDER BY cidr', WHITELIST),
+    ('ports', 'SELECT port_number, protocol FROM port_rules ORDER BY port_number, protocol', FULL_UPDATE),
+    ('settings', '''SELECT key, value FROM settings WHERE key IN ('firewall_backend', 'set_layout', 'enforcement_point',
+        'enforcement_interfaces', 'data_source', 'selection_mode') ORDER BY key''', FULL_UPDATE),
+    ('schedule', '''SELECT key, value FROM settings WHERE key IN ('schedule_enabled', 'update_interval_hours',
+        'update_jitter_minutes', 'verify_interval_minutes') ORDER BY key''', None),
+]
+
+
+def schedule_enabled():
+    return get_setting('schedule_enabled', '1') == '1'
+
+
+def last_successful_update():
+    """Return the start time of the newest successful full update as a timestamp, or None."""
+    try:
+        rows = get_from_db("SELECT max(started_at) FROM update_runs WHERE success AND coalesce(kind, 'update') = 'update'")
+    except sqlite3.OperationalError:
+        return None
+    return datetime.fromisoformat(rows[0][0]).timestamp() if rows and rows[0][0] else None
+
+
+def install_unit(path=UNIT_PATH):
+    """Write the systemd unit that starts the daemon at boot and enable it."""
+    with open(path, 'w') as f:
+        f.write(UNIT.format(script=os.path.abspath(__file__), home=updater.GEOBLOCK_HOME))
+    subprocess.run(['systemctl', 'daemon-reload'], check=True)
+    subprocess.run(['systemctl', 'enable', os.path.basename(path)], check=True)
+    print(f"Installed {path}, start it with: systemctl start {os.path.basename(path)}")
+
+
+def remove_legacy_cron_jobs(unit_path=UNIT_PATH):
+    try:
+        crontab = subprocess.check_output(['crontab', '-l']).decode('utf-8')
+    except (OSError, subprocess.CalledProcessError):
+        return
+    legacy = LEGACY_CRON_JOBS + ([LEGACY_BOOT_CRON_JOB] if os.path.exists(unit_path) else [])
+    lines = crontab.splitlines()
+    kept = [line for line in lines if line.strip() not in legacy]
+    if kept != lines:
+        print(f"Removing {len(lines) - len(kept)} cron entries replaced by the daemon.")
+        subprocess.run(['crontab', '-'], input=('\n'.join(kept) + '\n').encode('utf-8'), check=True)
+
+
+def retry_delay(failures):
+    """Exponential backoff after `failures` consecutive failed runs, with up to 10% jitter."""
+    delay = min(RETRY_BASE_SECONDS * 2 ** (failures - 1), RETRY_MAX_SECONDS)
+    return delay * random.uniform(1.0, 1.1)
+
+
+class Daemon:
+    """Runs updates through one JobManager, from the schedule, the app.db watch and control requests."""
+
+    def __init__(self):
+        self.jobs = JobManager(self.run_job)
+        self.wake = threading.Event()
+        self.stopping = False
+        self.failures = 0
+        self.next_run = None
+        self.next_verify = None
+        self.config = None
+        self.started_at = time.time()
+
+    def run_job(self, run, kind, **arguments):
+        try:
+            result = run_job(run, kind, **arguments)
+        except Exception:
+            # A failed rollback leaves the rules as they were, and retrying it with a full update would undo it
+            if kind != ROLLBACK:
+                self.failures += 1
+                self.next_run = time.time() + retry_delay(self.failures)
+                print(f"{kind} failed ({self.failures} in a row), retrying with a full update at {datetime.fromtimestamp(self.next_run):%Y-%m-%d %H:%M:%S}.")
+            raise
+        finally:
+            self.wake.set()
+        if kind != ROLLBACK:
+            self.failures = 0
+        # A hot apply may have fallen back to a full update
+        self.reschedule()
+        self.reschedule_verify()
+        return result
+
+    def reschedule(self, last_run=None):
+        """Plan the next full update one interval plus jitter after `last_run`, or now when there was none."""
+        if self.failures:
+            return
+        last_run = last_run or last_successful_update()
+        if last_run is None:
+            self.next_run = time.time()
+            return
+        interval = float(get_setting('update_interval_hours', UPDATE_INTERVAL_HOURS_DEFAULT)) * 3600
+        jitter = float(get_setting('update_jitter_minutes', UPDATE_JITTER_MINUTES_DEFAULT)) * 60
+        self.next_run = last_run + interval + random.uniform(0, jitter)
+
+    def reschedule_verify(self):
+        """Plan the next drift check verify_interval_minutes from now; 0 turns the checks off."""
+        interval = float(get_setting('verify_interval_minutes', VERIFY_INTERVAL_MINUTES_DEFAULT)) * 60
+        self.next_verify = time.time() + interval if interval > 0 else None
+
+    def read_config(self):
+        return {name: get_from_db(sql) for name, sql, _ in WATCHED}
+
+    def check_config(self):
+        """Queue whatever the parts of the configuration that changed since the last check need."""
+        try:
+            config = self.read_config()
+        except sqlite3.OperationalError as e:
+            print(f"Cannot read the configuration: {e}")
+            return
+        changed = [(name, kind) for name, _, kind in WATCHED if self.config is not None and config[name] != self.config[name]]
+        self.config = config
+        if not changed:
+            return
+        print(f"Configuration changed: {', '.join(name for name, _ in changed)}")
+        kinds = {kind for _, kind in changed}
+        for kind in reversed(JOB_KINDS):
+            if kind in kinds:
+                self.jobs.submit(kind)
+                break
+        if None in kinds:
+            self.reschedule()
+            self.reschedule_verify()
+
+    def status(self):
+        latest = self.jobs.latest()
+        return {
+            'pid': os.getpid(),
+            'started_at': self.started_at,
+            'schedule_enabled': schedule_enabled(),
+            'next_run': self.next_run if schedule_enabled() or self.failures else None,
+            'next_verify': self.next_verify,
+            'failures': self.failures,
+            'running': self.jobs.running,
+            'job': latest.progress() if latest else None,
+        }
+
+    def handle(self, request):
+        """Answer one control request: {"command": ..., ...arguments}."""
+        command = request.get('command')
+        if command == 'status':
+            return {'status': 'ok', **self.status()}
+        if command == 'submit':
+            kind = request.get('kind', FULL_UPDATE)
+            if kind not in JOB_KINDS + [ROLLBACK]:
+                return {'status': 'error', 'error': f"Unknown job kind: {kind}"}
+            arguments = {'snapshot': request.get('snapshot')} if kind == ROLLBACK else {}
+            return {'status': 'ok', 'job': self.jobs.submit(kind, **arguments).progress()}
+        if command == 'job':
+            job = self.jobs.get(request.get('id'))
+            if job is None:
+                return {'status': 'error', 'error': f"Unknown job: {request.get('id')}"}
+            return {'status': 'ok', 'job': job.progress()}
+        if command == 'schedule':
+            with transaction() as cursor:
+                cursor.execute('INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)', ('schedule_enabled', '1' if request.get('enabled') else '0'))
+            self.reschedule()
+            self.wake.set()
+            return {'status': 'ok', **self.status()}
+        if command == 'rollback':
+            # Queued like any other job, so it never runs alongside a verify or hot apply
+            return self.handle({**request, 'command': 'submit', 'kind': ROLLBACK})
+        return {'status': 'error', 'error': f"Unknown command: {command}"}
+
+    def serve(self, path=CONTROL_SOCKET):
+        """Run the control socket, the app.db watch and the scheduler until SIGTERM or SIGINT."""
+        daemon = self
+
+        class ControlHandler(socketserver.StreamRequestHandler):
+            def handle(self):
+                try:
+                    reply = daemon.handle(json.loads(self.rfile.readline()))
+                except ValueError as e:
+                    reply = {'status': 'error', 'error': f"Bad request: {e}"}
+                self.wfile.write(json.dumps(reply).encode() + b"\n")
+
+        if os.path.exists(path):
+            # Only a socket left behind by a daemon that died is taken over, never a live one
+            try:
+                control('status', path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                os.remove(path)
+            else:
+                raise SystemExit(f"Another geoblock daemon is already listening on {path}")
+        server = socketserver.ThreadingUnixStreamServer(path, ControlHandler)
+        server.daemon_threads = True
+        os.chmod(path, 0o660)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self.stop)
+        print(f"Control socket listening on {path}")
+
+        remove_legacy_cron_jobs()
+        with db.transaction() as cursor:
+            updater.create_update_runs(cursor)
+        updater.open_indexes = {}
+        updater.applied_cache = {}
+        watch = sqlite3.connect(db.DATABASE, timeout=db.BUSY_TIMEOUT)
+        data_version = None
+        self.reschedule()
+        # Puts the rules back after a reboot; a no-op when they are already in place
+        self.jobs.submit(HOT_APPLY)
+        try:
+            while not self.stopping:
+                version = watch.execute('PRAGMA data_version').fetchone()[0]
+                if version != data_version:
+                    data_version = version
+                    self.check_config()
+                if (schedule_enabled() or self.failures) and self.next_run is not None and time.time() >= self.next_run and not self.jobs.running:
+                    self.next_run = None
+                    self.jobs.submit(FULL_UPDATE)
+                if self.next_verify is not None and time.time() >= self.next_verify and not self.jobs.running:
+                    self.next_verify = None
+                    self.jobs.submit(VERIFY)
+                self.wake.wait(WATCH_INTERVAL)
+                self.wake.clear()
+        finally:
+            server.shutdown()
+            server.server_close()
+            os.remove(path)
+            watch.close()
+
+    def stop(self, signum=None, frame=None):
+        self.stopping = True
+        self.wake.set()
+
+
+def control(command, path=CONTROL_SOCKET, **arguments):
+    """Send one request to a running daemon and return its reply; raises OSError when none is listening."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.settimeout(CONTROL_TIMEOUT)
+        s.connect(path)
+        s.sendall(json.dumps({'command': command, **arguments}).encode() + b"\n")
+        with s.makefile('rb') as f:
+            reply = f.readline()
+    if not reply:
+        raise ConnectionError("The daemon closed the connection without a reply")
+    return json.loads(reply)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run geoblock as a resident daemon, or send a command to the running one.")
+    parser.add_argument('--socket', default=CONTROL_SOCKET, help="control socket path")
+    parser.add_argument('--send', metavar='COMMAND', help="send COMMAND (status, submit, job, schedule, rollback) to the running daemon")
+    parser.add_argument('--args', default='{}', help="JSON object of arguments for --send")
+    parser.add_argument('--install', action='store_true', help=f"install and enable {UNIT_PATH} so the daemon starts at boot")
+    args = parser.parse_args()
+    if args.install:
+        install_unit()
+    elif args.send:
+        print(json.dumps(control(args.send, args.socket, **json.loads(args.args)), indent=2))
+    else:
+        Daemon().serve(args.socket)
@@ -0,0 +1,60 @@
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+DATABASE = "app.db"
+BUSY_TIMEOUT = 10.0
+STATEMENT_CACHE_SIZE = 256
+
+_local = threading.local()
+# Connections handed back by finished threads (e.g. Flask requests), reused with their statement caches
+_idle = queue.LifoQueue()
+# Bumped after every committed transaction in this process, so caches can tell the data changed
+write_generation = 0
+
+
+def open_connection():
+    # Pooled connections move between threads, but only one thread uses a connection at a time
+    conn = sqlite3.connect(DATABASE, timeout=BUSY_TIMEOUT, cached_statements=STATEMENT_CACHE_SIZE, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute(f'PRAGMA busy_timeout={int(BUSY_TIMEOUT * 1000)}')
+    return conn
+
+
+def get_connection():
+    """Return this thread's connection to app.db: an idle pooled one, or a new one in WAL mode."""
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        try:
+            conn = _idle.get_nowait()
+        except queue.Empty:
+            conn = open_connection()
+        _local.conn = conn
+    return conn
+
+
+def query(sql, params=()):
+    """Run a read-only statement and return all rows."""
+    return get_connection().execute(sql, params).fetchall()
+
+
+@contextmanager
+def transaction():
+    """Yield a cursor whose statements are committed together, or rolled back on error."""
+    global write_generation
+    conn = get_connection()
+    with conn:
+        yield conn.cursor()
+    write_generation += 1
+
+
+def release_connection():
+    """Hand this thread's connection back to the pool, for threads that end after one task like Flask requests."""
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        _local.conn = None
+        if conn.in_transaction:
+            conn.rollback()
+        _idle.put(conn)
@@ -0,0 +1,225 @@
+import os
+import io
+import gzip
+import hmac
+import json
+import hashlib
+import argparse
+import threading
+import requests
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import updater
+from updater import FAMILIES, check_internet_access, get_source, get_selection_mode, compile_blocked, load_state_meta, get_from_db, get_setting
+from db import transaction
+
+ARTIFACT_PATH = os.path.join(updater.ZONE_DIR, "artifact.json.gz")
+AGENTS_SCHEMA = 'CREATE TABLE IF NOT EXISTS agents (id INTEGER PRIMARY KEY, url TEXT UNIQUE, token TEXT)'
+AGENT_LISTEN_DEFAULT = "127.0.0.1:8701"
+PUSH_WORKERS = 16
+PUSH_TIMEOUT = 300
+TOKEN_HEADER = 'X-Geoblock-Token'
+VERSION_HEADER = 'X-Geoblock-Version'
+SHA256_HEADER = 'X-Geoblock-Sha256'
+
+
+def encode_artifact(payload):
+    """Serialize an artifact payload reproducibly, so identical content gives an identical checksum."""
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb', mtime=0) as f:
+        f.write(json.dumps(payload, sort_keys=True).encode())
+    body = buffer.getvalue()
+    return body, hashlib.sha256(body).hexdigest()
+
+
+def decode_artifact(body, sha256):
+    """Verify the body's checksum and return the artifact payload."""
+    if hashlib.sha256(body).hexdigest() != sha256:
+        raise ValueError("Artifact checksum mismatch")
+    payload = json.loads(gzip.decompress(body))
+    payload['sha256'] = sha256
+    return payload
+
+
+def load_artifact(path=ARTIFACT_PATH):
+    try:
+        with open(path, 'rb') as f:
+            body = f.read()
+    except OSError:
+        return None, None
+    return json.loads(gzip.decompress(body)), body
+
+
+#### CONTROLLER ####
+
+def build_artifact(engine='auto', path=ARTIFACT_PATH):
+    """Fetch the configured data source and compile the block lists once.
+
+    The version is bumped only when the content changed. Returns (payload, body, sha256)."""
+    check_internet_access()
+    countries = sorted(row[0] for row in get_from_db('SELECT code FROM countries WHERE picked == True'))
+    mode = get_selection_mode()
+    print(f"Countries: {countries} ({mode})")
+    data_source = get_source()
+    data_source.fetch(countries)
+    content = {
+        'countries': countries,
+        'mode': mode,
+        'db_sha256': {family: data_source.version(family, countries) for family in FAMILIES},
+        'cidrs': {family: compile_blocked(data_source, countries, family, engine, mode) for family in FAMILIES},
+    }
+
+    previous, previous_body = load_artifact(path)
+    if previous is not None and all(previous.get(key) == value for key, value in content.items()):
+        print(f"Policy unchanged, keeping artifact version {previous['version']}.")
+        return previous, previous_body, hashlib.sha256(previous_body).hexdigest()
+
+    payload = {**content, 'version': (previous or {}).get('version', 0) + 1, 'created': datetime.now().isoformat()}
+    body, sha256 = encode_artifact(payload)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", 'wb') as f:
+        f.write(body)
+    os.replace(path + ".tmp", path)
+    print(f"Built artifact version {payload['version']} ({len(body)} bytes, sha256 {sha256}).")
+    return payload, body, sha256
+
+
+def get_agents():
+    with transaction() as cursor:
+        cursor.execute(AGENTS_SCHEMA)
+        cursor.execute('SELECT url, token FROM agents ORDER BY id')
+        return cursor.fetchall()
+
+
+def register_agent(url, token):
+    with transaction() as cursor:
+        cursor.execute(AGENTS_SCHEMA)
+        cursor.execute('INSERT OR REPLACE INTO agents (url, token) VALUES (?, ?)', (url.rstrip('/'), token))
+
+
+def unregister_agent(url):
+    with transaction() as cursor:
+        cursor.execute(AGENTS_SCHEMA)
+        cursor.execute('DELETE FROM agents WHERE url = ?', (url.rstrip('/'),))
+
+
+def push_to_agent(url, token, version, body, sha256):
+    headers = {TOKEN_HEADER: token, VERSION_HEADER: str(version), SHA256_HEADER: sha256, 'Content-Type': 'application/gzip'}
+    try:
+        response = requests.post(f"{url}/artifact", data=body, headers=headers, timeout=PUSH_TIMEOUT)
+        result = response.json()
+        result['ok'] = response.ok
+    except (requests.RequestException, ValueError) as e:
+        result = {'ok': False, 'status': 'error', 'error': str(e)}
+    result['url'] = url
+    return result
+
+
+def push(version, body, sha256, agents=None):
+    """Push the artifact to every registered agent in parallel; returns one result per agent."""
+    agents = get_agents() if agents is None else agents
+    if not agents:
+        print("No agents registered.")
+        return []
+    with ThreadPoolExecutor(max_workers=min(PUSH_WORKERS, len(agents))) as executor:
+        results = list(executor.map(lambda agent: push_to_agent(*agent, version, body, sha256), agents))
+    for result in results:
+        print(f"{result['url']}: {result['status']}" + (f" ({result['error']})" if result.get('error') else ""))
+    failed = sum(1 for result in results if not result['ok'])
+    print(f"Pushed artifact version {version} to {len(results) - failed}/{len(results)} agents.")
+    return results
+
+
+#### AGENT ####
+
+class AgentHandler(BaseHTTPRequestHandler):
+    """Accepts artifacts on POST /artifact and reports the applied one on GET /status."""
+
+    token = None
+    apply_lock = threading.Lock()
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def authorized(self):
+        return hmac.compare_digest(self.headers.get(TOKEN_HEADER, ''), self.token)
+
+    def do_GET(self):
+        if self.path != '/status':
+            return self.send_json(404, {'status': 'error', 'error': "Not found"})
+        if not self.authorized():
+            return self.send_json(403, {'status': 'error', 'error': "Bad token"})
+        self.send_json(200, {'status': 'ok', 'artifact': load_state_meta().get('artifact')})
+
+    def do_POST(self):
+        if self.path != '/artifact':
+            return self.send_json(404, {'status': 'error', 'error': "Not found"})
+        if not self.authorized():
+            return self.send_json(403, {'status': 'error', 'error': "Bad token"})
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            artifact = decode_artifact(body, self.headers.get(SHA256_HEADER, ''))
+            if str(artifact['version']) != self.headers.get(VERSION_HEADER):
+                raise ValueError("Artifact version does not match its header")
+        except (ValueError, OSError, KeyError) as e:
+            return self.send_json(400, {'status': 'error', 'error': str(e)})
+
+        with self.apply_lock:
+            applied = load_state_meta().get('artifact') or {}
+            if applied.get('sha256') == artifact['sha256']:
+                return self.send_json(200, {'status': 'unchanged', 'version': artifact['version']})
+            if applied.get('version', 0) > artifact['version']:
+                return self.send_json(409, {'status': 'stale', 'error': f"Version {applied['version']} is already applied", 'version': applied['version']})
+            try:
+                updater.update(artifact=artifact)
+            except Exception as e:
+                return self.send_json(500, {'status': 'error', 'error': f"{type(e).__name__}: {e}"})
+        entries = sum(len(cidrs) for cidrs in artifact['cidrs'].values())
+        self.send_json(200, {'status': 'applied', 'version': artifact['version'], 'entries': entries})
+
+
+def serve_agent(listen, token):
+    host, port = listen.rsplit(':', 1)
+    AgentHandler.token = token
+    server = ThreadingHTTPServer((host, int(port)), AgentHandler)
+    print(f"Agent listening on {host}:{server.server_address[1]}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compile the block lists once on a controller and push them to agents.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    push_parser = commands.add_parser('push', help="build the artifact and push it to all registered agents")
+    push_parser.add_argument('--engine', choices=['auto', 'python', 'numpy'], default='auto')
+    register_parser = commands.add_parser('register', help="register an agent")
+    register_parser.add_argument('url', help="agent base URL, e.g. http://10.0.0.5:8701")
+    register_parser.add_argument('--token', required=True, help="the agent's shared token")
+    unregister_parser = commands.add_parser('unregister', help="remove an agent")
+    unregister_parser.add_argument('url')
+    commands.add_parser('agents', help="list registered agents")
+    agent_parser = commands.add_parser('agent', help="run an agent that applies pushed artifacts")
+    agent_parser.add_argument('--listen', default=AGENT_LISTEN_DEFAULT, help="HOST:PORT to listen on")
+    agent_parser.add_argument('--token', help="shared token; defaults to the agent_token setting")
+    args = parser.parse_args()
+
+    if args.command == 'push':
+        payload, body, sha256 = build_artifact(args.engine)
+        results = push(payload['version'], body, sha256)
+        raise SystemExit(0 if all(result['ok'] for result in results) else 1)
+    elif args.command == 'register':
+        register_agent(args.url, args.token)
+    elif args.command == 'unregister':
+        unregister_agent(args.url)
+    elif args.command == 'agents':
+        print("\n".join(url for url, _ in get_agents()))
+    else:
+        token = args.token or get_setting('agent_token')
+        if not token:
+            parser.error("an agent token is required (--token or the agent_token setting)")
+        serve_agent(args.listen, token)
@@ -0,0 +1,583 @@
+import socket
+import hashlib
+import subprocess
+import tempfile
+import ipaddress
+from itertools import chain
+from collections import Counter
+
+IPSET_NAME = "GEO_BLOCK"
+IPSET6_NAME = "GEO_BLOCK6"
+ALLOW_IPSET_NAME = "GEO_ALLOW"
+ALLOW_IPSET6_NAME = "GEO_ALLOW6"
+IPSET_TMP_SUFFIX = "_TMP"
+IPSET_MIGRATE_SUFFIX = "_NEW"
+LIST_SET_SIZE = 256
+IPSET_MIN_HASHSIZE = 1024
+IPSET_MIN_MAXELEM = 65536
+IPTABLES_CHAIN = "GEOBLOCK"
+# Where blocked sources are dropped: filter INPUT, raw PREROUTING (before conntrack) or nftables ingress on given interfaces
+ENFORCEMENT_POINTS = ['input', 'raw', 'ingress']
+DEFAULT_ENFORCEMENT_POINT = "input"
+IPTABLES_HOOKS = {'input': ('filter', 'INPUT'), 'raw': ('raw', 'PREROUTING')}
+NFT_INGRESS_PRIORITY = -500
+MULTIPORT_MAX_PORTS = 15
+NFT_TABLE = "geoblock"
+NFT_SETS = {'inet': ('block4', 'allow4', 'ip', 'ipv4_addr'), 'inet6': ('block6', 'allow6', 'ip6', 'ipv6_addr')}
+SET_NAMES = {
+    'inet': {'set': IPSET_NAME, 'allow': ALLOW_IPSET_NAME, 'iptables': 'iptables'},
+    'inet6': {'set': IPSET6_NAME, 'allow': ALLOW_IPSET6_NAME, 'iptables': 'ip6tables'},
+}
+
+
+def run_command(args, input_lines=None, check=True):
+    """Run `args` through sudo and return the CompletedProcess.
+
+    When `input_lines` is given it is streamed to the command's stdin line by line,
+    so large restore scripts are never built in memory."""
+    if input_lines is None:
+        return subprocess.run(['sudo', *args], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, check=check)
+
+    with tempfile.TemporaryFile(mode='w+') as stderr:
+        with subprocess.Popen(['sudo', *args], stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=stderr, text=True) as proc:
+            try:
+                for line in input_lines:
+                    proc.stdin.write(line)
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+        stderr.seek(0)
+        error = stderr.read()
+    if check and proc.returncode != 0:
+        print(error, end='')
+        raise subprocess.CalledProcessError(proc.returncode, proc.args, stderr=error)
+    return subprocess.CompletedProcess(proc.args, proc.returncode, '', error)
+
+
+def family_of(cidr):
+    return 'inet6' if ':' in cidr else 'inet'
+
+
+def split_by_family(entries):
+    by_family = {family: [] for family in SET_NAMES}
+    for entry in entries:
+        by_family[family_of(entry)].append(entry)
+    return by_family
+
+
+def group_port_rules(port_rules):
+    """Return {protocol: sorted unique ports} from (port_number, protocol) rows, skipping invalid ones."""
+    ports_by_protocol = {}
+    for port_number, protocol in port_rules:
+        try:
+            port = int(port_number)
+        except (TypeError, ValueError):
+            port = 0
+        if not 0 < port < 65536 or protocol not in ('tcp', 'udp'):
+            print(f"Skipping invalid port rule: {port_number}/{protocol}")
+            continue
+        ports_by_protocol.setdefault(protocol, set()).add(port)
+    return {protocol: sorted(ports) for protocol, ports in sorted(ports_by_protocol.items())}
+
+
+def ipset_sizing(count):
+    """Return (hashsize, maxelem) for a hash:net set holding `count` entries."""
+    hashsize = IPSET_MIN_HASHSIZE
+    while hashsize < count:
+        hashsize *= 2
+    maxelem = max(IPSET_MIN_MAXELEM, hashsize * 2)
+    return hashsize, maxelem
+
+
+def country_set_name(name, code):
+    """Name of the per-country member set of block set `name`, e.g. GEO_BLOCK_CN."""
+    return f"{name}_{code}"
+
+
+def create_set_line(name, family, entries, list_set=False):
+    """Return the `ipset restore` create line for `name`.
+
+    A list:set keeps packet/byte counters per member set; a hash:net set is sized for `entries`."""
+    if list_set:
+        return f"create {name} list:set size {max(LIST_SET_SIZE, len(entries))} counters\n"
+    hashsize, maxelem = ipset_sizing(len(entries))
+    return f"create {name} hash:net family {family} hashsize {hashsize} maxelem {maxelem}\n"
+
+
+def canonical_entry(entry):
+    """Return a set entry as `ipset save` prints it: host entries without a prefix length, IPv6 in inet_ntop form.
+
+    Member names of a list:set pass through unchanged."""
+    address, _, prefixlen = entry.partition('/')
+    if ':' in address:
+        address, full = socket.inet_ntop(socket.AF_INET6, socket.inet_pton(socket.AF_INET6, address)), '128'
+    else:
+        full = '32'
+    return address if prefixlen in ('', full) else f"{address}/{prefixlen}"
+
+
+def entries_digest(entries):
+    """Order-independent sha256 of canonical set entries."""
+    return hashlib.sha256('\n'.join(sorted(entries)).encode()).hexdigest()
+
+
+def managed_set_family(name):
+    """Return the family of a geoblock block, allow or per-country set, or None for other sets."""
+    for family, names in SET_NAMES.items():
+        if name in (names['set'], names['allow']) or (name.startswith(country_set_name(names['set'], ''))
+                                                     and not name.endswith((IPSET_TMP_SUFFIX, IPSET_MIGRATE_SUFFIX))):
+            return family
+    return None
+
+
+def build_chain_rules(name, port_rules, allow_name=ALLOW_IPSET_NAME, local_only=False):
+    """Return the GEOBLOCK chain rules: the whitelist ACCEPT first, then one multiport rule per
+    protocol (at most MULTIPORT_MAX_PORTS ports each), or a single all-ports rule when no ports are configured.
+
+    `local_only` limits the DROP rules to packets for this host, as INPUT does, when the chain
+    is hooked into PREROUTING."""
+    rules = [f"-A {IPTABLES_CHAIN} -m set --match-set {allow_name} src -j ACCEPT"]
+    local = " -m addrtype --dst-type LOCAL" if local_only else ""
+    ports_by_protocol = group_port_rules(port_rules)
+    if not ports_by_protocol:
+        rules.append(f"-A {IPTABLES_CHAIN}{local} -m set --match-set {name} src -j DROP")
+        return rules
+    for protocol, ports in ports_by_protocol.items():
+        for i in range(0, len(ports), MULTIPORT_MAX_PORTS):
+            dports = ','.join(str(port) for port in ports[i:i + MULTIPORT_MAX_PORTS])
+            rules.append(f"-A {IPTABLES_CHAIN}{local} -p {protocol} -m multiport --dports {dports} -m set --match-set {name} src -j DROP")
+    return rules
+
+
+class IptablesBackend:
+    """iptables + ipset: hash:net sets loaded with `ipset restore`, matched from the GEOBLOCK chain.
+
+    The chain hangs off filter INPUT, or off raw PREROUTING so that blocked packets never create
+    conntrack entries."""
+
+    name = 'iptables'
+
+    def __init__(self, runner=run_command, enforcement=DEFAULT_ENFORCEMENT_POINT, interfaces=()):
+        self.run = runner
+        self.enforcement = enforcement
+        self.interfaces = list(interfaces)
+
+    def save(self):
+        return {'iptables': self.run(['iptables-save']).stdout, 'ipset': self.run(['ipset', 'save']).stdout}
+
+    def set_exists(self, name):
+        return self.run(['ipset', 'list', '-n', name], check=False).returncode == 0
+
+    def setup_set(self, name, family='inet'):
+        """Create the set if it is missing. Returns True when a new, empty set was created."""
+        if not self.set_exists(name):
+            print(f"Creating new ipset set {name}...")
+            self.run(['ipset', 'create', name, 'hash:net', 'family', family])
+            return True
+        return False
+
+    def load_set(self, name, entries, family='inet'):
+        """Build `name` in a temporary set with a single streamed `ipset restore`,
+        then swap it in so the live set is never empty. Returns the new maxelem."""
+        tmp_name = f"{name}{IPSET_TMP_SUFFIX}"
+        hashsize, maxelem = ipset_sizing(len(entries))
+
+        self.run(['ipset', 'destroy', tmp_name], check=False)
+        print(f"Loading {len(entries)} entries into {tmp_name} (hashsize {hashsize}, maxelem {maxelem})...")
+        lines = [create_set_line(tmp_name, family, entries)]
+        try:
+            self.run(['ipset', 'restore'], input_lines=chain(lines, (f"add {tmp_name} {entry}\n" for entry in entries)))
+        except subprocess.CalledProcessError:
+            self.run(['ipset', 'destroy', tmp_name], check=False)
+            raise
+
+        self.run(['ipset', 'swap', tmp_name, name])
+        self.run(['ipset', 'destroy', tmp_name])
+        print(f"Swapped {tmp_name} into {name}.")
+        return maxelem
+
+    def apply_set_delta(self, name, to_add, to_del):
+        """Apply an add/del delta to `name` in place with a single `ipset restore`."""
+        print(f"Applying delta to {name}: +{len(to_add)} -{len(to_del)}")
+        self.run(['ipset', '-exist', 'restore'], input_lines=chain(
+            (f"del {name} {entry}\n" for entry in to_del),
+            (f"add {name} {entry}\n" for entry in to_add)))
+
+    def set_type(self, name):
+        """Return the type of set `name` (e.g. 'hash:net' or 'list:set'), or None if it does not exist."""
+        result = self.run(['ipset', 'list', '-t', name], check=False)
+        if result.returncode != 0:
+            return None
+        for line in result.stdout.splitlines():
+            if line.startswith('Type:'):
+                return line.split(':', 1)[1].strip()
+        return None
+
+    def convert_set(self, name, family, port_rules, entries, list_set=False):
+        """Recreate `name` as a hash:net set of `entries`, or a list:set of the member sets in `entries`.
+
+        ipset cannot swap sets of different types or destroy a set the chain still matches, so the chain
+        is pointed at a filled copy while `name` is rebuilt, and traffic stays filtered throughout."""
+        tmp_name = f"{name}{IPSET_MIGRATE_SUFFIX}"
+        print(f"Rebuilding {name} as {'list:set' if list_set else 'hash:net'} with {len(entries)} entries...")
+        for target in (tmp_name, name):
+            self.run(['ipset', 'destroy', target], check=False)
+            self.run(['ipset', 'restore'], input_lines=chain(
+                [create_set_line(target, family, entries, list_set)],
+                (f"add {target} {entry}\n" for entry in entries)))
+            self.setup_rules(family, port_rules, target)
+        self.run(['ipset', 'destroy', tmp_name])
+
+    def list_members(self, name):
+        """Return {member: (packets, bytes)} of list:set `name` from a single `ipset list`."""
+        result = self.run(['ipset', 'list', name], check=False)
+        members = {}
+        if result.returncode != 0:
+            return members
+        lines = iter(result.stdout.splitlines())
+        for line in lines:
+            if line.startswith('Members:'):
+                break
+        for line in lines:
+            parts = line.split()
+            if not parts:
+                continue
+            counters = dict(zip(parts[1::2], parts[2::2]))
+            members[parts[0]] = (int(counters.get('packets', 0)), int(counters.get('bytes', 0)))
+        return members
+
+    def sync_members(self, name, members):
+        """Make list:set `name` hold exactly `members` with one `ipset restore`; kept members keep their counters.
+
+        Returns the members that were removed."""
+        current = self.list_members(name)
+        to_add = [member for member in members if member not in current]
+        to_del = sorted(set(current) - set(members))
+        if to_add or to_del:
+            self.apply_set_delta(name, to_add, to_del)
+        return to_del
+
+    def destroy_set(self, name):
+        self.run(['ipset', 'destroy', name], check=False)
+
+    def read_sets(self):
+        """Return {set name: (type, canonical entries)} of the geoblock sets from a single `ipset save`."""
+        sets = {}
+        for line in self.run(['ipset', 'save']).stdout.splitlines():
+            parts = line.split()
+            if len(parts) < 3 or managed_set_family(parts[1]) is None:
+                continue
+            if parts[0] == 'create':
+                sets[parts[1]] = (parts[2], [])
+            elif parts[0] == 'add' and parts[1] in sets:
+                sets[parts[1]][1].append(parts[2])
+        return sets
+
+    def read_rules(self):
+        """Return {family: (position of the GEOBLOCK jump in the enforcement hook or None, GEOBLOCK rules)},
+        from one iptables-save/ip6tables-save per family."""
+        table, hook = IPTABLES_HOOKS.get(self.enforcement, IPTABLES_HOOKS[DEFAULT_ENFORCEMENT_POINT])
+        rules = {}
+        for family, names in SET_NAMES.items():
+            position, chain_rules, current, count = None, [], None, 0
+            for line in self.run([f"{names['iptables']}-save"]).stdout.splitlines():
+                if line.startswith('*'):
+                    current = line[1:].strip()
+                    continue
+                parts = line.split()
+                if current != table or parts[:1] != ['-A']:
+                    continue
+                if parts[1] == IPTABLES_CHAIN:
+                    chain_rules.append(line)
+                elif parts[1] == hook:
+                    count += 1
+                    if parts[2:] == ['-j', IPTABLES_CHAIN] and position is None:
+                        position = count
+            rules[family] = (position, chain_rules)
+        return rules
+
+    def repair_set(self, name, family, entries, live=None, list_set=False):
+        """Bring set `name` back to `entries`: recreate it when it is missing (`live` is None),
+        otherwise add and delete only the entries that differ from the canonical `live` ones."""
+        if live is None:
+            print(f"Recreating missing set {name} with {len(entries)} entries...")
+            self.run(['ipset', 'restore'], input_lines=chain([create_set_line(name, family, entries, list_set)],
+                                                             (f"add {name} {entry}\n" for entry in entries)))
+            return len(entries)
+        live = set(live)
+        wanted = {canonical_entry(entry): entry for entry in entries}
+        to_add = [entry for key, entry in wanted.items() if key not in live]
+        to_del = sorted(live - set(wanted))
+        if to_add or to_del:
+            self.apply_set_delta(name, to_add, to_del)
+        return len(to_add) + len(to_del)
+
+    def repair_rules(self, family, port_rules, position):
+        """Rewrite the GEOBLOCK chain and move its jump back to the top of the hook when other rules
+        were inserted before it (`position` is the jump's current position)."""
+        self.setup_rules(family, port_rules)
+        if position is not None and position > 1:
+            command = SET_NAMES[family]['iptables']
+            table, hook = IPTABLES_HOOKS[self.enforcement]
+            print(f"Moving the {command} {IPTABLES_CHAIN} jump from position {position} back to the top of {hook}.")
+            self.run([command, '-t', table, '-I', hook, '1', '-j', IPTABLES_CHAIN])
+            self.run([command, '-t', table, '-D', hook, str(position + 1)])
+
+    def setup_rules(self, family, port_rules, name=None):
+        """Replace the GEOBLOCK chain in one `iptables-restore --noflush` and make sure the enforcement
+        point's hook (INPUT or raw PREROUTING) jumps to it.
+
+        The DROP rules match the family's block set, or set `name` when given."""
+        if self.enforcement not in IPTABLES_HOOKS:
+            raise ValueError(f"The {self.name} backend cannot enforce at {self.enforcement}, use {' or '.join(IPTABLES_HOOKS)}")
+        names = SET_NAMES[family]
+        command, name = names['iptables'], name or names['set']
+        table, hook = IPTABLES_HOOKS[self.enforcement]
+        rules = build_chain_rules(name, port_rules, names['allow'], local_only=hook != 'INPUT')
+        print(f"Installing {len(rules)} {command} rule(s) in {table} {IPTABLES_CHAIN}...")
+        self.run([f"{command}-restore", '--noflush'], input_lines=[f"{line}\n" for line in [f"*{table}", f":{IPTABLES_CHAIN} - [0:0]", *rules, 'COMMIT']])
+
+        if self.run([command, '-t', table, '-C', hook, '-j', IPTABLES_CHAIN], check=False).returncode != 0:
+            self.run([command, '-t', table, '-I', hook, '1', '-j', IPTABLES_CHAIN])
+
+        # After a move of the enforcement point, the old hook is removed only now that the new one is in place
+        for other_table, other_hook in IPTABLES_HOOKS.values():
+            if other_table != table and self.run([command, '-t', other_table, '-n', '-L', IPTABLES_CHAIN], check=False).returncode == 0:
+                print(f"Removing {command} {IPTABLES_CHAIN} chain from {other_table} {other_hook}.")
+                self.remove_chain(command, other_table, other_hook)
+
+        # Older versions dropped GEO_BLOCK sources on all ports straight from INPUT
+        legacy_rule = ['INPUT', '-m', 'set', '--match-set', name, 'src', '-j', 'DROP']
+        while self.run([command, '-D', *legacy_rule], check=False).returncode == 0:
+            print(f"Removed legacy {command} rule for {name}.")
+
+    def read_set(self, name):
+        """Return the entries of set `name` from one `ipset save`, or None when it does not exist."""
+        result = self.run(['ipset', 'save', name], check=False)
+        if result.returncode != 0:
+            return None
+        return saved_set_entries(result.stdout.splitlines(), name)
+
+    def sync_whitelist(self, whitelist_ips):
+        """Replace the contents of GEO_ALLOW/GEO_ALLOW6 with the whitelist via temp set + swap.
+
+        A set that already holds exactly the whitelist is left alone."""
+        for family, entries in split_by_family(sorted(set(whitelist_ips))).items():
+            name = SET_NAMES[family]['allow']
+            current = self.read_set(name)
+            if current is not None and set(current) == {canonical_entry(str(ipaddress.ip_network(entry, strict=False))) for entry in entries}:
+                continue
+            self.setup_set(name, family)
+            self.load_set(name, entries, family)
+
+    def remove_legacy_whitelist_rules(self, whitelist_ips):
+        """Delete per-IP INPUT ACCEPT rules left behind by older versions, found with one iptables-save.
+
+        Older versions inserted one rule per whitelist entry on every run and never removed them,
+        so a source with several identical rules is theirs even after its entry left the whitelist.
+        A single rule for a source outside the whitelist may be the admin's own and is only reported."""
+        wanted = {str(ipaddress.ip_network(ip, strict=False)) for ip in whitelist_ips if ':' not in ip}
+        saved = self.run(['iptables-save', '-t', 'filter']).stdout
+        sources = Counter(parts[3] for parts in map(str.split, saved.splitlines())
+                          if len(parts) == 6 and parts[:3] == ['-A', 'INPUT', '-s'] and parts[4:] == ['-j', 'ACCEPT'])
+        for source, count in sorted(sources.items()):
+            if source not in wanted and count == 1:
+                print(f"Keeping INPUT ACCEPT rule for {source}, which is not whitelisted; remove it by hand if an older version added it.")
+                continue
+            print(f"Removing {count} legacy whitelist rule(s) for {source}")
+            for _ in range(count):
+                self.run(['iptables', '-D', 'INPUT', '-s', source, '-j', 'ACCEPT'])
+
+    def restore_snapshot(self, dumps, port_rules=()):
+        """Reload the block sets saved in a snapshot's `ipset save` dump, each with one restore + swap.
+
+        A set whose layout changed since the snapshot (merged or per_country) is rebuilt in the
+        snapshot's layout with convert_set(), which repoints the rules for `port_rules`.
+        Returns {set name: entries} for the restored sets."""
+        saved = dumps['ipset'].splitlines()
+        restored = {}
+        for family, names in SET_NAMES.items():
+            name = names['set']
+            create = next((line for line in saved if line.startswith(f"create {name} ")), None)
+            if create is None:
+                continue
+            saved_list = create.split()[2] == 'list:set'
+            current_list = self.set_type(name) == 'list:set'
+            if saved_list != current_list:
+                print(f"{name} has a different set layout than in the snapshot, rebuilding it as in the snapshot.")
+            if saved_list:
+                # Per-country layout: reload each member set, then the membership
+                members = saved_set_entries(saved, name)
+                for member in members:
+                    entries = saved_set_entries(saved, member)
+                    self.setup_set(member, family)
+                    self.load_set(member, entries, family)
+                    restored[member] = entries
+                if current_list:
+                    for member in self.sync_members(name, members):
+                        self.destroy_set(member)
+                else:
+                    self.convert_set(name, family, port_rules, members, list_set=True)
+            else:
+                entries = saved_set_entries(saved, name)
+                if current_list:
+                    stale = list(self.list_members(name))
+                    self.convert_set(name, family, port_rules, entries)
+                    for member in stale:
+                        self.destroy_set(member)
+                else:
+                    self.setup_set(name, family)
+                    self.load_set(name, entries, family)
+                restored[name] = entries
+        return restored
+
+    def remove_chain(self, command, table, hook):
+        while self.run([command, '-t', table, '-D', hook, '-j', IPTABLES_CHAIN], check=False).returncode == 0:
+            pass
+        self.run([command, '-t', table, '-F', IPTABLES_CHAIN], check=False)
+        self.run([command, '-t', table, '-X', IPTABLES_CHAIN], check=False)
+
+    def teardown(self):
+        """Remove the GEOBLOCK chains and all geoblock sets."""
+        for names in SET_NAMES.values():
+            for table, hook in IPTABLES_HOOKS.values():
+                self.remove_chain(names['iptables'], table, hook)
+            for name in (names['set'], names['allow']):
+                self.run(['ipset', 'destroy', name], check=False)
+        # Per-country member sets are only referenced by the list:set destroyed above
+        for name in self.run(['ipset', 'list', '-n'], check=False).stdout.split():
+            if any(name.startswith(f"{names['set']}_") for names in SET_NAMES.values()):
+                self.run(['ipset', 'destroy', name], check=False)
+
+
+class NftablesBackend:
+    """nftables: interval sets loaded with native start-end ranges, applied as one `nft -f` transaction.
+
+    The drop rules run in an input chain, a prerouting chain at raw priority (before conntrack),
+    or in ingress chains on the configured interfaces (inet ingress, Linux 5.10 and later)."""
+
+    name = 'nftables'
+
+    def __init__(self, runner=run_command, enforcement=DEFAULT_ENFORCEMENT_POINT, interfaces=()):
+        self.run = runner
+        self.enforcement = enforcement
+        self.interfaces = list(interfaces)
+
+    def save(self):
+        return {'nftables': self.run(['nft', 'list', 'ruleset']).stdout}
+
+    def table_exists(self):
+        return self.run(['nft', 'list', 'table', 'inet', NFT_TABLE], check=False).returncode == 0
+
+    def read_table(self):
+        """Return the lines of the live geoblock table, or None when it does not exist."""
+        result = self.run(['nft', 'list', 'table', 'inet', NFT_TABLE], check=False)
+        return result.stdout.splitlines() if result.returncode == 0 else None
+
+    def hook_chains(self):
+        """Return (chain name, hook spec, drop rule prefix) for each base chain of the enforcement point."""
+        if self.enforcement == 'input':
+            return [('input', 'input priority -1', '')]
+        if self.enforcement == 'raw':
+            return [('prerouting', 'prerouting priority raw', 'fib daddr type local ')]
+        if self.enforcement == 'ingress' and self.interfaces:
+            return [(f"ingress{number}", f'ingress device "{interface}" priority {NFT_INGRESS_PRIORITY}', '')
+                    for number, interface in enumerate(self.interfaces)]
+        if self.enforcement == 'ingress':
+            raise ValueError("Ingress enforcement needs at least one interface")
+        raise ValueError(f"Unknown enforcement point: {self.enforcement}")
+
+    def build_ruleset(self, blocked, whitelist_ips, port_rules):
+        """Yield an nft script that atomically replaces the geoblock table.
+
+        `blocked` maps family to merged (start, end) integer ranges."""
+        allowed = split_by_family(sorted(set(whitelist_ips)))
+        yield f"table inet {NFT_TABLE}\n"
+        yield f"delete table inet {NFT_TABLE}\n"
+        yield f"table inet {NFT_TABLE} {{\n"
+        for family, (block_set, allow_set, _, addr_type) in NFT_SETS.items():
+            yield from _nft_set(block_set, addr_type, (format_range(start, end, family) for start, end in blocked.get(family, ())))
+            yield from _nft_set(allow_set, addr_type, allowed[family])
+
+        ports_by_protocol = group_port_rules(port_rules)
+        for chain_name, hook, prefix in self.hook_chains():
+            yield f"    chain {chain_name} {{\n"
+            yield f"        type filter hook {hook}; policy accept;\n"
+            for family, (_, allow_set, match, _) in NFT_SETS.items():
+                yield f"        {match} saddr @{allow_set} accept\n"
+            for family, (block_set, _, match, _) in NFT_SETS.items():
+                if not ports_by_protocol:
+                    yield f"        {prefix}{match} saddr @{block_set} drop\n"
+                for protocol, ports in ports_by_protocol.items():
+                    yield f"        {prefix}{protocol} dport {{ {', '.join(str(port) for port in ports)} }} {match} saddr @{block_set} drop\n"
+            yield "    }\n"
+        yield "}\n"
+
+    def apply(self, blocked, whitelist_ips, port_rules):
+        print(f"Applying nftables table inet {NFT_TABLE} in one transaction...")
+        self.run(['nft', '-f', '-'], input_lines=self.build_ruleset(blocked, whitelist_ips, port_rules))
+
+    def sync_whitelist(self, whitelist_ips):
+        """Replace the allow sets' contents in one transaction; a no-op until the table exists."""
+        if not self.table_exists():
+            return
+        lines = []
+        for family, entries in split_by_family(sorted(set(whitelist_ips))).items():
+            allow_set = NFT_SETS[family][1]
+            lines.append(f"flush set inet {NFT_TABLE} {allow_set}\n")
+            if entries:
+                lines.append(f"add element inet {NFT_TABLE} {allow_set} {{ {', '.join(entries)} }}\n")
+        self.run(['nft', '-f', '-'], input_lines=lines)
+
+    def restore_snapshot(self, dumps, port_rules=()):
+        """Replace the geoblock table with the copy saved in a snapshot's `nft list ruleset` dump, in one transaction.
+
+        The table carries its own rules, so `port_rules` is not needed."""
+        lines = dumps['nftables'].splitlines()
+        header = f"table inet {NFT_TABLE} {{"
+        if header not in lines:
+            print(f"Snapshot has no table inet {NFT_TABLE}, removing it.")
+            self.teardown()
+            return {}
+        start = lines.index(header)
+        end = lines.index('}', start)
+        print(f"Restoring nftables table inet {NFT_TABLE} in one transaction...")
+        self.run(['nft', '-f', '-'], input_lines=chain(
+            [f"table inet {NFT_TABLE}\n", f"delete table inet {NFT_TABLE}\n"],
+            (f"{line}\n" for line in lines[start:end + 1])))
+        return {}
+
+    def teardown(self):
+        if self.table_exists():
+            self.run(['nft', 'delete', 'table', 'inet', NFT_TABLE])
+
+
+def saved_set_entries(saved, name):
+    """Return the entries of set `name` from the lines of an `ipset save` dump."""
+    prefix = f"add {name} "
+    return [line[len(prefix):].split()[0] for line in saved if line.startswith(prefix)]
+
+
+BACKENDS = {backend.name: backend for backend in (IptablesBackend, NftablesBackend)}
+
+
+def format_range(start, end, family='inet'):
+    address = ipaddress.IPv4Address if family == 'inet' else ipaddress.IPv6Address
+    if start == end:
+        return str(address(start))
+    return f"{address(start)}-{address(end)}"
+
+
+def _nft_set(name, addr_type, elements):
+    yield f"    set {name} {{\n"
+    yield f"        type {addr_type}\n"
+    yield "        flags interval\n"
+    yield "        auto-merge\n"
+    first = True
+    for element in elements:
+        yield f"        elements = {{ {element}" if first else f",\n            {element}"
+        first = False
+    if not first:
+        yield " }\n"
+    yield "    }\n"
+
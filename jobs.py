@@ -0,0 +1,129 @@
+import time
+import threading
+from collections import OrderedDict
+from updater import UpdateRun, update, hot_apply, verify, rollback, apply_whitelist
+
+JOB_HISTORY = 20
+FULL_UPDATE = 'update'
+HOT_APPLY = 'hot-apply'
+VERIFY = 'verify'
+WHITELIST = 'whitelist'
+ROLLBACK = 'rollback'
+# A queued job is upgraded to a later kind in this list, which covers what the earlier ones do
+JOB_KINDS = [VERIFY, WHITELIST, HOT_APPLY, FULL_UPDATE]
+
+
+def run_job(run, kind, **arguments):
+    """Run one job of `kind` with `run` collecting its progress; returns the job's result."""
+    if kind == FULL_UPDATE:
+        return update(run=run)
+    if kind == HOT_APPLY:
+        return hot_apply(run=run)
+    if kind == WHITELIST:
+        # Nothing applied yet to sync the allow sets of
+        return apply_whitelist() or hot_apply(run=run)
+    if kind == ROLLBACK:
+        return rollback(arguments.get('snapshot'))
+    return verify(run=run)
+
+
+class UpdateJob:
+    """One queued or running update and its live progress."""
+
+    def __init__(self, job_id, kind=FULL_UPDATE, arguments=None):
+        self.id = job_id
+        self.kind = kind
+        self.arguments = arguments or {}
+        self.result = None
+        self.state = 'queued'
+        self.requests = 1
+        # Created when the job starts, so a job that waited in the queue does not count its wait
+        self.run = None
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+
+    @property
+    def finished(self):
+        return self.state in ('done', 'failed')
+
+    def progress(self):
+        run = self.run or UpdateRun()
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'state': self.state,
+            'requests': self.requests,
+            'phase': run.current_phase,
+            'rows_parsed': run.rows_scanned,
+            'entries_applied': run.entries_loaded,
+            'bytes_downloaded': run.bytes_downloaded,
+            'result': self.result,
+            'error': self.error,
+        }
+
+
+class JobManager:
+    """Runs `target(run, kind, **arguments)` for at most one job at a time.
+
+    Requests that arrive while a job is running are merged into a single queued job,
+    which starts as soon as the running one finishes. A queued job is upgraded when a
+    more thorough kind is requested (verify < whitelist < hot apply < full update), and a request
+    for a lesser kind joins it. A rollback is never merged: it queues on its own, and
+    requests after it queue behind it."""
+
+    def __init__(self, target):
+        self._target = target
+        self._lock = threading.Lock()
+        self._thread = None
+        self._queue = []
+        self._next_id = 1
+        self.jobs = OrderedDict()
+
+    def submit(self, kind=FULL_UPDATE, **arguments):
+        """Queue an update, or join the one already queued; returns the job."""
+        with self._lock:
+            last = self._queue[-1] if self._queue else None
+            if kind in JOB_KINDS and last is not None and last.kind in JOB_KINDS:
+                last.requests += 1
+                if JOB_KINDS.index(kind) > JOB_KINDS.index(last.kind):
+                    last.kind = kind
+                return last
+            job = UpdateJob(self._next_id, kind, arguments)
+            self._queue.append(job)
+            self._next_id += 1
+            self.jobs[job.id] = job
+            while len(self.jobs) > JOB_HISTORY:
+                self.jobs.popitem(last=False)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._work, daemon=True)
+                self._thread.start()
+            return job
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def latest(self):
+        return next(reversed(self.jobs.values()), None)
+
+    def _work(self):
+        while True:
+            with self._lock:
+                if not self._queue:
+                    self._thread = None
+                    return
+                job = self._queue.pop(0)
+                job.state = 'running'
+                job.run = UpdateRun()
+            try:
+                job.result = self._target(job.run, job.kind, **job.arguments)
+                job.state = 'done'
+            except Exception as e:
+                print(f"Update job {job.id} failed: {e}")
+                job.error = f"{type(e).__name__}: {e}"
+                job.state = 'failed'
+            job.finished_at = time.time()
@@ -0,0 +1,163 @@
+import os
+import sys
+import time
+import bisect
+import argparse
+import ipaddress
+import threading
+from compiler import merge_ranges, cidr_bounds
+from rangeindex import RangeIndex
+from updater import FAMILIES, DEFAULT_DATA_SOURCE, get_from_db, get_setting, get_source, get_selection_mode, reserved_ranges
+
+
+def parse_ips(lines):
+    """Take the first field of each non-empty line, so plain IP lists and access logs both work."""
+    for line in lines:
+        fields = line.split()
+        if fields:
+            yield fields[0]
+
+
+class IntervalSet:
+    """Sorted, merged integer intervals with bisect membership tests."""
+
+    def __init__(self, ranges):
+        merged = merge_ranges(ranges)
+        self.starts = [start for start, _ in merged]
+        self.ends = [end for _, end in merged]
+
+    def __contains__(self, value):
+        position = bisect.bisect_right(self.starts, value) - 1
+        return position >= 0 and value <= self.ends[position]
+
+
+class ZoneCountries:
+    """Country lookups over the cached ipdeny zone files of the picked countries.
+
+    Other countries' zone files are never fetched, so addresses outside the picked
+    countries have no known country."""
+
+    def __init__(self, source, family, codes):
+        bits = FAMILIES[family]['bits']
+        rows = sorted((*cidr_bounds(cidr, bits), code) for code in codes for cidr in source.country_cidrs(family, code))
+        self.starts = [start for start, _, _ in rows]
+        self.ends = [end for _, end, _ in rows]
+        self.codes = [code for _, _, code in rows]
+
+    def lookup(self, value):
+        position = bisect.bisect_right(self.starts, value) - 1
+        return self.codes[position] if position >= 0 and value <= self.ends[position] else None
+
+
+class IpLookup:
+    """Answers country/blocked/whitelisted for IPs from the compiled range indexes,
+    or from the picked countries' zone files when the data source is ipdeny.
+
+    The indexes and zone files are loaded once and reloaded whenever an update replaces them."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._indexes = {}
+        self._zones = {}
+
+    def index(self, family):
+        path = FAMILIES[family]['index']
+        try:
+            version = os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+        with self._lock:
+            loaded = self._indexes.get(family)
+            if loaded is None or loaded[0] != version:
+                try:
+                    loaded = self._indexes[family] = (version, RangeIndex(path))
+                except (OSError, ValueError):
+                    return None
+            return loaded[1]
+
+    def zones(self, family, picked):
+        """Return a ZoneCountries of the picked countries, or None when a zone file was never fetched."""
+        source = get_source('ipdeny')
+        versions = tuple((code, source.country_version(family, code)) for code in sorted(picked))
+        if any(version is None for _, version in versions):
+            return None
+        with self._lock:
+            loaded = self._zones.get(family)
+            if loaded is None or loaded[0] != versions:
+                loaded = self._zones[family] = (versions, ZoneCountries(source, family, picked))
+            return loaded[1]
+
+    def lookup(self, ips):
+        """Return one result dict per IP, in order; IPs of a family without lookup data get an error."""
+        picked = {row[0] for row in get_from_db('SELECT code FROM countries WHERE picked == True')}
+        ipdeny = get_setting('data_source', DEFAULT_DATA_SOURCE) == 'ipdeny'
+        allow_only = get_selection_mode() == 'allow'
+        reserved = {family: IntervalSet(reserved_ranges(family)) for family in FAMILIES} if allow_only else {}
+        whitelist = {'inet': [], 'inet6': []}
+        for (cidr,) in get_from_db('SELECT cidr FROM whitelisted_ips'):
+            try:
+                network = ipaddress.ip_network(cidr.strip(), strict=False)
+            except ValueError:
+                continue
+            whitelist['inet' if network.version == 4 else 'inet6'].append((int(network.network_address), int(network.broadcast_address)))
+        whitelist = {family: IntervalSet(ranges) for family, ranges in whitelist.items()}
+        if ipdeny:
+            indexes = {family: self.zones(family, picked) for family in FAMILIES}
+            missing = "The zone files of the picked countries are not cached yet, run an update first"
+        else:
+            indexes = {family: self.index(family) for family in FAMILIES}
+            missing = "The range index is not built yet, run an update first"
+
+        results = []
+        for ip in ips:
+            try:
+                address = ipaddress.ip_address(ip)
+            except ValueError:
+                results.append({'ip': ip, 'error': "Invalid IP address"})
+                continue
+            family = 'inet' if address.version == 4 else 'inet6'
+            index = indexes[family]
+            if index is None:
+                results.append({'ip': ip, 'error': missing})
+                continue
+            country = index.lookup(int(address))
+            whitelisted = int(address) in whitelist[family]
+            selected = country in picked
+            if allow_only:
+                matched = not selected and int(address) not in reserved[family]
+            else:
+                matched = selected
+            results.append({
+                'ip': ip,
+                'country': country,
+                'selected': selected,
+                'whitelisted': whitelisted,
+                'blocked': matched and not whitelisted,
+            })
+        return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Look up the country of IPs and whether the current selection blocks them.")
+    parser.add_argument('ips', nargs='*', help="IPv4 or IPv6 addresses")
+    parser.add_argument('--file', help="read IPs from the first field of each line of FILE (an IP list or access log); - for stdin")
+    args = parser.parse_args()
+
+    ips = list(args.ips)
+    if args.file == '-':
+        ips.extend(parse_ips(sys.stdin))
+    elif args.file:
+        with open(args.file) as f:
+            ips.extend(parse_ips(f))
+    if not ips:
+        parser.error("no IPs given")
+
+    started = time.perf_counter()
+    results = IpLookup().lookup(ips)
+    for result in results:
+        if 'error' in result:
+            print(f"{result['ip']}\terror: {result['error']}")
+        else:
+            status = 'blocked' if result['blocked'] else 'whitelisted' if result['whitelisted'] and result['selected'] else 'allowed'
+            print(f"{result['ip']}\t{result['country'] or '-'}\t{status}")
+    print(f"Looked up {len(results)} IPs in {(time.perf_counter() - started) * 1000:.1f} ms.", file=sys.stderr)
@@ -0,0 +1,159 @@
+import os
+import sys
+import mmap
+import struct
+import bisect
+from array import array
+from collections import Counter
+
+INDEX_MAGIC = b"GBIX"
+INDEX_VERSION = 2
+# magic, version, byte order, address width in bytes, row count, country count, source sha256
+HEADER = struct.Struct("<4sHcBII32s")
+DIRECTORY_ENTRY = struct.Struct("<2sxxII")
+
+
+class _Uint128View:
+    """Sequence of big-endian 128-bit integers over a buffer, usable with bisect."""
+
+    def __init__(self, view):
+        self._view = view
+
+    def __len__(self):
+        return len(self._view) // 16
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, _ = i.indices(len(self))
+            return _Uint128View(self._view[start * 16:stop * 16])
+        if i < 0:
+            i += len(self)
+        return int.from_bytes(self._view[i * 16:i * 16 + 16], 'big')
+
+    def __iter__(self):
+        view = self._view
+        for offset in range(0, len(view), 16):
+            yield int.from_bytes(view[offset:offset + 16], 'big')
+
+    def release(self):
+        self._view.release()
+
+
+class RangeIndex:
+    """Memory-mapped, read-only index of IP ranges grouped by country.
+
+    Layout after the header and country directory (IPv4 arrays in native byte order,
+    IPv6 addresses as big-endian 16-byte records):
+    global starts/ends/country numbers sorted by start, used for lookups, then
+    starts/ends grouped by country, so a country's ranges are one contiguous slice.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, byteorder, width, rows, country_count, source = HEADER.unpack_from(self._mmap)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION or byteorder != sys.byteorder[0].encode():
+            self._mmap.close()
+            raise ValueError(f"Unsupported range index: {path}")
+        self.source = source.hex()
+        self.width = width
+
+        self.codes = []
+        self.directory = {}
+        offset = HEADER.size
+        for _ in range(country_count):
+            code, start, count = DIRECTORY_ENTRY.unpack_from(self._mmap, offset)
+            code = code.rstrip(b"\0").decode()
+            self.codes.append(code)
+            self.directory[code] = (start, count)
+            offset += DIRECTORY_ENTRY.size
+
+        view = self._view = memoryview(self._mmap)
+        size = rows * width
+        self.starts = _address_view(view[offset:offset + size], width)
+        offset += size
+        self.ends = _address_view(view[offset:offset + size], width)
+        offset += size
+        self.country_numbers = view[offset:offset + rows * 2].cast('H')
+        offset += _padded(rows * 2)
+        self.grouped_starts = _address_view(view[offset:offset + size], width)
+        offset += size
+        self.grouped_ends = _address_view(view[offset:offset + size], width)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def count(self, code):
+        return self.directory.get(code, (0, 0))[1]
+
+    def select(self, codes):
+        """Return (starts, ends) memoryview slices for each selected country."""
+        slices = []
+        for code in codes:
+            start, count = self.directory.get(code, (0, 0))
+            if count:
+                slices.append((self.grouped_starts[start:start + count], self.grouped_ends[start:start + count]))
+        return slices
+
+    def ranges(self, codes):
+        """Yield (start, end) for every range of the selected countries."""
+        for starts, ends in self.select(codes):
+            yield from zip(starts, ends)
+
+    def lookup(self, ip):
+        """Return the country code of the range containing integer `ip`, or None."""
+        position = bisect.bisect_right(self.starts, ip) - 1
+        if position < 0 or ip > self.ends[position]:
+            return None
+        return self.codes[self.country_numbers[position]]
+
+    def close(self):
+        for view in (self.starts, self.ends, self.country_numbers, self.grouped_starts, self.grouped_ends, self._view):
+            view.release()
+        self._mmap.close()
+
+
+def _address_view(view, width):
+    return view.cast('I') if width == 4 else _Uint128View(view)
+
+
+def _write_addresses(f, addresses, width):
+    if width == 4:
+        array('I', addresses).tofile(f)
+    else:
+        f.write(b"".join(address.to_bytes(16, 'big') for address in addresses))
+
+
+def _padded(size):
+    return (size + 3) & ~3
+
+
+def build_index(rows, path, source="", width=4):
+    """Compile (start, end, country_code) rows into a range index at `path`.
+
+    `width` is 4 for IPv4 and 16 for IPv6 address ranges."""
+    rows = sorted(rows)
+    codes = sorted({code for _, _, code in rows})
+    numbers = {code: number for number, code in enumerate(codes)}
+    country_numbers = array('H', (numbers[code] for _, _, code in rows))
+
+    grouped = sorted(range(len(rows)), key=lambda i: country_numbers[i])
+    counts = Counter(country_numbers)
+    directory = []
+    offset = 0
+    for number, code in enumerate(codes):
+        count = counts[number]
+        directory.append(DIRECTORY_ENTRY.pack(code.encode(), offset, count))
+        offset += count
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(INDEX_MAGIC, INDEX_VERSION, sys.byteorder[0].encode(), width, len(rows), len(codes), bytes.fromhex(source)))
+        f.writelines(directory)
+        _write_addresses(f, (start for start, _, _ in rows), width)
+        _write_addresses(f, (end for _, end, _ in rows), width)
+        country_numbers.tofile(f)
+        f.write(b"\0" * (_padded(len(rows) * 2) - len(rows) * 2))
+        _write_addresses(f, (rows[i][0] for i in grouped), width)
+        _write_addresses(f, (rows[i][1] for i in grouped), width)
+    os.replace(tmp_path, path)
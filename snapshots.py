@@ -0,0 +1,85 @@
+import os
+import re
+import gzip
+import json
+import time
+import hashlib
+from itertools import groupby
+
+SNAPSHOT_PATTERN = re.compile(r'^snapshot_(\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2})_([0-9a-f]{12})\.json\.gz$')
+LEGACY_BACKUP_SUFFIX = '.backup'
+# iptables-save/ip6tables-save chain counters and "# Generated by ... on <date>" comments
+COUNTERS_PATTERN = re.compile(r'\[\d+:\d+\]')
+# Per-member counters of list:set entries in `ipset save` output
+IPSET_COUNTERS_PATTERN = re.compile(r' packets \d+ bytes \d+')
+# Hash parameters newer ipset versions print on create lines; initval is random for every new set
+IPSET_HASH_PARAMS_PATTERN = re.compile(r' (bucketsize \d+|initval 0x[0-9a-f]+)')
+
+
+def normalize_dump(dump):
+    """Drop comment lines, zero the packet counters, drop per-set hash parameters and sort set members,
+    so identical rules give identical dumps."""
+    lines = [IPSET_HASH_PARAMS_PATTERN.sub('', IPSET_COUNTERS_PATTERN.sub(' packets 0 bytes 0', COUNTERS_PATTERN.sub('[0:0]', line)))
+             for line in dump.splitlines() if not line.startswith('#')]
+    # `ipset save` lists members in hash order, which changes with initval whenever a set is rebuilt
+    lines = [line for is_add, group in groupby(lines, key=lambda line: line.startswith('add '))
+             for line in (sorted(group) if is_add else group)]
+    return '\n'.join(lines) + '\n'
+
+
+def snapshot_digest(backend_name, dumps):
+    payload = json.dumps({'backend': backend_name, 'dumps': {label: normalize_dump(dump) for label, dump in dumps.items()}}, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def list_snapshots(directory):
+    """Return snapshot file names in `directory`, oldest first."""
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return []
+    return sorted(name for name in names if SNAPSHOT_PATTERN.match(name))
+
+
+def write_snapshot(directory, backend_name, dumps, stamp):
+    """Store the dumps as one gzip-compressed snapshot, unless the newest one has the same content.
+
+    Returns the new snapshot's file name, or None when it was skipped."""
+    digest = snapshot_digest(backend_name, dumps)
+    existing = list_snapshots(directory)
+    if existing and SNAPSHOT_PATTERN.match(existing[-1]).group(2) == digest[:12]:
+        print(f"Rules unchanged since snapshot {existing[-1]}, skipping backup.")
+        return None
+    os.makedirs(directory, exist_ok=True)
+    name = f"snapshot_{stamp}_{digest[:12]}.json.gz"
+    path = os.path.join(directory, name)
+    with gzip.open(path + ".tmp", 'wt', encoding='utf-8') as f:
+        json.dump({'backend': backend_name, 'dumps': {label: normalize_dump(dump) for label, dump in dumps.items()}}, f)
+    os.replace(path + ".tmp", path)
+    print(f"Saved rule snapshot {name} ({os.path.getsize(path)} bytes).")
+    return name
+
+
+def load_snapshot(directory, name):
+    """Return (backend name, {label: dump}) stored in snapshot `name`."""
+    with gzip.open(os.path.join(directory, name), 'rt', encoding='utf-8') as f:
+        snapshot = json.load(f)
+    return snapshot['backend'], snapshot['dumps']
+
+
+def prune_snapshots(directory, keep, max_age_days):
+    """Delete snapshots beyond the newest `keep` or older than `max_age_days`; the newest is always kept.
+
+    Uncompressed *.backup dumps written by older versions are pruned by age."""
+    cutoff = time.time() - max_age_days * 86400
+    snapshots = list_snapshots(directory)
+    for position, name in enumerate(reversed(snapshots)):
+        path = os.path.join(directory, name)
+        if position and (position >= keep or os.path.getmtime(path) < cutoff):
+            os.remove(path)
+            print(f"Pruned rule snapshot {name}.")
+    for name in os.listdir(directory) if os.path.isdir(directory) else []:
+        path = os.path.join(directory, name)
+        if name.endswith(LEGACY_BACKUP_SUFFIX) and os.path.getmtime(path) < cutoff:
+            os.remove(path)
+            print(f"Pruned legacy backup {name}.")
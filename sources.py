@@ -0,0 +1,145 @@
+import os
+import json
+import hashlib
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from compiler import cidrs_to_ranges
+
+IPDENY_URLS = {
+    'inet': "http://www.ipdeny.com/ipblocks/data/countries",
+    'inet6': "http://www.ipdeny.com/ipv6/ipaddresses/blocks",
+}
+IPDENY_WORKERS = 8
+FETCH_TIMEOUT = 60
+
+
+def read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_atomic(path, data, mode='w'):
+    with open(path + ".tmp", mode) as f:
+        f.write(data)
+    os.replace(path + ".tmp", path)
+
+
+class IpdenySource:
+    """Per-country zone files from ipdeny.com, already in CIDR form.
+
+    Only the selected countries are fetched, in parallel over one connection pool, each file
+    with its own conditional request against a local cache. `on_download` is called with the
+    number of bytes each fetch() transferred."""
+
+    name = 'ipdeny'
+
+    def __init__(self, cache_dir, urls=None, workers=IPDENY_WORKERS, on_download=None):
+        self.cache_dir = cache_dir
+        self.urls = urls or IPDENY_URLS
+        self.workers = workers
+        self.on_download = on_download
+
+    def path(self, family, code):
+        return os.path.join(self.cache_dir, family, f"{code.lower()}.zone")
+
+    def fetch_zone(self, session, family, code, refresh=True):
+        """Fetch one zone file unless the cached copy is current. Returns the bytes transferred.
+
+        When the fetch fails the cached copy is kept and used; without one the error is raised."""
+        path = self.path(family, code)
+        meta = read_json(path + ".json")
+        if os.path.exists(path) and not refresh:
+            return 0
+        headers = {}
+        if os.path.exists(path):
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+
+        try:
+            response = session.get(f"{self.urls[family]}/{code.lower()}.zone", headers=headers, timeout=FETCH_TIMEOUT)
+            if response.status_code == 304:
+                return 0
+            # Countries without allocations in a family have no zone file
+            if response.status_code != 404:
+                response.raise_for_status()
+        except requests.RequestException as e:
+            if not os.path.exists(path):
+                raise
+            print(f"Cannot refresh {family} zone of {code}, keeping the cached copy: {e}")
+            return 0
+        body = b"" if response.status_code == 404 else response.content
+        write_atomic(path, body, 'wb')
+        meta = {'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified'),
+                'sha256': hashlib.sha256(body).hexdigest()}
+        write_atomic(path + ".json", json.dumps(meta))
+        return len(body)
+
+    def fetch(self, countries, refresh=True):
+        """Bring the zone files of `countries` up to date; with refresh=False only missing ones are fetched."""
+        jobs = [(family, code) for family in self.urls for code in countries]
+        for family in self.urls:
+            os.makedirs(os.path.join(self.cache_dir, family), exist_ok=True)
+        with requests.Session() as session:
+            adapter = requests.adapters.HTTPAdapter(pool_connections=len(self.urls), pool_maxsize=self.workers)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                sizes = list(executor.map(lambda job: self.fetch_zone(session, *job, refresh=refresh), jobs))
+        fetched = sum(1 for size in sizes if size)
+        print(f"Fetched {fetched} of {len(jobs)} ipdeny zone files ({sum(sizes)} bytes), the rest unchanged.")
+        if self.on_download:
+            self.on_download(sum(sizes))
+
+    def country_version(self, family, code):
+        return read_json(self.path(family, code) + ".json").get('sha256')
+
+    def version(self, family, countries):
+        """Fingerprint of the zone files of `countries`."""
+        digest = hashlib.sha256()
+        for code in sorted(countries):
+            digest.update(f"{code}:{self.country_version(family, code)}\n".encode())
+        return digest.hexdigest()
+
+    def country_cidrs(self, family, code):
+        try:
+            with open(self.path(family, code)) as f:
+                return [line.strip() for line in f if line.strip() and not line.startswith('#')]
+        except OSError:
+            return []
+
+    def compile(self, countries, family, engine='auto'):
+        """Return the selected countries' CIDRs as published; no range conversion is needed."""
+        cidrs = list(dict.fromkeys(cidr for code in countries for cidr in self.country_cidrs(family, code)))
+        print(f"Loaded {len(cidrs)} {family} CIDR entries from {len(countries)} ipdeny zone files.")
+        return cidrs
+
+    def ranges(self, countries, family):
+        return cidrs_to_ranges(self.compile(countries, family))
+
+    def open(self, family):
+        return IpdenyCountries(self, family)
+
+
+class IpdenyCountries:
+    """Per-country access to the cached zone files of one family."""
+
+    def __init__(self, source, family):
+        self.source = source
+        self.family = family
+
+    def has(self, code):
+        return bool(self.source.country_cidrs(self.family, code))
+
+    def cidrs(self, code):
+        return self.source.country_cidrs(self.family, code)
+
+    def ranges(self, codes):
+        return cidrs_to_ranges(cidr for code in codes for cidr in self.cidrs(code))
+
+    def close(self):
+        pass
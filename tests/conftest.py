@@ -0,0 +1,229 @@
+"""Shared fixtures: a throwaway GEOBLOCK_HOME with its own app.db, cached ipdeny zone files and a
+fake kernel that stands in for ipset, iptables and nft and records every call."""
+import os
+import sys
+import json
+import shutil
+import hashlib
+import tempfile
+import subprocess
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# updater.py reads these and chdirs into GEOBLOCK_HOME when it is first imported
+HOME = tempfile.mkdtemp(prefix="geoblock-tests-")
+os.environ.update(GEOBLOCK_HOME=HOME, GEOBLOCK_ZONE_DIR=os.path.join(HOME, "zone"), GEOBLOCK_SOCKET=os.path.join(HOME, "geoblock.sock"))
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS countries (id INTEGER PRIMARY KEY, code TEXT UNIQUE, name TEXT, picked BOOLEAN)',
+    'CREATE TABLE IF NOT EXISTS whitelisted_ips (id INTEGER PRIMARY KEY, cidr TEXT)',
+    'CREATE TABLE IF NOT EXISTS port_rules (id INTEGER PRIMARY KEY, port_number INTEGER, protocol TEXT)',
+    'CREATE TABLE IF NOT EXISTS system_info (last_update_date DATETIME)',
+    'CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT)',
+]
+COUNTRIES = [(1, 'CN', 'China'), (2, 'RU', 'Russia'), (3, 'US', 'United States')]
+# Zone files of the test countries, as ipdeny publishes them
+ZONES = {
+    'inet': {'CN': ['1.0.1.0/24', '1.0.2.0/23'], 'RU': ['2.60.0.0/16', '5.3.0.0/22'], 'US': ['3.0.0.0/15']},
+    'inet6': {'CN': ['2001:250::/35'], 'RU': ['2a00:1fa0::/29'], 'US': ['2600::/29']},
+}
+
+
+def host_entry(entry):
+    """An entry as `ipset save` prints it: hosts without their prefix length."""
+    return entry.rsplit('/', 1)[0] if entry.endswith('/128') or (entry.endswith('/32') and ':' not in entry) else entry
+
+
+class FakeKernel:
+    """Just enough ipset, iptables and nft to run the backends against, with every call kept in `calls`
+    as (args, stdin script or None)."""
+
+    def __init__(self):
+        self.sets = {}
+        self.tables = {}
+        self.nft = None
+        self.calls = []
+
+    def scripts(self, *prefix):
+        """Return the stdin scripts of the calls whose arguments start with `prefix`."""
+        return [script for args, script in self.calls if tuple(args[:len(prefix)]) == prefix and script is not None]
+
+    def chain(self, command, table, name):
+        return self.tables.setdefault((command, table), {'INPUT': [], 'PREROUTING': []}).setdefault(name, [])
+
+    def __call__(self, args, input_lines=None, check=True):
+        script = ''.join(input_lines) if input_lines is not None else None
+        self.calls.append((list(args), script))
+        command = args[0]
+        if command == 'ipset':
+            code, out = self.ipset([arg for arg in args[1:] if arg != '-exist'], script)
+        elif command == 'nft':
+            code, out = self.nft_command(args[1:], script)
+        elif command.endswith('-save'):
+            code, out = 0, self.save_tables(command[:-len('-save')])
+        elif command.endswith('-restore'):
+            code, out = self.restore_tables(command[:-len('-restore')], script)
+        elif command in ('iptables', 'ip6tables'):
+            code, out = self.iptables(command, args[1:])
+        else:
+            code, out = 1, ''
+        if check and code:
+            raise subprocess.CalledProcessError(code, args)
+        return subprocess.CompletedProcess(args, code, out, '')
+
+    def ipset(self, args, script):
+        command, names = args[0], [arg for arg in args[1:] if not arg.startswith('-')]
+        name = names[0] if names else None
+        if command == 'list':
+            if name is None:
+                return 0, '\n'.join(self.sets)
+            if name not in self.sets:
+                return 1, ''
+            set_type, _, entries = self.sets[name]
+            if '-n' in args:
+                return 0, name
+            members = '' if '-t' in args else "Members:\n" + ''.join(f"{entry} packets 0 bytes 0\n" for entry in entries)
+            return 0, f"Name: {name}\nType: {set_type}\n{members}"
+        if command == 'create':
+            self.sets[name] = [args[2], args[4] if len(args) > 4 else 'inet', []]
+        elif command == 'destroy':
+            return (0 if self.sets.pop(name, None) is not None else 1), ''
+        elif command == 'swap':
+            self.sets[name], self.sets[names[1]] = self.sets[names[1]], self.sets[name]
+        elif command == 'add' and host_entry(names[1]) not in self.sets[name][2]:
+            self.sets[name][2].append(host_entry(names[1]))
+        elif command == 'save':
+            if name is not None and name not in self.sets:
+                return 1, ''
+            out = ''
+            for set_name, (set_type, family, entries) in self.sets.items():
+                if name in (None, set_name):
+                    out += f"create {set_name} hash:net family {family}\n" if set_type == 'hash:net' else f"create {set_name} list:set size 8 counters\n"
+                    out += ''.join(f"add {set_name} {entry}\n" for entry in entries)
+            return 0, out
+        elif command == 'restore':
+            for line in script.splitlines():
+                parts = line.split()
+                if parts[0] == 'create':
+                    self.sets[parts[1]] = [parts[2], parts[4] if parts[2] == 'hash:net' else None, []]
+                elif parts[0] == 'add' and host_entry(parts[2]) not in self.sets[parts[1]][2]:
+                    self.sets[parts[1]][2].append(host_entry(parts[2]))
+                elif parts[0] == 'del' and host_entry(parts[2]) in self.sets[parts[1]][2]:
+                    self.sets[parts[1]][2].remove(host_entry(parts[2]))
+        return 0, ''
+
+    def save_tables(self, command):
+        out = ''
+        for (table_command, table), chains in self.tables.items():
+            if table_command == command:
+                out += f"*{table}\n" + ''.join(f":{name} ACCEPT [0:0]\n" for name in chains)
+                out += ''.join(f"{rule}\n" for rules in chains.values() for rule in rules) + "COMMIT\n"
+        return out
+
+    def restore_tables(self, command, script):
+        table = None
+        for line in script.splitlines():
+            if line.startswith('*'):
+                table = line[1:]
+            elif line.startswith(':'):
+                self.chain(command, table, line[1:].split()[0]).clear()
+            elif line.startswith('-A'):
+                self.chain(command, table, line.split()[1]).append(line)
+        return 0, ''
+
+    def iptables(self, command, args):
+        table = 'filter'
+        if args[0] == '-t':
+            table, args = args[1], args[2:]
+        chains = self.tables.setdefault((command, table), {'INPUT': [], 'PREROUTING': []})
+        operation, name, rest = args[0], args[1] if len(args) > 1 else None, args[2:]
+        if operation == '-n':
+            return (0 if args[2] in chains else 1), ''
+        if operation == '-X':
+            return (0 if chains.pop(name, None) is not None else 1), ''
+        if operation == '-F':
+            chains.get(name, []).clear()
+            return 0, ''
+        position = None
+        if operation == '-I' and rest and rest[0].isdigit():
+            position, rest = int(rest[0]), rest[1:]
+        rule = ' '.join(['-A', name, *rest])
+        rules = chains.setdefault(name, [])
+        if operation == '-C':
+            return (0 if rule in rules else 1), ''
+        if operation == '-I':
+            rules.insert((position or 1) - 1, rule)
+        elif operation == '-A':
+            rules.append(rule)
+        elif operation == '-D':
+            if rule not in rules:
+                return 1, ''
+            rules.remove(rule)
+        return 0, ''
+
+    def nft_command(self, args, script):
+        if args[:2] == ['list', 'table']:
+            return (0, self.nft) if self.nft is not None else (1, '')
+        if args[:2] == ['list', 'ruleset']:
+            return 0, self.nft or ''
+        if args[:2] == ['delete', 'table']:
+            self.nft = None
+        elif args[:1] == ['-f'] and script.startswith('table inet geoblock\ndelete table inet geoblock\n'):
+            self.nft = script.split('\n', 2)[2]
+        return 0, ''
+
+
+@pytest.fixture
+def geoblock(monkeypatch):
+    """A clean app.db and zone directory with the test countries, fed from cached ipdeny zone files.
+
+    Returns the updater module; updater.get_backend() runs its commands on the fake kernel in `updater.kernel`."""
+    import db
+    import updater
+    from db import transaction
+    shutil.rmtree(updater.ZONE_DIR, ignore_errors=True)
+    with transaction() as cursor:
+        for statement in SCHEMA + [updater.UPDATE_RUNS_SCHEMA]:
+            cursor.execute(statement)
+        for table in ('countries', 'whitelisted_ips', 'port_rules', 'system_info', 'settings', 'update_runs'):
+            cursor.execute(f'DELETE FROM {table}')
+        cursor.executemany('INSERT INTO countries (id, code, name, picked) VALUES (?, ?, ?, 0)', COUNTRIES)
+        cursor.execute("INSERT INTO settings (key, value) VALUES ('data_source', 'ipdeny')")
+    for family, zones in ZONES.items():
+        os.makedirs(os.path.join(updater.IPDENY_CACHE_DIR, family))
+        for code, cidrs in zones.items():
+            write_zone(updater, family, code, cidrs)
+
+    kernel = FakeKernel()
+    get_backend = updater.get_backend
+    monkeypatch.setattr(updater, 'get_backend', lambda name=None, runner=None: get_backend(name, runner or kernel))
+    monkeypatch.setattr(updater, 'check_internet_access', lambda: None)
+    monkeypatch.setattr(updater, 'kernel', kernel, raising=False)
+    yield updater
+    db.release_connection()
+
+
+def write_zone(updater, family, code, cidrs):
+    """Store a zone file in the ipdeny cache, with the metadata a fetch leaves next to it."""
+    body = ''.join(f"{cidr}\n" for cidr in cidrs).encode()
+    path = os.path.join(updater.IPDENY_CACHE_DIR, family, f"{code.lower()}.zone")
+    with open(path, 'wb') as f:
+        f.write(body)
+    with open(path + ".json", 'w') as f:
+        json.dump({'etag': None, 'last_modified': None, 'sha256': hashlib.sha256(body).hexdigest()}, f)
+
+
+def configure(**settings):
+    """Store app.db settings, picked countries (picked=[codes]), ports (ports=[(port, protocol)]) and the whitelist."""
+    from db import transaction
+    with transaction() as cursor:
+        if 'picked' in settings:
+            cursor.execute('UPDATE countries SET picked = 0')
+            cursor.executemany('UPDATE countries SET picked = 1 WHERE code = ?', [(code,) for code in settings.pop('picked')])
+        if 'ports' in settings:
+            cursor.execute('DELETE FROM port_rules')
+            cursor.executemany('INSERT INTO port_rules (port_number, protocol) VALUES (?, ?)', settings.pop('ports'))
+        if 'whitelist' in settings:
+            cursor.execute('DELETE FROM whitelisted_ips')
+            cursor.executemany('INSERT INTO whitelisted_ips (cidr) VALUES (?)', [(cidr,) for cidr in settings.pop('whitelist')])
+        cursor.executemany('INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)', settings.items())
@@ -0,0 +1,127 @@
+"""The restore and nft scripts the updater sends to the kernel, checked against a fake runner."""
+from conftest import configure
+from firewall import create_set_line
+
+
+def rules_in(kernel, command='iptables', table='filter'):
+    return kernel.tables[(command, table)]['GEOBLOCK']
+
+
+def apply_families(updater, countries, ports=()):
+    """Do what a full update does to the block sets, without downloading anything."""
+    backend = updater.get_backend()
+    state = updater.load_state_meta()
+    for family in updater.FAMILIES:
+        updater.update_family(backend, family, countries, list(ports), state, data_source=updater.get_source())
+    updater.save_state_meta(state)
+    return state
+
+
+def test_update_family_loads_the_set_in_one_restore_and_swaps_it_in(geoblock):
+    kernel = geoblock.kernel
+    apply_families(geoblock, ['CN'], [(22, 'tcp'), (443, 'tcp')])
+
+    entries = ['1.0.1.0/24', '1.0.2.0/23']
+    assert kernel.scripts('ipset', 'restore')[0] == create_set_line('GEO_BLOCK_TMP', 'inet', entries) + ''.join(f"add GEO_BLOCK_TMP {entry}\n" for entry in entries)
+    assert (['ipset', 'swap', 'GEO_BLOCK_TMP', 'GEO_BLOCK'], None) in kernel.calls
+    assert kernel.sets['GEO_BLOCK'][2] == entries
+    assert kernel.sets['GEO_BLOCK6'][2] == ['2001:250::/35']
+    assert kernel.scripts('iptables-restore', '--noflush')[-1] == (
+        "*filter\n:GEOBLOCK - [0:0]\n"
+        "-A GEOBLOCK -m set --match-set GEO_ALLOW src -j ACCEPT\n"
+        "-A GEOBLOCK -p tcp -m multiport --dports 22,443 -m set --match-set GEO_BLOCK src -j DROP\n"
+        "COMMIT\n")
+    assert kernel.tables[('iptables', 'filter')]['INPUT'] == ['-A INPUT -j GEOBLOCK']
+
+
+def test_update_family_leaves_an_unchanged_set_alone(geoblock):
+    kernel = geoblock.kernel
+    apply_families(geoblock, ['CN'])
+    kernel.calls.clear()
+    apply_families(geoblock, ['CN'])
+
+    assert kernel.scripts('ipset', 'restore') == []
+    assert kernel.scripts('ipset', '-exist', 'restore') == []
+
+
+def test_hot_apply_sends_only_the_toggled_countries(geoblock):
+    kernel = geoblock.kernel
+    configure(picked=['CN', 'RU'], whitelist=['192.0.2.1'])
+    apply_families(geoblock, ['CN', 'RU'])
+    kernel.calls.clear()
+
+    configure(picked=['CN', 'US'])
+    geoblock.hot_apply()
+
+    assert kernel.scripts('ipset', '-exist', 'restore') == [
+        "del GEO_BLOCK 2.60.0.0/16\ndel GEO_BLOCK 5.3.0.0/22\nadd GEO_BLOCK 3.0.0.0/15\n",
+        "del GEO_BLOCK6 2a00:1fa0::/29\nadd GEO_BLOCK6 2600::/29\n",
+    ]
+    assert not any(args[:2] == ['ipset', 'swap'] and args[2].startswith('GEO_BLOCK') for args, _ in kernel.calls)
+    assert sorted(kernel.sets['GEO_BLOCK'][2]) == ['1.0.1.0/24', '1.0.2.0/23', '3.0.0.0/15']
+    assert kernel.sets['GEO_ALLOW'][2] == ['192.0.2.1']
+    assert geoblock.load_state_meta()['GEO_BLOCK']['source']['countries'] == ['CN', 'US']
+
+
+def test_update_nftables_replaces_the_table_in_one_script(geoblock):
+    kernel = geoblock.kernel
+    configure(firewall_backend='nftables')
+    backend = geoblock.get_backend()
+    state = {}
+    geoblock.update_nftables(backend, ['CN', 'RU'], [(22, 'tcp'), (53, 'udp')], ['192.0.2.1', '2001:db8::/32'], state,
+                             data_source=geoblock.get_source())
+
+    [script] = kernel.scripts('nft', '-f', '-')
+    lines = script.splitlines()
+    assert lines[:3] == ["table inet geoblock", "delete table inet geoblock", "table inet geoblock {"]
+    assert "        elements = { 1.0.1.0-1.0.3.255," in lines
+    assert "            2.60.0.0-2.60.255.255," in lines
+    assert "        elements = { 192.0.2.1 }" in lines
+    assert "        elements = { 2001:db8::/32 }" in lines
+    chain = lines[lines.index("    chain input {"):]
+    assert chain[1:8] == [
+        "        type filter hook input priority -1; policy accept;",
+        "        ip saddr @allow4 accept",
+        "        ip6 saddr @allow6 accept",
+        "        tcp dport { 22 } ip saddr @block4 drop",
+        "        udp dport { 53 } ip saddr @block4 drop",
+        "        tcp dport { 22 } ip6 saddr @block6 drop",
+        "        udp dport { 53 } ip6 saddr @block6 drop",
+    ]
+    assert state['nftables']['entries'] == {'block4': 3, 'block6': 2}
+
+
+def test_update_nftables_skips_an_unchanged_table(geoblock):
+    kernel = geoblock.kernel
+    configure(firewall_backend='nftables')
+    backend = geoblock.get_backend()
+    state = {}
+    for whitelist in (['192.0.2.1'], ['192.0.2.1'], ['192.0.2.2']):
+        geoblock.update_nftables(backend, ['CN'], [], whitelist, state, data_source=geoblock.get_source())
+
+    scripts = kernel.scripts('nft', '-f', '-')
+    assert len(scripts) == 2
+    assert "        elements = { 192.0.2.2 }\n" in scripts[1]
+
+
+def test_hot_apply_is_recorded_as_a_hot_apply_run(geoblock):
+    configure(picked=['CN'])
+    apply_families(geoblock, ['CN'])
+
+    configure(picked=['CN', 'RU'])
+    geoblock.hot_apply()
+
+    [(kind, success, backend)] = geoblock.get_from_db('SELECT kind, success, backend FROM update_runs')
+    assert (kind, success, backend) == ('hot-apply', 1, 'iptables')
+
+
+def test_an_update_runs_table_from_before_run_kinds_gets_the_kind_column(geoblock):
+    from db import transaction
+    with transaction() as cursor:
+        cursor.execute('DROP TABLE update_runs')
+        cursor.execute(geoblock.UPDATE_RUNS_SCHEMA.replace(', kind TEXT)', ')'))
+        cursor.execute("INSERT INTO update_runs (started_at, duration, success) VALUES ('2026-01-01T00:00:00', 1.0, 1)")
+
+    geoblock.UpdateRun().record(0.5, 'iptables', kind='hot-apply')
+
+    assert geoblock.get_from_db('SELECT kind FROM update_runs ORDER BY id') == [(None,), ('hot-apply',)]
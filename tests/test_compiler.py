@@ -0,0 +1,86 @@
+"""The NumPy compile paths must produce exactly the CIDRs of the pure-Python ones."""
+import os
+import sys
+import random
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from compiler import np, compile_ranges, compile_ranges_np, compile_index_np, merge_ranges
+from rangeindex import RangeIndex, build_index
+
+pytestmark = pytest.mark.skipif(np is None, reason="numpy is not installed")
+
+MAX_IPV4 = (1 << 32) - 1
+CODES = ['CN', 'RU', 'US', 'BR', 'IN']
+
+
+def random_partition(rng, count):
+    """Split the whole IPv4 space into `count` consecutive ranges with random countries, like the database."""
+    cuts = sorted(rng.sample(range(1, MAX_IPV4), count - 1))
+    starts = [0, *cuts]
+    ends = [cut - 1 for cut in cuts] + [MAX_IPV4]
+    return [(start, end, rng.choice(CODES)) for start, end in zip(starts, ends)]
+
+
+def open_test_index(tmp_path, rows):
+    path = str(tmp_path / "test.idx")
+    build_index(iter(rows), path, source="00" * 32)
+    return RangeIndex(path)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_compile_index_np_matches_python(tmp_path, seed):
+    rng = random.Random(seed)
+    index = open_test_index(tmp_path, random_partition(rng, rng.choice([2, 10, 500, 5000])))
+    try:
+        codes = rng.sample(CODES, rng.randint(1, len(CODES)))
+        ranges = list(index.ranges(codes))
+        cidrs, rows = compile_index_np(index, codes)
+        assert cidrs == compile_ranges(ranges)
+        assert rows == len(ranges)
+    finally:
+        index.close()
+
+
+@pytest.mark.parametrize('rows', [
+    [(0, MAX_IPV4, 'CN')],
+    [(0, 0, 'CN'), (1, MAX_IPV4 - 1, 'RU'), (MAX_IPV4, MAX_IPV4, 'CN')],
+    [(0, 0, 'RU'), (1, MAX_IPV4, 'CN')],
+    [(0, MAX_IPV4 - 1, 'RU'), (MAX_IPV4, MAX_IPV4, 'CN')],
+])
+def test_compile_index_np_edges(tmp_path, rows):
+    index = open_test_index(tmp_path, rows)
+    try:
+        assert compile_index_np(index, ['CN'])[0] == compile_ranges(index.ranges(['CN']))
+    finally:
+        index.close()
+
+
+def test_compile_index_np_edge_values(tmp_path):
+    index = open_test_index(tmp_path, [(0, 0, 'CN'), (1, MAX_IPV4 - 1, 'RU'), (MAX_IPV4, MAX_IPV4, 'CN')])
+    try:
+        assert compile_index_np(index, ['CN'])[0] == ['0.0.0.0/32', '255.255.255.255/32']
+        assert compile_index_np(index, ['CN', 'RU'])[0] == ['0.0.0.0/0']
+    finally:
+        index.close()
+
+
+@pytest.mark.parametrize('seed', range(50))
+def test_compile_ranges_np_matches_python(seed):
+    rng = random.Random(seed)
+    spans = [(start, min(start + rng.randint(0, 1 << rng.randint(0, 24)), MAX_IPV4))
+             for start in (rng.randint(0, MAX_IPV4) for _ in range(rng.randint(0, 2000)))]
+    ranges = merge_ranges(spans)
+    assert compile_ranges_np(ranges) == compile_ranges(ranges)
+
+
+@pytest.mark.parametrize('ranges', [
+    [],
+    [(0, MAX_IPV4)],
+    [(0, 0)],
+    [(MAX_IPV4, MAX_IPV4)],
+    [(0, 0), (MAX_IPV4, MAX_IPV4)],
+    [(1, MAX_IPV4 - 1)],
+])
+def test_compile_ranges_np_edges(ranges):
+    assert compile_ranges_np(ranges) == compile_ranges(ranges)
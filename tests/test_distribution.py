@@ -0,0 +1,83 @@
+"""Pushes from a controller to agents on 127.0.0.1, applied to the fake kernel."""
+import threading
+from http.server import ThreadingHTTPServer
+import pytest
+import distribution
+from distribution import AgentHandler, encode_artifact, push, push_to_agent
+
+ARTIFACT = {
+    'countries': ['CN', 'RU'],
+    'mode': 'block',
+    'db_sha256': {'inet': "00" * 32, 'inet6': "00" * 32},
+    'cidrs': {'inet': ['1.0.1.0/24', '1.0.2.0/23', '2.60.0.0/16'], 'inet6': ['2001:250::/35']},
+    'version': 1,
+    'created': "2026-01-01T00:00:00",
+}
+
+
+@pytest.fixture
+def agents(geoblock):
+    """Two agents with their own tokens; yields [(url, token)] and stops them afterwards."""
+    servers, urls = [], []
+    for token in ("token-a", "token-b"):
+        handler = type('TestAgentHandler', (AgentHandler,), {'token': token, 'log_message': lambda self, *args: None})
+        server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        urls.append((f"http://127.0.0.1:{server.server_address[1]}", token))
+    yield urls
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def firewall_changes(kernel):
+    """The calls that change the kernel, leaving out reads like `ipset list` and `iptables-save`."""
+    return [args for args, _ in kernel.calls if args[0] != 'iptables-save' and args[:2] not in (['ipset', 'list'], ['ipset', 'save'])
+            and '-C' not in args and '-n' not in args]
+
+
+def test_a_valid_push_is_applied(geoblock, agents):
+    body, sha256 = encode_artifact(ARTIFACT)
+    results = push(ARTIFACT['version'], body, sha256, agents=agents[:1])
+
+    assert [(result['status'], result['version'], result['entries']) for result in results] == [('applied', 1, 4)]
+    assert sorted(geoblock.kernel.sets['GEO_BLOCK'][2]) == ['1.0.1.0/24', '1.0.2.0/23', '2.60.0.0/16']
+    assert geoblock.kernel.sets['GEO_BLOCK6'][2] == ['2001:250::/35']
+    assert geoblock.load_state_meta()['artifact'] == {'version': 1, 'sha256': sha256}
+
+    # The same artifact again changes nothing
+    calls = len(geoblock.kernel.calls)
+    assert push_to_agent(*agents[0], ARTIFACT['version'], body, sha256)['status'] == 'unchanged'
+    assert len(geoblock.kernel.calls) == calls
+
+
+def test_a_wrong_token_is_rejected_without_touching_the_firewall(geoblock, agents):
+    body, sha256 = encode_artifact(ARTIFACT)
+    (url_a, _), (url_b, token_b) = agents
+    results = push(ARTIFACT['version'], body, sha256, agents=[(url_a, token_b), (url_b, "token-a")])
+
+    assert [(result['ok'], result['error']) for result in results] == [(False, "Bad token"), (False, "Bad token")]
+    assert firewall_changes(geoblock.kernel) == []
+    assert 'artifact' not in geoblock.load_state_meta()
+
+
+def test_a_checksum_mismatch_is_rejected_without_touching_the_firewall(geoblock, agents):
+    body, sha256 = encode_artifact(ARTIFACT)
+    tampered = encode_artifact({**ARTIFACT, 'cidrs': {'inet': ['0.0.0.0/0'], 'inet6': []}})[0]
+    result = push_to_agent(*agents[1], ARTIFACT['version'], tampered, sha256)
+
+    assert (result['ok'], result['error']) == (False, "Artifact checksum mismatch")
+    assert firewall_changes(geoblock.kernel) == []
+    assert 'artifact' not in geoblock.load_state_meta()
+
+
+def test_an_older_version_is_refused_once_a_newer_one_is_applied(geoblock, agents):
+    newer = {**ARTIFACT, 'version': 2, 'countries': ['CN'], 'cidrs': {'inet': ['1.0.1.0/24', '1.0.2.0/23'], 'inet6': []}}
+    assert push_to_agent(*agents[0], 2, *encode_artifact(newer))['status'] == 'applied'
+    calls = len(geoblock.kernel.calls)
+
+    result = push_to_agent(*agents[0], 1, *encode_artifact(ARTIFACT))
+    assert (result['status'], result['version']) == ('stale', 2)
+    assert len(geoblock.kernel.calls) == calls
+    assert distribution.load_state_meta()['artifact']['version'] == 2
@@ -0,0 +1,68 @@
+"""Early-drop enforcement points: the whitelist must still be matched before any DROP."""
+import pytest
+from conftest import configure
+from test_backends import apply_families
+
+
+def chains_of(script):
+    """Return {chain name: rule lines} of an nft script."""
+    chains, name = {}, None
+    for line in script.splitlines():
+        stripped = line.strip()
+        if stripped.startswith('chain '):
+            name = stripped.split()[1]
+            chains[name] = []
+        elif stripped == '}':
+            name = None
+        elif name and not stripped.startswith('type '):
+            chains[name].append(stripped)
+    return chains
+
+
+@pytest.mark.parametrize('command, allow, block', [('iptables', 'GEO_ALLOW', 'GEO_BLOCK'), ('ip6tables', 'GEO_ALLOW6', 'GEO_BLOCK6')])
+def test_iptables_raw_accepts_the_whitelist_before_dropping(geoblock, command, allow, block):
+    kernel = geoblock.kernel
+    configure(enforcement_point='raw')
+    apply_families(geoblock, ['CN'], [(22, 'tcp')])
+
+    assert kernel.tables[(command, 'raw')]['GEOBLOCK'] == [
+        f"-A GEOBLOCK -m set --match-set {allow} src -j ACCEPT",
+        f"-A GEOBLOCK -m addrtype --dst-type LOCAL -p tcp -m multiport --dports 22 -m set --match-set {block} src -j DROP",
+    ]
+    assert kernel.tables[(command, 'raw')]['PREROUTING'] == ['-A PREROUTING -j GEOBLOCK']
+    assert 'GEOBLOCK' not in kernel.tables.get((command, 'filter'), {})
+
+
+def test_iptables_moving_to_raw_removes_the_input_chain(geoblock):
+    kernel = geoblock.kernel
+    apply_families(geoblock, ['CN'])
+    assert kernel.tables[('iptables', 'filter')]['INPUT'] == ['-A INPUT -j GEOBLOCK']
+
+    configure(enforcement_point='raw')
+    apply_families(geoblock, ['CN'])
+
+    assert kernel.tables[('iptables', 'filter')]['INPUT'] == []
+    assert 'GEOBLOCK' not in kernel.tables[('iptables', 'filter')]
+    assert kernel.tables[('iptables', 'raw')]['GEOBLOCK'][0] == "-A GEOBLOCK -m set --match-set GEO_ALLOW src -j ACCEPT"
+
+
+@pytest.mark.parametrize('settings, chains', [
+    ({'enforcement_point': 'raw'}, ['prerouting']),
+    ({'enforcement_point': 'ingress', 'enforcement_interfaces': 'eth0,eth1'}, ['ingress0', 'ingress1']),
+])
+def test_nftables_early_drop_accepts_the_whitelist_before_dropping(geoblock, settings, chains):
+    configure(firewall_backend='nftables', **settings)
+    backend = geoblock.get_backend()
+    geoblock.update_nftables(backend, ['CN'], [(22, 'tcp')], ['192.0.2.1', '2001:db8::1'], {}, data_source=geoblock.get_source())
+
+    [script] = geoblock.kernel.scripts('nft', '-f', '-')
+    assert sorted(chains_of(script)) == chains
+    for rules in chains_of(script).values():
+        verdicts = [rule.rsplit(' ', 1)[1] for rule in rules]
+        assert verdicts == ['accept', 'accept', 'drop', 'drop']
+        assert rules[:2] == ["ip saddr @allow4 accept", "ip6 saddr @allow6 accept"]
+    if settings['enforcement_point'] == 'raw':
+        assert "        type filter hook prerouting priority raw; policy accept;\n" in script
+        assert "        fib daddr type local tcp dport { 22 } ip saddr @block4 drop\n" in script
+    else:
+        assert '        type filter hook ingress device "eth1" priority -500; policy accept;\n' in script
@@ -0,0 +1,141 @@
+"""IpdenySource against a local stand-in for ipdeny.com: conditional requests and the zone cache."""
+import os
+import hashlib
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import pytest
+import requests
+from sources import IpdenySource
+
+
+class Ipdeny:
+    """Serves /<family>/<cc>.zone from `zones` with ETags, answering If-None-Match with 304;
+    codes in `failing` get a 500. Every request is kept in `requests` as (path, If-None-Match)."""
+
+    def __init__(self):
+        self.zones = {'inet': {'cn': "1.0.1.0/24\n1.0.2.0/23\n", 'ru': "2.60.0.0/16\n"}, 'inet6': {'cn': "2001:250::/35\n"}}
+        self.failing = set()
+        self.requests = []
+        ipdeny = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                family, name = self.path.strip('/').split('/')
+                code = name[:-len('.zone')]
+                ipdeny.requests.append((self.path, self.headers.get('If-None-Match')))
+                if code in ipdeny.failing:
+                    self.send_response(500)
+                    self.end_headers()
+                    return
+                body = ipdeny.zones[family].get(code)
+                if body is None:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                etag = f'"{hashlib.sha256(body.encode()).hexdigest()[:16]}"'
+                if self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body.encode())
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        base = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.urls = {'inet': f"{base}/inet", 'inet6': f"{base}/inet6"}
+
+
+@pytest.fixture
+def ipdeny():
+    server = Ipdeny()
+    yield server
+    server.server.shutdown()
+    server.server.server_close()
+
+
+@pytest.fixture
+def source(ipdeny, tmp_path):
+    downloads = []
+    source = IpdenySource(str(tmp_path / "ipdeny"), urls=ipdeny.urls, workers=4, on_download=downloads.append)
+    source.downloads = downloads
+    return source
+
+
+def test_fetch_downloads_only_the_selected_countries(ipdeny, source):
+    source.fetch(['CN'])
+
+    assert sorted(path for path, _ in ipdeny.requests) == ['/inet/cn.zone', '/inet6/cn.zone']
+    assert source.compile(['CN'], 'inet') == ['1.0.1.0/24', '1.0.2.0/23']
+    assert source.compile(['CN'], 'inet6') == ['2001:250::/35']
+    assert source.downloads == [len("1.0.1.0/24\n1.0.2.0/23\n") + len("2001:250::/35\n")]
+
+
+def test_a_country_without_allocations_has_an_empty_zone(ipdeny, source):
+    source.fetch(['RU'])
+
+    assert source.compile(['RU'], 'inet6') == []
+    assert not source.open('inet6').has('RU')
+
+
+def test_an_unchanged_zone_is_revalidated_with_its_etag(ipdeny, source):
+    source.fetch(['CN'])
+    path = source.path('inet', 'CN')
+    mtime = os.stat(path).st_mtime_ns
+    version = source.version('inet', ['CN'])
+    ipdeny.requests.clear()
+
+    source.fetch(['CN'])
+
+    assert all(etag is not None for _, etag in ipdeny.requests) and len(ipdeny.requests) == 2
+    assert source.downloads[-1] == 0
+    assert os.stat(path).st_mtime_ns == mtime
+    assert source.version('inet', ['CN']) == version
+
+
+def test_a_changed_zone_replaces_the_cached_copy(ipdeny, source):
+    source.fetch(['CN'])
+    version = source.version('inet', ['CN'])
+    ipdeny.zones['inet']['cn'] = "1.0.1.0/24\n"
+
+    source.fetch(['CN'])
+
+    assert source.compile(['CN'], 'inet') == ['1.0.1.0/24']
+    assert source.version('inet', ['CN']) != version
+
+
+def test_cached_zones_are_not_fetched_again_without_refresh(ipdeny, source):
+    source.fetch(['CN'])
+    ipdeny.requests.clear()
+
+    source.fetch(['CN', 'RU'], refresh=False)
+
+    assert sorted(path for path, _ in ipdeny.requests) == ['/inet/ru.zone', '/inet6/ru.zone']
+
+
+def test_a_failed_country_keeps_its_cached_zone(ipdeny, source):
+    source.fetch(['CN', 'RU'])
+    version = source.version('inet', ['CN'])
+    ipdeny.zones['inet']['cn'] = "1.0.1.0/24\n"
+    ipdeny.zones['inet']['ru'] = "5.3.0.0/22\n"
+    ipdeny.failing.add('cn')
+
+    source.fetch(['CN', 'RU'])
+
+    assert source.compile(['CN'], 'inet') == ['1.0.1.0/24', '1.0.2.0/23']
+    assert source.version('inet', ['CN']) == version
+    assert source.compile(['RU'], 'inet') == ['5.3.0.0/22']
+
+
+def test_a_failed_country_without_a_cached_zone_fails_the_fetch(ipdeny, source):
+    ipdeny.failing.add('ru')
+
+    with pytest.raises(requests.HTTPError):
+        source.fetch(['CN', 'RU'])
+    assert source.compile(['CN'], 'inet') == ['1.0.1.0/24', '1.0.2.0/23']
@@ -1,34 +1,99 @@
 import os
 import zipfile
-import sqlite3
 import csv
-from flask import Flask, request, render_template_string, redirect, url_for, jsonify
-from subprocess import run, CalledProcessError, check_output, Popen, PIPE
-import netaddr
-from updater import update
+import sqlite3
+from flask import Flask, Response, request, render_template, render_template_string, redirect, url_for, jsonify, stream_with_context
+import ipaddress
+from updater import apply_whitelist, get_setting, get_set_sizes, load_state_meta, get_country_counters, get_set_layout, get_backend, INDEX_PATH, STATE_DIR, DEFAULT_BACKEND, SET_LAYOUTS, DEFAULT_SET_LAYOUT, DATA_SOURCES, DEFAULT_DATA_SOURCE, SELECTION_MODES, DEFAULT_SELECTION_MODE, PHASES, RUN_KINDS, create_update_runs
+from firewall import BACKENDS, ENFORCEMENT_POINTS, DEFAULT_ENFORCEMENT_POINT
+from rangeindex import RangeIndex
+from jobs import JobManager, run_job, FULL_UPDATE, HOT_APPLY, VERIFY, WHITELIST, ROLLBACK
+from lookup import IpLookup, parse_ips
+from daemon import control
+import db
+from db import query, transaction
 import re
+import json
 import time
-from threading import Thread
+import hashlib
 from datetime import datetime
 
 app = Flask(__name__)
-DATABASE = 'app.db'
-DB_URL = 'http://www.ipdeny.com/ipblocks/data/countries'
-CIDR_PATTERN = re.compile(r'^((25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.){3}(25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\/(3[0-2]|[12][0-9]|[0-9])$')
-update_completed = False
-
-os.chdir("/opt/hosting/geoblock/")
-CRON_JOB = '0 5 1,15 * * /usr/bin/python3 /opt/hosting/geoblock/updater.py'
+INTERFACE_PATTERN = re.compile(r'^[A-Za-z0-9_.:@-]{1,15}$')
+update_jobs = JobManager(run_job)
+ip_lookup = IpLookup()
+# Seconds between progress checks of a job streamed over /jobs/<id>/events
+JOB_EVENT_INTERVAL = 0.5
+# Upper bounds in seconds of the update duration histogram on /metrics
+DURATION_BUCKETS = [1, 5, 15, 30, 60, 120, 300, 600, 1800]
+# Drop rates are measured against a counter sample at least this many seconds old
+COUNTER_SAMPLE_INTERVAL = 10
+counter_sample = (None, {})
+
+GEOBLOCK_HOME = os.environ.get("GEOBLOCK_HOME", "/opt/hosting/geoblock/")
+os.chdir(GEOBLOCK_HOME)
+# Last rendered index page as (etag, html)
+page_cache = (None, None)
+# Daemon status as (time.monotonic() when fetched, status), reused for DAEMON_STATUS_TTL seconds
+DAEMON_STATUS_TTL = 2.0
+daemon_status_cache = (None, None)
 
 def is_valid_cidr(cidr):
-    return CIDR_PATTERN.match(cidr) is not None
-
-def cron_job_exists():
+    """Accept IPv4 and IPv6 addresses and networks; host bits are masked off by ipset and nftables."""
     try:
-        result = run(['crontab', '-l'], capture_output=True, text=True, check=True)
-        return CRON_JOB in result.stdout
-    except CalledProcessError as e:
+        ipaddress.ip_network(cidr, strict=False)
+    except ValueError:
         return False
+    return True
+
+def daemon_status():
+    """Return the status of the running daemon, or None when it is not running.
+
+    Answers from a copy up to DAEMON_STATUS_TTL seconds old, so page loads and polling do not
+    each cost a round trip to the daemon."""
+    global daemon_status_cache
+    fetched_at, status = daemon_status_cache
+    if fetched_at is not None and time.monotonic() - fetched_at < DAEMON_STATUS_TTL:
+        return status
+    try:
+        status = control('status')
+    except (OSError, ValueError):
+        status = None
+    daemon_status_cache = (time.monotonic(), status)
+    return status
+
+def submit_job(kind=FULL_UPDATE, **arguments):
+    """Queue an update in the daemon, or in this process when no daemon is running; returns its progress.
+
+    A daemon that is slow to answer is still running and still applying, so only a missing or
+    refused socket falls back here. Both sides take updater.LOCK_PATH before changing the firewall."""
+    try:
+        reply = control('submit', kind=kind, **arguments)
+    except (FileNotFoundError, ConnectionRefusedError):
+        return update_jobs.submit(kind, **arguments).progress()
+    if reply['status'] != 'ok':
+        raise ValueError(reply['error'])
+    return reply['job']
+
+def sync_whitelist():
+    """Apply the saved whitelist to the allow sets right away, without rebuilding any block set.
+
+    Runs under updater.LOCK_PATH like every other change of the firewall. While an update holds
+    the lock, or before anything was applied, a whitelist job does it after the running one."""
+    try:
+        if apply_whitelist(blocking=False):
+            return
+    except BlockingIOError:
+        print("An update is running, queueing the whitelist change behind it.")
+    submit_job(WHITELIST)
+
+def get_job_progress(job_id):
+    """Return the progress of a job of the daemon, or of this process when no daemon is running."""
+    try:
+        return control('job', id=job_id).get('job')
+    except (FileNotFoundError, ConnectionRefusedError):
+        job = update_jobs.get(job_id)
+        return job.progress() if job else None
 
 
 #### HTML SECTION ####
@@ -137,21 +202,70 @@ HTML_TEMPLATE = '''
         }
     </style>
     <script>
-        function updateCountryStatus(countryId, checked) {
-            fetch('/update_country_status', {
+        // Checkbox changes are batched and saved as one selection after a short pause
+        const COUNTRY_SAVE_DELAY = 500;
+        let countrySaveTimer = null;
+
+        function updateCountryStatus() {
+            clearTimeout(countrySaveTimer);
+            countrySaveTimer = setTimeout(saveCountrySelection, COUNTRY_SAVE_DELAY);
+        }
+
+        function saveCountrySelection() {
+            const picked = Array.from(document.querySelectorAll('input[id^="country_"]:checked'))
+                .map(checkbox => Number(checkbox.id.slice('country_'.length)));
+            fetch('/countries', {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json'
                 },
-                body: JSON.stringify({ id: countryId, picked: checked })
+                body: JSON.stringify({ picked: picked })
             })
             .then(response => response.json())
             .then(data => {
-                console.log('Country status updated:', data);
+                console.log('Country selection updated:', data.filter(country => country.picked).length, 'picked');
             })
             .catch(error => console.error('Error:', error));
         }
 
+        window.addEventListener('beforeunload', () => {
+            if (countrySaveTimer !== null) {
+                clearTimeout(countrySaveTimer);
+                const picked = Array.from(document.querySelectorAll('input[id^="country_"]:checked'))
+                    .map(checkbox => Number(checkbox.id.slice('country_'.length)));
+                navigator.sendBeacon('/countries', new Blob([JSON.stringify({ picked: picked })], { type: 'application/json' }));
+            }
+        });
+
+        // Per-country drop counters, refreshed while the page is open
+        const DROP_STATS_REFRESH = 10000;
+
+        function refreshDropStats() {
+            fetch('/stats/countries')
+            .then(response => response.json())
+            .then(data => {
+                const table = document.getElementById('dropStatsTable');
+                while (table.rows.length > 1) {
+                    table.deleteRow(1);
+                }
+                document.getElementById('dropStatsNote').textContent = data.layout === 'per_country'
+                    ? '' : 'Per-country drop counters need the per_country set layout (iptables backend, block mode).';
+                for (const country of data.countries) {
+                    const row = table.insertRow();
+                    const rate = country.packets_per_second === null ? '-' : country.packets_per_second.toFixed(2);
+                    for (const value of [`${country.name} (${country.code})`, country.packets, country.bytes, rate]) {
+                        row.insertCell().textContent = value;
+                    }
+                }
+            })
+            .catch(error => console.error('Error:', error));
+        }
+
+        document.addEventListener('DOMContentLoaded', () => {
+            refreshDropStats();
+            setInterval(refreshDropStats, DROP_STATS_REFRESH);
+        });
+
         function addPortRow() {
             const table = document.getElementById('portTable');
             const row = table.insertRow();
@@ -176,7 +290,7 @@ HTML_TEMPLATE = '''
             const cell1 = row.insertCell(0);
             const cell2 = row.insertCell(1);
 
-            cell1.innerHTML = '<input type="text" name="whitelisted_ip[]" placeholder="IP in CIDR format" pattern="^([0-9]{1,3}\.){3}[0-9]{1,3}($|/(16|24|32))$" required>';
+            cell1.innerHTML = '<input type="text" name="whitelisted_ip[]" placeholder="IPv4 or IPv6 address or CIDR" pattern="^[0-9]{1,3}([.][0-9]{1,3}){3}(/([0-9]|[12][0-9]|3[0-2]))?$|^[0-9A-Fa-f:.]*:[0-9A-Fa-f:.]*(/([0-9]|[1-9][0-9]|1[01][0-9]|12[0-8]))?$" required>';
             cell2.innerHTML = '<button type="button" onclick="deleteWhitelistRow(this)">Delete</button>';
         }
 
@@ -190,8 +304,16 @@ HTML_TEMPLATE = '''
     <h1>Country GEOBLOCK. HOSTING SERVER</h1>
     <details>
         <summary style="font-size: 1.5em; font-weight: bold;">Countries list</summary>
+        <form action="/update-settings" method="post">
+            <select name="selection_mode">
+                {% for mode in selection_modes %}
+                <option value="{{ mode }}" {% if mode == selection_mode %}selected{% endif %}>{{ 'Block the picked countries' if mode == 'block' else 'Allow only the picked countries' }}</option>
+                {% endfor %}
+            </select>
+            <input type="submit" value="Save Selection Mode">
+        </form>
         {% for country in countries %}
-            <input type="checkbox" id="country_{{ country[0] }}" name="country_{{ country[0] }}" {% if (country[3] == 1) %}checked{% endif %} onchange="updateCountryStatus({{ country[0] }}, this.checked)"> {{ country[2] }} ({{ country[1] }})<br>
+            <input type="checkbox" id="country_{{ country[0] }}" name="country_{{ country[0] }}" {% if (country[3] == 1) %}checked{% endif %} onchange="updateCountryStatus()"> {{ country[2] }} ({{ country[1] }}){% if country[1] in range_counts %} - {{ range_counts[country[1]] }} ranges{% endif %}<br>
         {% endfor %}
     </details>
     
@@ -206,7 +328,7 @@ HTML_TEMPLATE = '''
             <tr>
                 <td>
                 <input type="text" name="whitelisted_ip[]" value="{{ ip }}" 
-                   pattern="^([0-9]{1,3}\.){3}[0-9]{1,3}($|/(16|24|32))$" required>
+                   pattern="^[0-9]{1,3}([.][0-9]{1,3}){3}(/([0-9]|[12][0-9]|3[0-2]))?$|^[0-9A-Fa-f:.]*:[0-9A-Fa-f:.]*(/([0-9]|[1-9][0-9]|1[01][0-9]|12[0-8]))?$" required>
                    </td>
                 <td><button type="button" onclick="deleteWhitelistRow(this)">Delete</button></td>
             </tr>
@@ -248,27 +370,78 @@ HTML_TEMPLATE = '''
     <form action="/update_now" method="post">
         <input type="submit" value="Update Now">
     </form>
+    <form action="/verify" method="post">
+        <input type="submit" value="Verify Rules">
+    </form>
     <form action="/install_schedule" method="post">
         <input type="submit" value="Install Schedule">
     </form>
     <form action="/remove_schedule" method="post">
         <input type="submit" value="Remove Schedule">
     </form>
+    <form action="/rollback" method="post" onsubmit="return confirm('Restore the block sets from the previous snapshot? A snapshot taken with the other set layout is restored in that layout until the next update.');">
+        <input type="submit" value="Roll Back Rules">
+    </form>
+    <form action="/update-settings" method="post">
+        <select name="firewall_backend">
+            {% for backend in backends %}
+            <option value="{{ backend }}" {% if backend == firewall_backend %}selected{% endif %}>{{ backend }}</option>
+            {% endfor %}
+        </select>
+        <input type="submit" value="Save Firewall Backend">
+    </form>
+    <form action="/update-settings" method="post">
+        <select name="set_layout">
+            {% for layout in set_layouts %}
+            <option value="{{ layout }}" {% if layout == set_layout %}selected{% endif %}>{{ layout }}</option>
+            {% endfor %}
+        </select>
+        <input type="submit" value="Save Set Layout">
+    </form>
+    <form action="/update-settings" method="post">
+        <select name="enforcement_point">
+            {% for point in enforcement_points %}
+            <option value="{{ point }}" {% if point == enforcement_point %}selected{% endif %}>{{ point }}</option>
+            {% endfor %}
+        </select>
+        <input type="text" name="enforcement_interfaces" value="{{ enforcement_interfaces }}" placeholder="Ingress interfaces, e.g. eth0,eth1">
+        <input type="submit" value="Save Enforcement Point">
+    </form>
+    <form action="/update-settings" method="post">
+        <select name="data_source">
+            {% for source in data_sources %}
+            <option value="{{ source }}" {% if source == data_source %}selected{% endif %}>{{ source }}</option>
+            {% endfor %}
+        </select>
+        <input type="submit" value="Save Data Source">
+    </form>
+
+    <h2>Drop Statistics</h2>
+    <p id="dropStatsNote"></p>
+    <table id="dropStatsTable">
+        <tr>
+            <th>Country</th>
+            <th>Dropped packets</th>
+            <th>Dropped bytes</th>
+            <th>Packets/s</th>
+        </tr>
+    </table>
 
     <h2>System Info</h2>
     <p>{{ date_info }}</p>
-    <p>{{ cron_info }}</p>
+    <p>{{ schedule_info }}</p>
+    <p>{{ drift_info }}</p>
 </body>
 </html>
 
 '''
+INDEX_TEMPLATE = app.jinja_env.from_string(HTML_TEMPLATE)
 
 #### DATABASE SECTION ####
 
 def populate_countries():
     """Populate the countries table with sample data."""
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
+    with transaction() as cursor:
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS countries (
                 id INTEGER PRIMARY KEY,
@@ -370,115 +543,277 @@ def populate_countries():
             (90, 'ZM', 'Zambia', False)
         ]
         cursor.executemany('INSERT OR IGNORE INTO countries (id, code, name, picked) VALUES (?, ?, ?, ?)', countries)
-        conn.commit()
 
 def init_db():
     """Initialize the SQLite database."""
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
+    with transaction() as cursor:
         cursor.execute('''CREATE TABLE IF NOT EXISTS countries (id INTEGER PRIMARY KEY, code TEXT, name TEXT, picked BOOLEAN)''')
         cursor.execute('''CREATE TABLE IF NOT EXISTS whitelisted_ips (id INTEGER PRIMARY KEY, cidr TEXT)''')
         cursor.execute('''CREATE TABLE IF NOT EXISTS port_rules (id INTEGER PRIMARY KEY, port_number INTEGER, protocol TEXT)''')
         cursor.execute('''CREATE TABLE IF NOT EXISTS system_info (last_update_date DATETIME)''')
-        conn.commit()
+        cursor.execute('''CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT)''')
+        create_update_runs(cursor)
     populate_countries()
 
 def get_countries():
     """Fetch the list of countries and their statuses."""
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM countries')
-        return cursor.fetchall()
+    return query('SELECT * FROM countries')
 
 def get_whitelisted_ips():
     """Fetch the list of whitelisted IPs."""
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        cursor.execute('SELECT cidr FROM whitelisted_ips')
-        return [row[0] for row in cursor.fetchall()]
+    return [row[0] for row in query('SELECT cidr FROM whitelisted_ips')]
 
 def add_ip_to_whitelist(cidr):
     """Add CIDR to the database."""
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
+    with transaction() as cursor:
         cursor.execute('INSERT INTO whitelisted_ips (cidr) VALUES (?)', (cidr,))
-        conn.commit()
+
+def set_picked_countries(country_ids):
+    """Replace the whole country selection in one transaction."""
+    with transaction() as cursor:
+        cursor.execute('UPDATE countries SET picked = 0 WHERE picked')
+        cursor.executemany('UPDATE countries SET picked = 1 WHERE id = ?', [(country_id,) for country_id in country_ids])
 
 def get_port_rules():
     """Fetch the list of port rules."""
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM port_rules')
-        return cursor.fetchall()
+    return query('SELECT * FROM port_rules')
+
+def get_range_counts():
+    """Fetch the number of IP ranges per country from the compiled range index."""
+    try:
+        index = RangeIndex(INDEX_PATH)
+    except (OSError, ValueError):
+        return {}
+    counts = {code: index.count(code) for code in index.codes}
+    index.close()
+    return counts
+
+def get_update_runs():
+    """Fetch the recorded update and hot-apply runs, oldest first."""
+    try:
+        cursor = db.get_connection().execute('SELECT * FROM update_runs ORDER BY id')
+    except sqlite3.OperationalError:
+        return []
+    columns = [column[0] for column in cursor.description]
+    runs = [dict(zip(columns, row)) for row in cursor.fetchall()]
+    for run in runs:
+        # Runs recorded before hot applies were are all full updates
+        run['kind'] = run.get('kind') or 'update'
+    return runs
+
+def get_drop_stats():
+    """Return per-country drop counters, busiest first, with rates since the last counter sample."""
+    global counter_sample
+    now = time.monotonic()
+    counters = get_country_counters()
+    sampled_at, previous = counter_sample
+    elapsed = now - sampled_at if sampled_at is not None else 0
+    names = dict(query('SELECT code, name FROM countries'))
+    stats = []
+    for code, (packets, bytes_) in sorted(counters.items(), key=lambda item: (-item[1][0], item[0])):
+        before = previous.get(code)
+        # Counters restart when a country's set is re-added
+        measured = before is not None and elapsed > 0 and packets >= before[0]
+        stats.append({
+            'code': code,
+            'name': names.get(code, code),
+            'packets': packets,
+            'bytes': bytes_,
+            'packets_per_second': round((packets - before[0]) / elapsed, 3) if measured else None,
+            'bytes_per_second': round((bytes_ - before[1]) / elapsed, 3) if measured else None,
+        })
+    if sampled_at is None or elapsed >= COUNTER_SAMPLE_INTERVAL:
+        counter_sample = (now, counters)
+    return stats
+
+def render_metrics():
+    """Render update history and set sizes in the Prometheus text exposition format."""
+    runs = get_update_runs()
+    lines = [
+        '# HELP geoblock_update_runs_total Recorded full update and hot-apply runs by result.',
+        '# TYPE geoblock_update_runs_total counter',
+    ]
+    for kind in RUN_KINDS:
+        for result, success in (('success', 1), ('failure', 0)):
+            count = sum(1 for run in runs if run['kind'] == kind and run['success'] == success)
+            lines.append(f'geoblock_update_runs_total{{kind="{kind}",result="{result}"}} {count}')
+
+    lines += [
+        '# HELP geoblock_update_duration_seconds Wall time of full update and hot-apply runs.',
+        '# TYPE geoblock_update_duration_seconds histogram',
+    ]
+    for kind in RUN_KINDS:
+        durations = [run['duration'] for run in runs if run['kind'] == kind]
+        for bucket in DURATION_BUCKETS:
+            lines.append(f'geoblock_update_duration_seconds_bucket{{kind="{kind}",le="{bucket}"}} {sum(1 for d in durations if d <= bucket)}')
+        lines.append(f'geoblock_update_duration_seconds_bucket{{kind="{kind}",le="+Inf"}} {len(durations)}')
+        lines.append(f'geoblock_update_duration_seconds_sum{{kind="{kind}"}} {sum(durations)}')
+        lines.append(f'geoblock_update_duration_seconds_count{{kind="{kind}"}} {len(durations)}')
+
+    updates = [run for run in runs if run['kind'] == 'update']
+    if updates:
+        last = updates[-1]
+        lines += [
+            '# HELP geoblock_last_update_success Whether the last update run succeeded.',
+            '# TYPE geoblock_last_update_success gauge',
+            f'geoblock_last_update_success {int(bool(last["success"]))}',
+            '# HELP geoblock_last_update_timestamp_seconds Start time of the last update run.',
+            '# TYPE geoblock_last_update_timestamp_seconds gauge',
+            f'geoblock_last_update_timestamp_seconds {datetime.fromisoformat(last["started_at"]).timestamp()}',
+            '# HELP geoblock_last_update_phase_seconds Exclusive wall time of each phase of the last update run.',
+            '# TYPE geoblock_last_update_phase_seconds gauge',
+        ]
+        lines += [f'geoblock_last_update_phase_seconds{{phase="{phase}"}} {last[f"{phase}_seconds"]}' for phase in PHASES]
+        for counter, help_text in (('rows_scanned', 'Database ranges read for the selected countries'),
+                                   ('entries_loaded', 'Set entries written to the firewall'),
+                                   ('bytes_downloaded', 'Database bytes downloaded')):
+            lines += [
+                f'# HELP geoblock_last_update_{counter} {help_text} by the last update run.',
+                f'# TYPE geoblock_last_update_{counter} gauge',
+                f'geoblock_last_update_{counter} {last[counter]}',
+            ]
+
+    lines += [
+        '# HELP geoblock_set_entries Entries in each block set as of the last apply.',
+        '# TYPE geoblock_set_entries gauge',
+    ]
+    lines += [f'geoblock_set_entries{{set="{name}"}} {entries}' for name, entries in sorted(get_set_sizes().items())]
+
+    drift = load_state_meta().get('drift')
+    if drift is not None:
+        lines += [
+            '# HELP geoblock_drift Whether the last drift check found the kernel out of line with the last apply (0 ok, 1 repaired, 2 unrepaired).',
+            '# TYPE geoblock_drift gauge',
+            f'geoblock_drift {["ok", "repaired", "drifted"].index(drift["status"])}',
+            '# HELP geoblock_drift_checked_timestamp_seconds Time of the last drift check.',
+            '# TYPE geoblock_drift_checked_timestamp_seconds gauge',
+            f'geoblock_drift_checked_timestamp_seconds {datetime.fromisoformat(drift["checked_at"]).timestamp()}',
+        ]
+
+    counters = get_country_counters()
+    if counters:
+        for index, (counter, help_text) in enumerate((('packets', 'Packets'), ('bytes', 'Bytes'))):
+            lines += [
+                f'# HELP geoblock_country_dropped_{counter}_total {help_text} dropped per country since its set was added.',
+                f'# TYPE geoblock_country_dropped_{counter}_total counter',
+            ]
+            lines += [f'geoblock_country_dropped_{counter}_total{{country="{code}"}} {values[index]}' for code, values in sorted(counters.items())]
+    return '\n'.join(lines) + '\n'
 
 @app.route('/save_whitelist', methods=['POST'])
 def save_whitelist():
-    whitelisted_ips = request.form.getlist('whitelisted_ip[]')
+    whitelisted_ips = [ip.strip() for ip in request.form.getlist('whitelisted_ip[]')]
 
     for ip in whitelisted_ips:
-        if not netaddr.valid_ipv4_cidr(ip):
+        if not is_valid_cidr(ip):
             print(f"Invalid CIDR Format: {ip}")
             return f"Invalid CIDR format: {ip}", 400
 
-        with sqlite3.connect(DATABASE) as conn:
-            cursor = conn.cursor()
+        with transaction() as cursor:
             cursor.execute('SELECT cidr FROM whitelisted_ips WHERE cidr = ?', (ip,))
             result = cursor.fetchone()
             if result is None:
                 cursor.execute('INSERT INTO whitelisted_ips (cidr) VALUES (?)', (ip,))
-                conn.commit()
-
-        iptables_check = run(['iptables', '-C', 'INPUT', '-s', ip, '-j', 'ACCEPT'], capture_output=True, text=True)
-        if iptables_check.returncode != 0:
-            run(['iptables', '-A', 'INPUT', '-s', ip, '-j', 'ACCEPT'])
 
+    sync_whitelist()
     return redirect(url_for('index'))
 
 
 #### FLASK SECTION ####
 
-@app.route('/')
-def index():
+@app.teardown_appcontext
+def release_db_connection(exception=None):
+    """Each request runs on a new thread; its app.db connection goes back to the pool for the next one."""
+    db.release_connection()
+
+def page_etag(status):
+    """ETag of the index page, derived from everything it shows without querying the database.
+
+    In-process writes bump db.write_generation. Writes by a separate updater process show up
+    in the stat of app.db and its WAL, a new range index in the stat of INDEX_PATH and a
+    drift check in the stat of state.json. `status` is the daemon_status() fetched once for
+    the request and passed on to render_index()."""
+    files = []
+    for path in (db.DATABASE, db.DATABASE + '-wal', INDEX_PATH, os.path.join(STATE_DIR, "state.json")):
+        try:
+            stat = os.stat(path)
+            files.append((stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            files.append(None)
+    version = repr((db.write_generation, files, status and (status['schedule_enabled'], status['next_run'], status['failures'])))
+    return hashlib.sha1(version.encode()).hexdigest()
+
+def render_index(status):
     countries = get_countries()
     whitelisted_ips = get_whitelisted_ips()
     port_rules = get_port_rules()
-
-    cron_info = "Cron job info: " + ("Set" if cron_job_exists() else "Not set")
+    range_counts = get_range_counts()
+
+    if status is None:
+        enabled = get_setting('schedule_enabled', '1') == '1'
+        schedule_info = f"Schedule: {'on' if enabled else 'off'}, but the daemon is not running (start it with sudo python3 daemon.py, or at boot after sudo python3 daemon.py --install)"
+    elif status['next_run'] is None:
+        schedule_info = "Schedule: not set"
+    else:
+        schedule_info = f"Schedule: next update {datetime.fromtimestamp(status['next_run']).strftime('%B %d, %Y, %I:%M %p')}"
+        if status['failures']:
+            schedule_info += f" (retry after {status['failures']} failed runs)"
     date_info = "Last set date: "
 
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        cursor.execute('SELECT last_update_date FROM system_info')
-        result = cursor.fetchone()
-        last_update_date = datetime.fromisoformat(result[0]).strftime("%B %d, %Y, %I:%M %p") if result else "NONE"
-            
-        date_info += str(last_update_date)
+    result = query('SELECT last_update_date FROM system_info')
+    last_update_date = datetime.fromisoformat(result[0][0]).strftime("%B %d, %Y, %I:%M %p") if result else "NONE"
+    date_info += str(last_update_date)
+
+    drift = load_state_meta().get('drift')
+    if drift is None:
+        drift_info = "Drift check: not run yet"
+    else:
+        checked_at = datetime.fromisoformat(drift['checked_at']).strftime("%B %d, %Y, %I:%M %p")
+        drift_info = {'ok': "Drift check: kernel matches the last apply", 'repaired': "Drift check: repaired",
+                      'drifted': "Drift check: DRIFT"}[drift['status']] + f" ({checked_at})"
+        if drift['problems']:
+            drift_info += ": " + "; ".join(drift['problems'])
     
-    return render_template_string(HTML_TEMPLATE, countries=countries, cron_info=cron_info, date_info=date_info, port_rules=port_rules, whitelisted_ips=whitelisted_ips)
+    return render_template(INDEX_TEMPLATE, countries=countries, schedule_info=schedule_info, drift_info=drift_info, date_info=date_info, port_rules=port_rules, whitelisted_ips=whitelisted_ips, range_counts=range_counts, backends=list(BACKENDS), firewall_backend=get_setting('firewall_backend', DEFAULT_BACKEND), set_layouts=SET_LAYOUTS, set_layout=get_setting('set_layout', DEFAULT_SET_LAYOUT), enforcement_points=ENFORCEMENT_POINTS, enforcement_point=get_setting('enforcement_point', DEFAULT_ENFORCEMENT_POINT), enforcement_interfaces=get_setting('enforcement_interfaces', ''), data_sources=DATA_SOURCES, data_source=get_setting('data_source', DEFAULT_DATA_SOURCE), selection_modes=SELECTION_MODES, selection_mode=get_setting('selection_mode', DEFAULT_SELECTION_MODE))
+
+@app.route('/')
+def index():
+    global page_cache
+    status = daemon_status()
+    etag = page_etag(status)
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        cached_etag, html = page_cache
+        if cached_etag != etag:
+            html = render_index(status)
+            page_cache = (etag, html)
+        response = Response(html, mimetype='text/html')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
 
 
 @app.route('/update-whitelist', methods=['POST'])
 def update_whitelist():
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-
+    whitelisted_ips = [ip.strip() for ip in request.form.getlist('whitelisted_ip[]')]
+    invalid = [ip for ip in whitelisted_ips if not is_valid_cidr(ip)]
+    if invalid:
+        # Rejected as a whole, so a bad row never silently drops from the saved whitelist
+        return f"Invalid CIDR format: {', '.join(invalid)}", 400
+    with transaction() as cursor:
         cursor.execute('DELETE FROM whitelisted_ips')
-        whitelisted_ips = request.form.getlist('whitelisted_ip[]')
-        valid_ips = [ip for ip in whitelisted_ips if is_valid_cidr(ip)]
-
-        for ip in valid_ips:
+        for ip in whitelisted_ips:
             cursor.execute('INSERT INTO whitelisted_ips (cidr) VALUES (?)', (ip,))
-        print(f"Valid whitelisted IPs: {valid_ips}")
-
-        conn.commit()
+        print(f"Valid whitelisted IPs: {whitelisted_ips}")
 
+    sync_whitelist()
     return redirect(url_for('index'))
 
 
 @app.route('/update-ports', methods=['POST'])
 def update_ports():
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
+    with transaction() as cursor:
         port_numbers = request.form.getlist('port_number[]')
         protocols = request.form.getlist('protocol[]')
 
@@ -488,99 +823,194 @@ def update_ports():
         for port_number, protocol in zip(port_numbers, protocols):
             cursor.execute('INSERT INTO port_rules (port_number, protocol) VALUES (?, ?)', (port_number, protocol))
 
-        conn.commit()
-
     return redirect(url_for('index'))
 
 
-def run_update():
-    global update_completed
-    update_completed = False
-    update()
-    print("Updated! Setting update_completed as True!")
-    update_completed = True
+@app.route('/update-settings', methods=['POST'])
+def update_settings():
+    keys = ('firewall_backend', 'set_layout', 'enforcement_point', 'enforcement_interfaces', 'data_source', 'selection_mode')
+    settings = {key: request.form[key].strip() for key in keys if key in request.form}
+    if not settings:
+        return "No settings given", 400
+    if settings.get('firewall_backend', DEFAULT_BACKEND) not in BACKENDS:
+        return f"Unknown firewall backend: {settings['firewall_backend']}", 400
+    if settings.get('set_layout', DEFAULT_SET_LAYOUT) not in SET_LAYOUTS:
+        return f"Unknown set layout: {settings['set_layout']}", 400
+    if settings.get('data_source', DEFAULT_DATA_SOURCE) not in DATA_SOURCES:
+        return f"Unknown data source: {settings['data_source']}", 400
+    if settings.get('selection_mode', DEFAULT_SELECTION_MODE) not in SELECTION_MODES:
+        return f"Unknown selection mode: {settings['selection_mode']}", 400
+    if settings.get('enforcement_point', DEFAULT_ENFORCEMENT_POINT) not in ENFORCEMENT_POINTS:
+        return f"Unknown enforcement point: {settings['enforcement_point']}", 400
+    interfaces = settings.get('enforcement_interfaces', '').replace(',', ' ').split()
+    if not all(INTERFACE_PATTERN.match(interface) for interface in interfaces):
+        return f"Invalid interface name in: {settings['enforcement_interfaces']}", 400
+    if 'enforcement_interfaces' in settings:
+        settings['enforcement_interfaces'] = ','.join(interfaces)
+
+    # Ingress hooks only exist in nftables and need at least one interface
+    backend = settings.get('firewall_backend') or get_setting('firewall_backend', DEFAULT_BACKEND)
+    point = settings.get('enforcement_point') or get_setting('enforcement_point', DEFAULT_ENFORCEMENT_POINT)
+    if 'enforcement_interfaces' not in settings:
+        interfaces = get_setting('enforcement_interfaces', '').replace(',', ' ').split()
+    if point == 'ingress' and (backend != 'nftables' or not interfaces):
+        return "Ingress enforcement needs the nftables backend and at least one interface", 400
+
+    with transaction() as cursor:
+        cursor.executemany('INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)', settings.items())
+
+    return redirect(url_for('index'))
+
 
-@app.route('/task_status', methods=['GET'])
-def task_status():
-    global update_completed
-    return jsonify({'completed': update_completed})
+@app.route('/jobs/<int:job_id>', methods=['GET'])
+def job_status(job_id):
+    progress = get_job_progress(job_id)
+    if progress is None:
+        return {'error': f"Unknown job: {job_id}"}, 404
+    return jsonify(progress)
+
+@app.route('/jobs/<int:job_id>/events')
+def job_events(job_id):
+    """Stream the job's progress as Server-Sent Events until it finishes."""
+    if get_job_progress(job_id) is None:
+        return {'error': f"Unknown job: {job_id}"}, 404
+
+    def events():
+        sent = None
+        while True:
+            progress = get_job_progress(job_id)
+            if progress is None:
+                return
+            if progress != sent:
+                yield f"data: {json.dumps(progress)}\n\n"
+                sent = progress
+            if progress['state'] in ('done', 'failed'):
+                return
+            time.sleep(JOB_EVENT_INTERVAL)
+
+    return Response(stream_with_context(events()), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
 
 @app.route('/update_now', methods=['POST'])
 def update_now():
-    thread = Thread(target=run_update)
-    thread.start()
-    return redirect(url_for('update_status'))
+    job = submit_job()
+    return redirect(url_for('update_status', job_id=job['id']))
 
-@app.route('/update_status')
-def update_status():
+@app.route('/verify', methods=['POST'])
+def verify_now():
+    job = submit_job(VERIFY)
+    return redirect(url_for('update_status', job_id=job['id']))
+
+@app.route('/update_status/<int:job_id>')
+def update_status(job_id):
     return render_template_string('''
         <html>
         <body>
-            <h1>Update in progress...</h1>
-            <p>The update process has started. Please wait.</p>
+            <h1 id="title">Update in progress...</h1>
+            <p>Update job #{{ job_id }}: <span id="state">queued</span></p>
+            <ul>
+                <li>Phase: <span id="phase">-</span></li>
+                <li>Rows parsed: <span id="rows_parsed">0</span></li>
+                <li>Entries applied: <span id="entries_applied">0</span></li>
+                <li>Bytes downloaded: <span id="bytes_downloaded">0</span></li>
+                <li>Result: <span id="result">-</span></li>
+            </ul>
+            <p id="error" style="color: red;"></p>
             <script>
-                function checkStatus() {
-                    console.log("Fetching task_status...")
-                    fetch('/task_status')
-                        .then(response => response.json())
-                        .then(data => {
-                            console.log("Data: ", data)
-                            if (data.completed) {
-                                setTimeout(() => window.location.href = "{{ url_for('index') }}", 2000);
-                            } else {
-                                setTimeout(checkStatus, 2000);
-                            }
-                        });
-                }
-                checkStatus();
+                const source = new EventSource("{{ url_for('job_events', job_id=job_id) }}");
+                source.onmessage = (event) => {
+                    const job = JSON.parse(event.data);
+                    for (const field of ['state', 'phase', 'rows_parsed', 'entries_applied', 'bytes_downloaded', 'result']) {
+                        document.getElementById(field).textContent = job[field] ?? '-';
+                    }
+                    if (job.state === 'done') {
+                        source.close();
+                        document.getElementById('title').textContent = 'Update finished';
+                        setTimeout(() => window.location.href = "{{ url_for('index') }}", 2000);
+                    } else if (job.state === 'failed') {
+                        source.close();
+                        document.getElementById('title').textContent = 'Update failed';
+                        document.getElementById('error').textContent = job.error;
+                    }
+                };
             </script>
         </body>
         </html>
-    ''')
+    ''', job_id=job_id)
+
+@app.route('/rollback', methods=['POST'])
+def rollback_rules():
+    """Queue a restore of the block sets from a snapshot, by default the previous one.
+
+    The rollback runs as a job after whatever is running; JSON clients get its id to follow
+    on /jobs/<id>/events, where the restored snapshot is the job's result."""
+    job = submit_job(ROLLBACK, snapshot=request.values.get('snapshot') or None)
+    if request.is_json:
+        return {'status': 'queued', 'job': job['id']}, 202
+    return redirect(url_for('update_status', job_id=job['id']))
+
+@app.route('/lookup', methods=['GET', 'POST'])
+def lookup_ips():
+    """Look up IPs given as ?ip=..., a JSON {"ips": [...]}, an uploaded file or a plain-text body.
+
+    Uploaded files and text bodies may be IP lists or access logs; the first field of each line is used."""
+    ips = request.args.getlist('ip')
+    if request.method == 'POST':
+        if request.is_json:
+            ips += (request.get_json(silent=True) or {}).get('ips', [])
+        elif 'file' in request.files:
+            ips += parse_ips(request.files['file'].read().decode('utf-8', 'replace').splitlines())
+        else:
+            ips += parse_ips(request.get_data(as_text=True).splitlines())
+    if not ips:
+        return {'error': "No IPs given"}, 400
+
+    started = time.perf_counter()
+    results = ip_lookup.lookup([str(ip) for ip in ips])
+    return jsonify({'results': results, 'elapsed_ms': round((time.perf_counter() - started) * 1000, 3)})
+
+@app.route('/metrics')
+def metrics():
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/stats/countries')
+def country_stats():
+    """Per-country drop counters and rates as JSON; empty unless the per_country set layout is active."""
+    return jsonify({'layout': get_set_layout(get_backend()), 'countries': get_drop_stats()})
+
+def set_schedule(enabled):
+    """Turn the daemon's scheduled updates on or off; a running daemon picks the setting up from app.db, a stopped one when it starts."""
+    with transaction() as cursor:
+        cursor.execute('INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)', ('schedule_enabled', '1' if enabled else '0'))
+    return redirect(url_for('index'))
 
 @app.route('/install_schedule', methods=['POST'])
 def install_schedule():
-    try:
-        crontab = check_output(['crontab', '-l']).decode('utf-8')
-    except CalledProcessError:
-        crontab = ''
-
-    if CRON_JOB not in crontab:
-        crontab += f'\n{CRON_JOB}\n'
-
-        with Popen(['crontab', '-'], stdin=PIPE) as proc:
-            proc.communicate(input=crontab.encode('utf-8'))
-
-        reboot_job = f'@reboot /usr/bin/python3 /opt/hosting/geoblock/updater.py\n'
-        with Popen(['crontab', '-'], stdin=PIPE) as proc:
-            proc.communicate(input=(crontab + reboot_job).encode('utf-8'))
-    return redirect(url_for('index'))
+    return set_schedule(True)
 
 @app.route('/remove_schedule', methods=['POST'])
 def remove_schedule():
-    try:
-        crontab = check_output(['crontab', '-l']).decode('utf-8')
-    except CalledProcessError:
-        crontab = ''
-
-    lines = crontab.splitlines()
-    lines = [line for line in lines if line.strip() != CRON_JOB]
-
-    with Popen(['crontab', '-'], stdin=PIPE) as proc:
-        proc.communicate(input='\n'.join(lines).encode('utf-8'))
-    return redirect(url_for('index'))
+    return set_schedule(False)
+
+@app.route('/countries', methods=['GET', 'POST'])
+def countries_selection():
+    if request.method == 'POST':
+        picked = (request.get_json(silent=True) or {}).get('picked')
+        if not isinstance(picked, list) or not all(isinstance(country_id, int) for country_id in picked):
+            return {'error': "Expected a JSON body like {\"picked\": [country ids]}"}, 400
+        set_picked_countries(picked)
+        submit_job(HOT_APPLY)
+    return jsonify([{'id': id, 'code': code, 'name': name, 'picked': bool(picked)} for id, code, name, picked in get_countries()])
 
 @app.route('/update_country_status', methods=['POST'])
 def update_country_status():
     data = request.get_json()
     country_id = data.get('id')
     picked = data.get('picked')
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
+    with transaction() as cursor:
         cursor.execute('UPDATE countries SET picked = ? WHERE id = ?', (picked, country_id))
-        conn.commit()
+    job = submit_job(HOT_APPLY)
 
-    return {'status': 'success'}, 200
+    return {'status': 'success', 'job': job['id']}, 200
 
 if __name__ == '__main__':
     init_db()
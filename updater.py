@@ -1,4 +1,11 @@
 import os
+import io
+import csv
+import json
+import hashlib
+import argparse
+import shutil
+import time
 import subprocess
 import requests
 import zipfile
@@ -6,15 +13,164 @@ import sqlite3
 import struct
 import socket
 import ipaddress
+import fcntl
+import functools
+import threading
+from contextlib import contextmanager
 from datetime import datetime
+from compiler import np, compile_ranges, compile_ranges_np, compile_index_np, merge_ranges, cidrs_to_ranges, cidr_bounds, complement_ranges, subtract_ranges
+from rangeindex import RangeIndex, build_index
+from db import query, transaction
+from sources import IpdenySource
+from snapshots import write_snapshot, prune_snapshots, list_snapshots, load_snapshot, snapshot_digest
+from firewall import (BACKENDS, SET_NAMES, NFT_SETS, IPSET_MIN_MAXELEM, IPTABLES_CHAIN, ENFORCEMENT_POINTS, DEFAULT_ENFORCEMENT_POINT, IptablesBackend, NftablesBackend,
+                      country_set_name, ipset_sizing, canonical_entry, entries_digest, managed_set_family, split_by_family)
 
-ZONE_DIR = "/opt/iptables"
-IPSET_NAME = "GEO_BLOCK"
+ZONE_DIR = os.environ.get("GEOBLOCK_ZONE_DIR", "/opt/iptables")
 DB_URL = "https://download.ip2location.com/lite/IP2LOCATION-LITE-DB1.CSV.ZIP"
-DB_PATH = "/tmp/IP2LOCATION-LITE-DB1.CSV"
+DB_ZIP_PATH = "/tmp/IP2LOCATION-LITE-DB1.CSV.ZIP"
+DB6_URL = "https://download.ip2location.com/lite/IP2LOCATION-LITE-DB1.IPV6.CSV.ZIP"
+DB6_ZIP_PATH = "/tmp/IP2LOCATION-LITE-DB1.IPV6.CSV.ZIP"
+DOWNLOAD_CHUNK_SIZE = 1 << 16
+DOWNLOAD_TIMEOUT = 60
 BACKUP_ZONE_DIR = os.path.join(ZONE_DIR, "backup")
-SQLITE_DB_PATH = "app.db" 
-os.chdir("/opt/hosting/geoblock/")
+STATE_DIR = os.path.join(ZONE_DIR, "state")
+INDEX_PATH = os.path.join(ZONE_DIR, "IP2LOCATION-LITE-DB1.idx")
+INDEX6_PATH = os.path.join(ZONE_DIR, "IP2LOCATION-LITE-DB1.IPV6.idx")
+CIDR_CACHE_DIR = os.path.join(ZONE_DIR, "cidr_cache")
+IPDENY_CACHE_DIR = os.path.join(ZONE_DIR, "ipdeny")
+# IPv4-mapped addresses (::ffff:0:0/96) in the IPv6 database duplicate the IPv4 edition
+IPV4_MAPPED_RANGE = (0xFFFF << 32, (0xFFFF << 32) | 0xFFFFFFFF)
+DELTA_REBUILD_RATIO = 0.5
+APPLY_RATE_DEFAULT = 50000.0
+DEFAULT_BACKEND = "iptables"
+DATA_SOURCES = ['ip2location', 'ipdeny']
+DEFAULT_DATA_SOURCE = "ip2location"
+# merged: one hash:net set per family; per_country: a list:set of per-country sets with drop counters
+SET_LAYOUTS = ['merged', 'per_country']
+DEFAULT_SET_LAYOUT = "merged"
+# block: drop the picked countries; allow: drop every public address outside the picked countries
+SELECTION_MODES = ['block', 'allow']
+DEFAULT_SELECTION_MODE = "block"
+# Allow-only mode blocks the complement of the picked countries within the public unicast space,
+# leaving out the special-purpose ranges (RFC 6890) so local and private traffic still passes
+IPV4_RESERVED = ['0.0.0.0/8', '10.0.0.0/8', '100.64.0.0/10', '127.0.0.0/8', '169.254.0.0/16', '172.16.0.0/12', '192.0.0.0/24',
+                 '192.0.2.0/24', '192.88.99.0/24', '192.168.0.0/16', '198.18.0.0/15', '198.51.100.0/24', '203.0.113.0/24', '224.0.0.0/3']
+IPV6_RESERVED = ['2001:db8::/32', '3fff::/20']
+SNAPSHOT_KEEP_DEFAULT = 20
+SNAPSHOT_MAX_AGE_DAYS_DEFAULT = 30
+FAMILIES = {
+    'inet': {**SET_NAMES['inet'], 'bits': 32, 'url': DB_URL, 'zip': DB_ZIP_PATH, 'index': INDEX_PATH,
+             'space': '0.0.0.0/0', 'reserved': IPV4_RESERVED},
+    'inet6': {**SET_NAMES['inet6'], 'bits': 128, 'url': DB6_URL, 'zip': DB6_ZIP_PATH, 'index': INDEX6_PATH,
+              'space': '2000::/3', 'reserved': IPV6_RESERVED},
+}
+PHASES = ['connectivity', 'backup', 'download', 'parse', 'compile', 'apply']
+UPDATE_RUNS_SCHEMA = f'''CREATE TABLE IF NOT EXISTS update_runs (id INTEGER PRIMARY KEY, started_at DATETIME, duration REAL,
+    success BOOLEAN, error TEXT, backend TEXT, rows_scanned INTEGER, entries_loaded INTEGER, bytes_downloaded INTEGER,
+    {', '.join(f'{phase}_seconds REAL' for phase in PHASES)}, kind TEXT)'''
+# Kinds of recorded runs; rows from before hot applies were recorded have no kind and are full updates
+RUN_KINDS = ['update', 'hot-apply']
+GEOBLOCK_HOME = os.environ.get("GEOBLOCK_HOME", "/opt/hosting/geoblock/")
+os.chdir(GEOBLOCK_HOME)
+# flock()ed while the firewall or the applied state is changed, by the daemon, the UI and updater.py alike
+LOCK_PATH = os.path.join(GEOBLOCK_HOME, "geoblock.lock")
+# A resident process (daemon.py) keeps range indexes and applied sets in memory between runs
+# by setting these to dicts; None opens and reads them on every use
+open_indexes = None
+applied_cache = None
+
+class UpdateRun:
+    """Timings and counters of one update() run; nested phases are timed exclusively."""
+
+    def __init__(self):
+        self.started_at = datetime.now()
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.rows_scanned = 0
+        self.entries_loaded = 0
+        self.bytes_downloaded = 0
+        self.current_phase = None
+        self._stack = []
+
+    @contextmanager
+    def phase(self, name):
+        started = time.monotonic()
+        outer, self.current_phase = self.current_phase, name
+        self._stack.append(0.0)
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - started
+            self.phases[name] += elapsed - self._stack.pop()
+            if self._stack:
+                self._stack[-1] += elapsed
+            self.current_phase = outer
+
+    def record(self, duration, backend, error=None, kind='update'):
+        """Append this run to the update_runs table."""
+        with transaction() as cursor:
+            create_update_runs(cursor)
+            cursor.execute(f'''INSERT INTO update_runs (started_at, duration, success, error, backend, rows_scanned, entries_loaded,
+                bytes_downloaded, {', '.join(f'{phase}_seconds' for phase in PHASES)}, kind) VALUES ({', '.join('?' * (9 + len(PHASES)))})''',
+                (self.started_at.isoformat(), duration, error is None, error, backend, self.rows_scanned, self.entries_loaded,
+                 self.bytes_downloaded, *(self.phases[phase] for phase in PHASES), kind))
+
+def create_update_runs(cursor):
+    """Create the update_runs table, or add the kind column to one from an older version."""
+    cursor.execute(UPDATE_RUNS_SCHEMA)
+    if 'kind' not in {row[1] for row in cursor.execute('PRAGMA table_info(update_runs)').fetchall()}:
+        cursor.execute('ALTER TABLE update_runs ADD COLUMN kind TEXT')
+
+current_run = UpdateRun()
+state_thread_lock = threading.RLock()
+state_lock_depth = 0
+state_lock_file = None
+
+@contextmanager
+def state_lock(blocking=True):
+    """Hold LOCK_PATH, so only one thread of one process changes the firewall and the applied state at a time.
+
+    Re-entrant within a thread, e.g. when a hot apply falls back to a full update. With
+    `blocking` False, raises BlockingIOError instead of waiting for another holder."""
+    global state_lock_depth, state_lock_file
+    if not state_thread_lock.acquire(blocking):
+        raise BlockingIOError(f"{LOCK_PATH} is held by another thread")
+    try:
+        if state_lock_depth == 0:
+            lock_file = open(LOCK_PATH, 'a')
+            if not try_flock(lock_file):
+                if not blocking:
+                    lock_file.close()
+                    raise BlockingIOError(f"{LOCK_PATH} is held by another process")
+                print(f"Waiting for another geoblock process to release {LOCK_PATH}...")
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            state_lock_file = lock_file
+        state_lock_depth += 1
+        try:
+            yield
+        finally:
+            state_lock_depth -= 1
+            if state_lock_depth == 0:
+                # Closing the file releases the flock
+                state_lock_file.close()
+                state_lock_file = None
+    finally:
+        state_thread_lock.release()
+
+def try_flock(lock_file):
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return False
+    return True
+
+def holds_state_lock(function):
+    """Run `function` under state_lock()."""
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with state_lock():
+            return function(*args, **kwargs)
+    return wrapper
 
 def check_internet_access():
     while True:
@@ -29,93 +185,1003 @@ def check_internet_access():
 def timestamp():
     return subprocess.check_output("date +%Y-%m-%d_%H-%M-%S", shell=True).decode().strip()
 
-def backup_existing_rules():
-    if not os.path.exists(BACKUP_ZONE_DIR):
-        os.makedirs(BACKUP_ZONE_DIR, exist_ok=True)
-    subprocess.run(['sudo', 'iptables-save'], stdout=open(os.path.join(BACKUP_ZONE_DIR, f"iptables_{timestamp()}.backup"), 'w'), check=True)
-    subprocess.run(['sudo', 'ipset', 'save'], stdout=open(os.path.join(BACKUP_ZONE_DIR, f"ipset_{timestamp()}.backup"), 'w'), check=True)
-
-def download_and_extract_db():
-    print("Downloading and extracting database ...")
-    response = requests.get(DB_URL, stream=True)
-    with open("/tmp/IP2LOCATION-LITE-DB1.CSV.ZIP", 'wb') as f:
-        f.write(response.content)
-    
-    with zipfile.ZipFile("/tmp/IP2LOCATION-LITE-DB1.CSV.ZIP", 'r') as zip_ref:
-        zip_ref.extractall("/tmp/")
-    print("Database downloaded and extracted.")
-
-def setup_ipset():
-    result = subprocess.run(['sudo', 'ipset', 'list', IPSET_NAME], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    if result.returncode == 0:
-        print("Flushing existing ipset set...")
-        subprocess.run(['sudo', 'ipset', 'flush', IPSET_NAME], check=True)
+def backup_existing_rules(backend):
+    """Snapshot the live rules (skipped when unchanged since the last snapshot) and prune old snapshots."""
+    write_snapshot(BACKUP_ZONE_DIR, backend.name, backend.save(), timestamp())
+    prune_snapshots(BACKUP_ZONE_DIR, int(get_setting('snapshot_keep', SNAPSHOT_KEEP_DEFAULT)),
+                    float(get_setting('snapshot_max_age_days', SNAPSHOT_MAX_AGE_DAYS_DEFAULT)))
+
+def load_download_meta(zip_path=DB_ZIP_PATH):
+    try:
+        with open(zip_path + ".json") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_download_meta(meta, zip_path=DB_ZIP_PATH):
+    with open(zip_path + ".json", 'w') as f:
+        json.dump(meta, f)
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def download_db(url=DB_URL, zip_path=DB_ZIP_PATH):
+    """Download `url` to `zip_path` in chunks, resuming a partial download if one exists.
+
+    Returns True when a new archive was stored, False when upstream is unchanged."""
+    print(f"Downloading database {os.path.basename(zip_path)} ...")
+    meta = load_download_meta(zip_path)
+    part_path = zip_path + ".part"
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    partial = meta.get('partial', {})
+
+    headers = {}
+    if offset and (partial.get('etag') or partial.get('last_modified')):
+        headers['Range'] = f"bytes={offset}-"
+        headers['If-Range'] = partial.get('etag') or partial.get('last_modified')
+    elif os.path.exists(zip_path):
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+    with requests.get(url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+        if response.status_code == 304:
+            print("Database not modified upstream, skipping download.")
+            return False
+        if response.status_code == 416:
+            # Nothing left past the end of the .part file: it is complete when it has the size of the
+            # archive, otherwise it can never be resumed and the download starts over
+            total = response.headers.get('Content-Range', '').rsplit('/', 1)[-1]
+            expected_size = int(total) if total.isdigit() else partial.get('size')
+            if expected_size != offset:
+                print(f"Partial download of {offset} bytes does not match the {expected_size or 'unknown'} byte archive, starting over.")
+                os.remove(part_path)
+                meta.pop('partial', None)
+                save_download_meta(meta, zip_path)
+                return download_db(url, zip_path)
+            print("Partial download is already complete.")
+        else:
+            response.raise_for_status()
+
+            if response.status_code == 206:
+                print(f"Resuming download at byte {offset}.")
+                mode = 'ab'
+                expected_size = int(response.headers['Content-Range'].rsplit('/', 1)[1])
+            else:
+                offset, mode = 0, 'wb'
+                expected_size = int(response.headers.get('Content-Length', 0)) or None
+
+            meta['partial'] = {'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified'), 'size': expected_size}
+            save_download_meta(meta, zip_path)
+
+            with open(part_path, mode) as f:
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+                    current_run.bytes_downloaded += len(chunk)
+
+    size = os.path.getsize(part_path)
+    if expected_size is not None and size != expected_size:
+        raise IOError(f"Incomplete download: got {size} of {expected_size} bytes")
+    try:
+        with zipfile.ZipFile(part_path) as zip_ref:
+            bad_member = zip_ref.testzip()
+    except zipfile.BadZipFile:
+        bad_member = part_path
+    if bad_member is not None:
+        os.remove(part_path)
+        raise IOError(f"Checksum mismatch in downloaded database: {bad_member}")
+
+    sha256 = file_sha256(part_path)
+    unchanged = sha256 == meta.get('sha256') and os.path.exists(zip_path)
+    os.replace(part_path, zip_path)
+    partial = meta.pop('partial')
+    meta.update(etag=partial['etag'], last_modified=partial['last_modified'], sha256=sha256, size=size)
+    save_download_meta(meta, zip_path)
+    if unchanged:
+        print("Downloaded database is identical to the previous one.")
+        return False
+    print(f"Database downloaded ({size} bytes, sha256 {sha256}).")
+    return True
+
+def iter_db_rows(zip_path=DB_ZIP_PATH):
+    """Stream CSV rows straight out of the database archive without extracting it."""
+    with zipfile.ZipFile(zip_path) as zip_ref:
+        member = next(name for name in zip_ref.namelist() if name.upper().endswith('.CSV'))
+        with zip_ref.open(member) as raw:
+            yield from csv.reader(io.TextIOWrapper(raw, encoding='utf-8', newline=''))
+
+def load_state_meta():
+    try:
+        with open(os.path.join(STATE_DIR, "state.json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_state_meta(meta):
+    os.makedirs(STATE_DIR, exist_ok=True)
+    with open(os.path.join(STATE_DIR, "state.json"), 'w') as f:
+        json.dump(meta, f)
+
+def load_applied_set(name):
+    """Return the entries last applied to `name`, or None if no record exists.
+
+    With applied_cache set, the file is only read again when its mtime changed."""
+    path = os.path.join(STATE_DIR, f"{name}.txt")
+    try:
+        mtime = os.stat(path).st_mtime_ns
+        if applied_cache is not None and applied_cache.get(name, (None,))[0] == mtime:
+            return list(applied_cache[name][1])
+        with open(path) as f:
+            entries = [line.strip() for line in f if line.strip()]
+    except OSError:
+        return None
+    if applied_cache is not None:
+        applied_cache[name] = (mtime, entries)
+    return list(entries)
+
+def save_applied_set(name, entries):
+    os.makedirs(STATE_DIR, exist_ok=True)
+    path = os.path.join(STATE_DIR, f"{name}.txt")
+    with open(path + ".tmp", 'w') as f:
+        f.writelines(f"{entry}\n" for entry in entries)
+    os.replace(path + ".tmp", path)
+    if applied_cache is not None:
+        applied_cache[name] = (os.stat(path).st_mtime_ns, list(entries))
+
+def plan_ipset(applied, desired, maxelem):
+    """Return (to_add, to_del, rebuild) needed to move a set from `applied` to `desired`."""
+    if applied is None or len(desired) > maxelem:
+        return list(desired), [], True
+    applied, desired_set = set(applied), set(desired)
+    to_add = [entry for entry in desired if entry not in applied]
+    to_del = sorted(applied - desired_set)
+    rebuild = len(to_add) + len(to_del) > len(desired) * DELTA_REBUILD_RATIO
+    return to_add, to_del, rebuild
+
+def print_plan(name, to_add, to_del, rebuild, apply_rate):
+    changes = len(to_add) + len(to_del)
+    print(f"Plan for {name}: {'full rebuild' if rebuild else 'incremental'}, +{len(to_add)} -{len(to_del)}")
+    print(f"Expected apply time: {changes / apply_rate:.2f}s")
+
+def get_from_db(sql, params=()):
+    return query(sql, params)
+
+def get_setting(key, default=None):
+    try:
+        rows = get_from_db('SELECT value FROM settings WHERE key = ?', (key,))
+    except sqlite3.OperationalError:
+        return default
+    return rows[0][0] if rows else default
+
+def get_enforcement_interfaces():
+    """Return the interfaces of settings.enforcement_interfaces (comma or space separated)."""
+    return get_setting('enforcement_interfaces', '').replace(',', ' ').split()
+
+def get_backend(name=None, runner=None):
+    """Return the configured firewall backend (settings.firewall_backend, iptables by default),
+    enforcing at settings.enforcement_point."""
+    name = name or get_setting('firewall_backend', DEFAULT_BACKEND)
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown firewall backend: {name}")
+    enforcement = get_setting('enforcement_point', DEFAULT_ENFORCEMENT_POINT)
+    if enforcement not in ENFORCEMENT_POINTS:
+        raise ValueError(f"Unknown enforcement point: {enforcement}")
+    kwargs = {'enforcement': enforcement, 'interfaces': get_enforcement_interfaces()}
+    return BACKENDS[name](**kwargs) if runner is None else BACKENDS[name](runner, **kwargs)
+
+def get_set_layout(backend):
+    """Return the configured block set layout (settings.set_layout); only iptables supports per_country,
+    and only when blocking the picked countries."""
+    layout = get_setting('set_layout', DEFAULT_SET_LAYOUT)
+    if layout not in SET_LAYOUTS:
+        raise ValueError(f"Unknown set layout: {layout}")
+    if get_selection_mode() == 'allow':
+        # The complement of a few countries would be nearly every other country's set
+        return DEFAULT_SET_LAYOUT
+    return layout if isinstance(backend, IptablesBackend) else DEFAULT_SET_LAYOUT
+
+def get_selection_mode():
+    """Return whether the picked countries are blocked or are the only ones allowed (settings.selection_mode)."""
+    mode = get_setting('selection_mode', DEFAULT_SELECTION_MODE)
+    if mode not in SELECTION_MODES:
+        raise ValueError(f"Unknown selection mode: {mode}")
+    return mode
+
+def iter_db_ranges(zip_path=DB_ZIP_PATH, bits=32):
+    for row in iter_db_rows(zip_path):
+        start, end = int(row[0]), int(row[1])
+        if bits == 128 and start <= IPV4_MAPPED_RANGE[1] and end >= IPV4_MAPPED_RANGE[0]:
+            continue
+        yield start, end, row[2]
+
+def open_index(family='inet'):
+    """Open the compiled range index, rebuilding it from the archive when it is missing or stale.
+
+    Callers hand the index back with release_index()."""
+    config = FAMILIES[family]
+    sha256 = load_download_meta(config['zip']).get('sha256', '')
+    if open_indexes is not None:
+        index = open_indexes.pop(family, None)
+        if index is not None and index.source == sha256:
+            open_indexes[family] = index
+            return index
+        if index is not None:
+            index.close()
+    with current_run.phase('parse'):
+        try:
+            index = RangeIndex(config['index'])
+            if index.source != sha256:
+                index.close()
+                index = None
+        except (OSError, ValueError):
+            index = None
+        if index is None:
+            print(f"Compiling {family} range index ...")
+            os.makedirs(os.path.dirname(config['index']), exist_ok=True)
+            build_index(iter_db_ranges(config['zip'], config['bits']), config['index'], source=sha256, width=config['bits'] // 8)
+            index = RangeIndex(config['index'])
+    if open_indexes is not None:
+        open_indexes[family] = index
+    return index
+
+def release_index(index):
+    """Close an index from open_index() unless a resident process keeps it open."""
+    if open_indexes is None or index not in open_indexes.values():
+        index.close()
+
+def process_country_group(countries, family='inet'):
+    index = open_index(family)
+    ranges = list(index.ranges(countries))
+    release_index(index)
+    return ranges
+
+def pick_engine(engine, family='inet'):
+    """Resolve `engine` to python or numpy; the numpy engine only handles IPv4."""
+    if engine == 'numpy' and np is None:
+        raise RuntimeError("The numpy engine was requested but numpy is not installed")
+    if engine == 'auto':
+        engine = 'python' if np is None else 'numpy'
+    return engine if family == 'inet' else 'python'
+
+def compile_country_group(countries, engine='auto', family='inet'):
+    engine = pick_engine(engine, family)
+    with current_run.phase('compile'):
+        if engine == 'numpy':
+            index = open_index(family)
+            cidrs, rows = compile_index_np(index, countries)
+            release_index(index)
+        else:
+            ranges = process_country_group(countries, family)
+            cidrs, rows = compile_ranges(ranges, FAMILIES[family]['bits']), len(ranges)
+    current_run.rows_scanned += rows
+    print(f"Compiled {len(cidrs)} {family} CIDR entries from {rows} ranges ({engine} engine).")
+    return cidrs
+
+def compile_country_ranges(countries, family='inet'):
+    """Return the merged (start, end) ranges of the selected countries, for backends with native ranges."""
+    with current_run.phase('compile'):
+        ranges = process_country_group(countries, family)
+        merged = merge_ranges(ranges)
+    current_run.rows_scanned += len(ranges)
+    print(f"Compiled {len(merged)} {family} ranges from {len(ranges)} rows.")
+    return merged
+
+def reserved_ranges(family):
+    """Return the merged ranges allow-only mode never blocks: the reserved ones and all outside the family's public space."""
+    config = FAMILIES[family]
+    whole = (0, (1 << config['bits']) - 1)
+    outside = complement_ranges([cidr_bounds(config['space'], config['bits'])], whole)
+    return merge_ranges([*cidrs_to_ranges(config['reserved']), *outside])
+
+def check_allow_selection(countries):
+    if not countries:
+        raise ValueError("Allow-only mode needs at least one picked country, otherwise every public address is blocked")
+
+def allow_only_ranges(data_source, countries, family):
+    """Return the merged ranges of the family's public space outside the picked countries."""
+    check_allow_selection(countries)
+    allowed = data_source.ranges(countries, family)
+    with current_run.phase('compile'):
+        return complement_ranges(allowed, (0, (1 << FAMILIES[family]['bits']) - 1), reserved_ranges(family))
+
+def blocked_ranges(data_source, countries, family, mode=DEFAULT_SELECTION_MODE):
+    """Return the merged ranges to block in `mode`, for backends with native ranges."""
+    if mode == 'block':
+        return data_source.ranges(countries, family)
+    started = time.monotonic()
+    ranges = allow_only_ranges(data_source, countries, family)
+    print(f"Built {len(ranges)} allow-only {family} ranges in {time.monotonic() - started:.2f}s.")
+    return ranges
+
+def compile_blocked(data_source, countries, family, engine='auto', mode=DEFAULT_SELECTION_MODE):
+    """Return the CIDRs to block in `mode`: the picked countries, or the minimal cover of everything else."""
+    if mode == 'block':
+        return data_source.compile(countries, family, engine)
+    started = time.monotonic()
+    ranges = allow_only_ranges(data_source, countries, family)
+    engine = pick_engine(engine, family)
+    with current_run.phase('compile'):
+        cidrs = compile_ranges_np(ranges) if engine == 'numpy' else compile_ranges(ranges, FAMILIES[family]['bits'])
+    print(f"Compiled {len(cidrs)} allow-only {family} CIDR entries from {len(ranges)} ranges in {time.monotonic() - started:.2f}s ({engine} engine).")
+    return cidrs
+
+def load_country_cidrs(index, code, family='inet'):
+    """Return the aggregated CIDRs of one country, cached per database version."""
+    directory = os.path.join(CIDR_CACHE_DIR, family, index.source[:16])
+    path = os.path.join(directory, f"{code}.txt")
+    try:
+        with open(path) as f:
+            return f.read().split()
+    except OSError:
+        pass
+    cidrs = compile_ranges(index.ranges([code]), FAMILIES[family]['bits'])
+    os.makedirs(directory, exist_ok=True)
+    with open(path + ".tmp", 'w') as f:
+        f.writelines(f"{cidr}\n" for cidr in cidrs)
+    os.replace(path + ".tmp", path)
+    # Entries compiled from older databases are never read again
+    for stale in os.listdir(os.path.dirname(directory)):
+        if stale != index.source[:16]:
+            shutil.rmtree(os.path.join(CIDR_CACHE_DIR, family, stale), ignore_errors=True)
+    return cidrs
+
+class Ip2LocationSource:
+    """The IP2Location LITE archives: the whole world per family, compiled through the range index."""
+
+    name = 'ip2location'
+
+    def fetch(self, countries, refresh=True):
+        for config in FAMILIES.values():
+            if refresh or not load_download_meta(config['zip']).get('sha256'):
+                download_db(config['url'], config['zip'])
+
+    def country_version(self, family, code):
+        return load_download_meta(FAMILIES[family]['zip']).get('sha256')
+
+    def version(self, family, countries):
+        return load_download_meta(FAMILIES[family]['zip']).get('sha256')
+
+    def compile(self, countries, family, engine='auto'):
+        return compile_country_group(countries, engine, family)
+
+    def ranges(self, countries, family):
+        return compile_country_ranges(countries, family)
+
+    def open(self, family):
+        return IndexCountries(open_index(family), family)
+
+
+class IndexCountries:
+    """Per-country access to one family's range index."""
+
+    def __init__(self, index, family):
+        self.index = index
+        self.family = family
+
+    def has(self, code):
+        return bool(self.index.count(code))
+
+    def cidrs(self, code):
+        return load_country_cidrs(self.index, code, self.family)
+
+    def ranges(self, codes):
+        return merge_ranges(self.index.ranges(codes))
+
+    def close(self):
+        release_index(self.index)
+
+
+def count_downloaded(size):
+    current_run.bytes_downloaded += size
+
+def get_source(name=None):
+    """Return the configured data source (settings.data_source, ip2location by default)."""
+    name = name or get_setting('data_source', DEFAULT_DATA_SOURCE)
+    if name == 'ipdeny':
+        return IpdenySource(IPDENY_CACHE_DIR, on_download=count_downloaded)
+    if name != 'ip2location':
+        raise ValueError(f"Unknown data source: {name}")
+    return Ip2LocationSource()
+
+def hot_apply_family(backend, family, countries, state, data_source, mode=DEFAULT_SELECTION_MODE):
+    """Add or remove only the entries of countries toggled since the family's last apply.
+
+    In allow mode the delta is inverted: a newly picked country's entries leave the set.
+
+    Returns False when there is no applied state for the current database to start from."""
+    config = FAMILIES[family]
+    name = config['set']
+    set_state = state.get(name, {})
+    source = set_state.get('source')
+    applied = load_applied_set(name)
+    # The data of the previously applied countries must not have changed since
+    if (applied is None or not source or source.get('db_sha256') != data_source.version(family, source['countries'])
+            or source.get('mode', DEFAULT_SELECTION_MODE) != mode or backend.set_type(name) != 'hash:net'):
+        return False
+    if mode == 'allow':
+        check_allow_selection(countries)
+
+    added = sorted(set(countries) - set(source['countries']))
+    removed = sorted(set(source['countries']) - set(countries))
+    if added or removed:
+        blocked, unblocked = (added, removed) if mode == 'block' else (removed, added)
+        reader = data_source.open(family)
+        with current_run.phase('compile'):
+            to_add = [cidr for code in blocked for cidr in reader.cidrs(code)]
+            if mode == 'allow':
+                # A country's data may reach into reserved ranges, which a full update leaves out
+                reserved, public_parts = subtract_ranges(to_add, reserved_ranges(family), config['bits'])
+                reserved = set(reserved)
+                to_add = [cidr for cidr in to_add if cidr not in reserved] + public_parts
+            # Entries from a full update may span an unblocked country and a blocked neighbour, so they are split
+            to_del, kept_parts = subtract_ranges(applied, reader.ranges(unblocked), config['bits'])
+        reader.close()
+        to_add += kept_parts
+        deleted = set(to_del)
+        cidrs = [cidr for cidr in applied if cidr not in deleted] + to_add
+        print(f"Hot apply to {name}: +{added} -{removed}")
+        with current_run.phase('apply'):
+            if len(cidrs) > set_state.get('maxelem', IPSET_MIN_MAXELEM):
+                set_state['maxelem'] = backend.load_set(name, cidrs, family)
+            else:
+                backend.apply_set_delta(name, to_add, to_del)
+        save_applied_set(name, cidrs)
+        current_run.entries_loaded += len(to_add) + len(to_del)
+        set_state['entries'] = len(cidrs)
+    set_state['source'] = {'db_sha256': data_source.version(family, countries), 'countries': countries, 'mode': mode}
+    return True
+
+@holds_state_lock
+def hot_apply(run=None):
+    """Bring the firewall in line with the current country selection without refreshing the data source.
+
+    Recorded in update_runs as a hot-apply run. Falls back to a full update when there is no
+    applied state to start from."""
+    global current_run
+    current_run = run or UpdateRun()
+    started = time.monotonic()
+    backend = get_backend()
+    try:
+        applied = apply_selection(backend)
+    except Exception as e:
+        current_run.record(time.monotonic() - started, backend.name, error=f"{type(e).__name__}: {e}", kind='hot-apply')
+        raise
+    if not applied:
+        return update(run=current_run)
+    current_run.record(time.monotonic() - started, backend.name, kind='hot-apply')
+    print("Country selection applied.")
+
+def apply_selection(backend):
+    """The work of hot_apply(); returns False when a full update is needed instead."""
+    state = load_state_meta()
+    if state.get('backend', DEFAULT_BACKEND) != backend.name:
+        return False
+    countries = sorted(row[0] for row in get_from_db('SELECT code FROM countries WHERE picked == True'))
+    mode = get_selection_mode()
+    print(f"Countries: {countries} ({mode})")
+    data_source = get_source()
+    # Only data that was never fetched is downloaded, e.g. the zone file of a newly picked country
+    with current_run.phase('download'):
+        data_source.fetch(countries, refresh=False)
+
+    if isinstance(backend, NftablesBackend):
+        if not backend.table_exists():
+            return False
+        port_protocols = get_from_db('SELECT port_number, protocol FROM port_rules')
+        whitelist_ips = [row[0] for row in get_from_db('SELECT cidr FROM whitelisted_ips')]
+        with current_run.phase('apply'):
+            update_nftables(backend, countries, port_protocols, whitelist_ips, state, data_source=data_source, mode=mode)
+    elif get_set_layout(backend) == 'per_country':
+        port_protocols = get_from_db('SELECT port_number, protocol FROM port_rules')
+        with current_run.phase('apply'):
+            for family in FAMILIES:
+                update_country_sets(backend, family, countries, port_protocols, state, data_source=data_source)
+    else:
+        for family in FAMILIES:
+            if not hot_apply_family(backend, family, countries, state, data_source, mode):
+                print(f"No applied state for {FAMILIES[family]['set']}, running a full update.")
+                return False
+    if isinstance(backend, IptablesBackend):
+        with current_run.phase('apply'):
+            backend.sync_whitelist([row[0] for row in get_from_db('SELECT cidr FROM whitelisted_ips')])
+    record_fingerprint(backend, state)
+    save_state_meta(state)
+    return True
+
+def update_family(backend, family, countries, port_rules, state, engine='auto', plan=False, cidrs=None, origin=None, data_source=None,
+                  mode=DEFAULT_SELECTION_MODE):
+    """Bring the family's block set in line with the selected countries and mode, applying only the delta.
+
+    `cidrs` and `origin` (the artifact checksum) are given when applying a controller's artifact."""
+    config = FAMILIES[family]
+    name = config['set']
+    data_source = data_source or get_source()
+    if get_set_layout(backend) == 'per_country':
+        if cidrs is None:
+            return update_country_sets(backend, family, countries, port_rules, state, plan, data_source)
+        print(f"Artifacts carry one merged list per family, loading {name} as a single set.")
+
+    set_state = state.setdefault(name, {})
+    source = {'db_sha256': origin or data_source.version(family, countries), 'countries': countries, 'mode': mode}
+    if backend.set_type(name) == 'list:set':
+        # Switching back from per-country sets
+        cidrs = compile_blocked(data_source, countries, family, engine, mode) if cidrs is None else cidrs
+        print(f"Plan for {name}: rebuild as one hash:net set of {len(cidrs)} entries")
+        if plan:
+            return
+        backend.convert_set(name, family, port_rules, cidrs)
+        for code in set_state.pop('members', {}):
+            backend.destroy_set(country_set_name(name, code))
+        save_applied_set(name, cidrs)
+        current_run.entries_loaded += len(cidrs)
+        set_state.update(maxelem=ipset_sizing(len(cidrs))[1], source=source, entries=len(cidrs))
+        return
+
+    if plan:
+        recreated = not backend.set_exists(name)
+    else:
+        recreated = backend.setup_set(name, family)
+        backend.setup_rules(family, port_rules)
+
+    applied = None if recreated else load_applied_set(name)
+    if cidrs is not None:
+        pass
+    elif applied is not None and set_state.get('source') == source:
+        print(f"Database and country selection unchanged since last apply of {name}.")
+        cidrs = applied
+    else:
+        with current_run.phase('compile'):
+            cidrs = compile_blocked(data_source, countries, family, engine, mode)
+
+    to_add, to_del, rebuild = plan_ipset(applied, cidrs, set_state.get('maxelem', IPSET_MIN_MAXELEM))
+    apply_rate = set_state.get('apply_rate', APPLY_RATE_DEFAULT)
+    print_plan(name, to_add, to_del, rebuild, apply_rate)
+    if plan:
+        return
+
+    started = time.monotonic()
+    if rebuild:
+        set_state['maxelem'] = backend.load_set(name, cidrs, family)
+    elif to_add or to_del:
+        backend.apply_set_delta(name, to_add, to_del)
+    changes = len(to_add) + len(to_del)
+    if changes:
+        set_state['apply_rate'] = changes / max(time.monotonic() - started, 1e-3)
+    if rebuild or changes:
+        save_applied_set(name, cidrs)
+    current_run.entries_loaded += len(cidrs) if rebuild else changes
+    set_state['source'] = source
+    set_state['entries'] = len(cidrs)
+
+def update_country_sets(backend, family, countries, port_rules, state, plan=False, data_source=None):
+    """Give every selected country its own hash:net set and make the family's block set a list:set
+    of them, whose per-member counters show how much traffic each country drops.
+
+    A country's set is only (re)loaded when the database changed; toggling a country just adds
+    or removes a member, so this also serves hot applies."""
+    config = FAMILIES[family]
+    name = config['set']
+    set_state = state.setdefault(name, {})
+    data_source = data_source or get_source()
+    is_list = backend.set_type(name) == 'list:set'
+    live = backend.list_members(name) if is_list else {}
+    members = {code: info for code, info in set_state.get('members', {}).items() if country_set_name(name, code) in live}
+
+    reader = data_source.open(family)
+    selected = [code for code in countries if reader.has(code)]
+    for code in selected:
+        info = members.get(code, {})
+        db_sha256 = data_source.country_version(family, code)
+        if info.get('db_sha256') == db_sha256:
+            continue
+        member = country_set_name(name, code)
+        with current_run.phase('compile'):
+            cidrs = reader.cidrs(code)
+        if plan:
+            print(f"Plan for {member}: load {len(cidrs)} entries")
+            continue
+        recreated = backend.setup_set(member, family)
+        applied = None if recreated or not info else load_applied_set(member)
+        to_add, to_del, rebuild = plan_ipset(applied, cidrs, info.get('maxelem', IPSET_MIN_MAXELEM))
+        if rebuild:
+            info['maxelem'] = backend.load_set(member, cidrs, family)
+        elif to_add or to_del:
+            backend.apply_set_delta(member, to_add, to_del)
+        save_applied_set(member, cidrs)
+        current_run.entries_loaded += len(cidrs) if rebuild else len(to_add) + len(to_del)
+        members[code] = {**info, 'db_sha256': db_sha256, 'entries': len(cidrs)}
+    reader.close()
+
+    wanted = [country_set_name(name, code) for code in selected]
+    print(f"Plan for {name}: list:set of {len(wanted)} country sets")
+    if plan:
+        return
+    if is_list:
+        removed = backend.sync_members(name, wanted)
+        backend.setup_rules(family, port_rules)
     else:
-        print("Creating new ipset set...")
-        subprocess.run(['sudo', 'ipset', 'create', IPSET_NAME, 'hash:net', 'family', 'inet'], check=True)
-
-def setup_iptables():
-    result = subprocess.run(['sudo', 'iptables', '-C', 'INPUT', '-m', 'set', '--match-set', IPSET_NAME, 'src', '-j', 'DROP'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    if result.returncode != 0:
-        print("Creating new iptables rule...")
-        subprocess.run(['sudo', 'iptables', '-I', 'INPUT', '-m', 'set', '--match-set', IPSET_NAME, 'src', '-j', 'DROP'], check=True)
+        backend.convert_set(name, family, port_rules, wanted, list_set=True)
+        removed = []
+    stale = set(removed) | {country_set_name(name, code) for code in set_state.get('members', {}) if code not in selected}
+    for member in sorted(stale):
+        backend.destroy_set(member)
+    set_state['members'] = {code: members[code] for code in selected}
+    set_state['entries'] = sum(info['entries'] for info in set_state['members'].values())
+    set_state.pop('source', None)
+
+def get_country_counters(backend=None):
+    """Return {country code: [packets, bytes]} dropped through the per-country sets.
+
+    Reads every member's counters with a single `ipset list` of each family's list:set."""
+    backend = backend or get_backend()
+    counters = {}
+    if get_set_layout(backend) != 'per_country':
+        return counters
+    for config in FAMILIES.values():
+        prefix = country_set_name(config['set'], '')
+        for member, (packets, bytes_) in backend.list_members(config['set']).items():
+            if member.startswith(prefix):
+                total = counters.setdefault(member[len(prefix):], [0, 0])
+                total[0] += packets
+                total[1] += bytes_
+    return counters
+
+def update_nftables(backend, countries, port_rules, whitelist_ips, state, plan=False, blocked=None, origin=None, data_source=None,
+                    mode=DEFAULT_SELECTION_MODE):
+    """Replace the whole nftables table in one transaction when anything it is built from changed."""
+    set_state = state.setdefault(backend.name, {})
+    data_source = data_source or get_source()
+    source = {
+        'db_sha256': origin or {family: data_source.version(family, countries) for family in FAMILIES},
+        'countries': countries,
+        'mode': mode,
+        'whitelist': sorted(set(whitelist_ips)),
+        'ports': sorted(map(list, port_rules)),
+        'enforcement': [backend.enforcement, *backend.interfaces],
+    }
+    if set_state.get('source') == source and backend.table_exists():
+        print("Nothing changed since the last nftables apply.")
+        return
+
+    if blocked is None:
+        with current_run.phase('compile'):
+            blocked = {family: blocked_ranges(data_source, countries, family, mode) for family in FAMILIES}
+    elements = sum(len(ranges) for ranges in blocked.values())
+    print(f"Plan for nftables: replace table with {elements} range elements in one transaction")
+    if plan:
+        return
+    backend.apply(blocked, whitelist_ips, port_rules)
+    current_run.entries_loaded += elements
+    set_state['entries'] = {NFT_SETS[family][0]: len(ranges) for family, ranges in blocked.items()}
+    set_state['source'] = source
+
+def get_set_sizes():
+    """Return {set name: entry count} for the block sets of the last applied backend."""
+    state = load_state_meta()
+    backend = state.get('backend', DEFAULT_BACKEND)
+    if backend == NftablesBackend.name:
+        return dict(state.get(backend, {}).get('entries', {}))
+    return {config['set']: state[config['set']]['entries'] for config in FAMILIES.values() if 'entries' in state.get(config['set'], {})}
+
+def apply_update(backend, plan=False, engine='auto', artifact=None):
+    """Apply the locally selected countries, or the compiled `artifact` pushed by a controller."""
+    if artifact is None:
+        with current_run.phase('connectivity'):
+            check_internet_access()
+    if not plan:
+        with current_run.phase('backup'):
+            backup_existing_rules(backend)
+    data_source = None
+    if artifact is None:
+        countries = sorted(row[0] for row in get_from_db('SELECT code FROM countries WHERE picked == True'))
+        mode = get_selection_mode()
+        data_source = get_source()
+        with current_run.phase('download'):
+            data_source.fetch(countries)
+        origin, cidrs = None, {}
     else:
-        print("iptables rule already exists.")
-
-def convert_ip_range_to_cidr(start_ip, end_ip):
-    start_ip = ipaddress.ip_address(int(start_ip))
-    end_ip = ipaddress.ip_address(int(end_ip))
-
-    network = ipaddress.summarize_address_range(start_ip, end_ip)
-    cidr_blocks = [str(net) for net in network]
-
-    return cidr_blocks[0]
-
-def get_from_db(query, params=()):
-    with sqlite3.connect(SQLITE_DB_PATH) as conn:
-        cursor = conn.cursor()
-        cursor.execute(query, params)
-        return cursor.fetchall()
-
-def process_country_group(countries):
-    with open(DB_PATH, 'r') as db_file:
-        for line in db_file:
-            parts = line.strip().split(',')
-            start_ip, end_ip, country_code = parts[0].strip('"'), parts[1].strip('"'), parts[2].strip('"')
-            if country_code in countries:
-                #print(f"converting start_ip of {start_ip} and end_ip {end_ip} to CIDR...")
-                cidr = convert_ip_range_to_cidr(start_ip, end_ip)
-                if cidr:
-                    print(f"Adding {cidr} to ipset for {country_code}")
-                    subprocess.run(['sudo', 'ipset', 'add', IPSET_NAME, cidr], check=True)
-
-def update():
-    check_internet_access()
-    backup_existing_rules()
-    download_and_extract_db()
-    setup_ipset()
-    setup_iptables()
-
-    countries = [row[0] for row in get_from_db('SELECT code FROM countries WHERE picked == True')]
-    print(f"Countries: {countries}")
+        print(f"Applying artifact version {artifact['version']} (sha256 {artifact['sha256']}).")
+        countries, origin, cidrs = artifact['countries'], artifact['sha256'], artifact['cidrs']
+        mode = artifact.get('mode', DEFAULT_SELECTION_MODE)
+    print(f"Countries: {countries} ({mode})")
     port_protocols = get_from_db('SELECT port_number, protocol FROM port_rules')
     print(f"Ports: {port_protocols}")
     whitelist_ips = [row[0] for row in get_from_db('SELECT cidr FROM whitelisted_ips')]
     print(f"Whitelisted ips: {whitelist_ips}")
 
-    process_country_group(countries)
+    state = load_state_meta()
 
-    for ip in whitelist_ips:
-        print(f"Adding whitelisted IP {ip} to iptables with ACCEPT action")
-        subprocess.run(['sudo', 'iptables', '-I', 'INPUT', '-s', ip, '-j', 'ACCEPT'], check=True)
+    with current_run.phase('apply'):
+        if isinstance(backend, NftablesBackend):
+            blocked = {family: cidrs_to_ranges(entries) for family, entries in cidrs.items()} if artifact else None
+            update_nftables(backend, countries, port_protocols, whitelist_ips, state, plan, blocked, origin, data_source, mode)
+        else:
+            if not plan:
+                backend.sync_whitelist(whitelist_ips)
+                backend.remove_legacy_whitelist_rules(whitelist_ips)
+            for family in FAMILIES:
+                update_family(backend, family, countries, port_protocols, state, engine, plan, cidrs.get(family), origin, data_source, mode)
+        if plan:
+            return
+        previous = state.get('backend', DEFAULT_BACKEND)
+        if previous != backend.name:
+            print(f"Switched firewall backend from {previous} to {backend.name}, removing the old rules...")
+            get_backend(previous).teardown()
+    state['backend'] = backend.name
+    if artifact is not None:
+        state['artifact'] = {'version': artifact['version'], 'sha256': artifact['sha256']}
+    record_fingerprint(backend, state)
+    save_state_meta(state)
 
-    with sqlite3.connect(SQLITE_DB_PATH) as conn:
-        cursor = conn.cursor()
+    with transaction() as cursor:
         cursor.execute('DELETE FROM system_info')
         cursor.execute('INSERT INTO system_info (last_update_date) VALUES (?)', (datetime.now().isoformat(),))
 
+def apply_whitelist(blocking=True):
+    """Bring only the allow sets in line with the whitelist in app.db; the block sets and rules are left alone.
+
+    Returns False when nothing was applied for the current settings yet, so a hot apply is needed
+    instead. With `blocking` False, raises BlockingIOError while another run holds LOCK_PATH."""
+    with state_lock(blocking):
+        backend = get_backend()
+        state = load_state_meta()
+        fingerprint = state.get('fingerprint')
+        if not fingerprint or fingerprint['backend'] != backend.name or fingerprint['enforcement'] != backend.enforcement:
+            return False
+        if isinstance(backend, NftablesBackend) and not backend.table_exists():
+            return False
+        whitelist_ips = [row[0] for row in get_from_db('SELECT cidr FROM whitelisted_ips')]
+        backend.sync_whitelist(whitelist_ips)
+        if isinstance(backend, IptablesBackend):
+            backend.remove_legacy_whitelist_rules(whitelist_ips)
+        record_fingerprint(backend, state)
+        save_state_meta(state)
+        print(f"Whitelist applied ({len(whitelist_ips)} entries).")
+        return True
+
+@holds_state_lock
+def rollback(name=None):
+    """Restore the block sets from snapshot `name`, by default the newest one that differs from the live rules.
+
+    A snapshot taken before a set_layout change is restored in its own layout; the next update
+    converts the sets back to the configured one. Returns the name of the restored snapshot."""
+    backend = get_backend()
+    snapshots = list_snapshots(BACKUP_ZONE_DIR)
+    if name is None:
+        live = snapshot_digest(backend.name, backend.save())[:12]
+        candidates = [snapshot for snapshot in snapshots if not snapshot.endswith(f"_{live}.json.gz")]
+        if not candidates:
+            raise ValueError("No snapshot that differs from the live rules")
+        name = candidates[-1]
+    elif name not in snapshots:
+        raise ValueError(f"Unknown snapshot: {name}")
+
+    backend_name, dumps = load_snapshot(BACKUP_ZONE_DIR, name)
+    if backend_name != backend.name:
+        raise ValueError(f"Snapshot {name} was taken with the {backend_name} backend, but {backend.name} is active")
+    print(f"Rolling back to snapshot {name}...")
+    started = time.monotonic()
+    restored = backend.restore_snapshot(dumps, get_from_db('SELECT port_number, protocol FROM port_rules'))
+
+    # Forget what produced the applied state so the next update recompiles and re-applies the selection
+    state = load_state_meta()
+    for set_name, entries in restored.items():
+        save_applied_set(set_name, entries)
+    for config in FAMILIES.values():
+        block_set = config['set']
+        prefix = country_set_name(block_set, '')
+        members = [entries for set_name, entries in restored.items() if set_name.startswith(prefix)]
+        if block_set not in restored and not members:
+            continue
+        set_state = state.setdefault(block_set, {})
+        set_state.pop('source', None)
+        if members:
+            # Member sets are reloaded from scratch on the next update
+            set_state['members'] = {set_name[len(prefix):]: {} for set_name in restored if set_name.startswith(prefix)}
+            set_state['entries'] = sum(len(entries) for entries in members)
+        else:
+            set_state.pop('members', None)
+            set_state['entries'] = len(restored[block_set])
+    state.get(backend.name, {}).pop('source', None)
+    record_fingerprint(backend, state)
+    save_state_meta(state)
+    print(f"Rolled back to {name} in {time.monotonic() - started:.2f}s.")
+    return name
+
+def expected_sets(state):
+    """Return {set name: (list_set, entries)} the block sets hold according to the applied state."""
+    sets = {}
+    for config in FAMILIES.values():
+        name = config['set']
+        set_state = state.get(name, {})
+        names = [country_set_name(name, code) for code in set_state['members']] if 'members' in set_state else [name]
+        if 'members' in set_state:
+            sets[name] = (True, names)
+        for set_name in names:
+            entries = load_applied_set(set_name)
+            if entries is not None:
+                sets[set_name] = (False, entries)
+    return sets
+
+def set_fingerprint(entries):
+    return {'entries': len(entries), 'sha256': entries_digest(entries)}
+
+def rules_fingerprint(position, rules):
+    return {'position': position, 'rules': len(rules), 'sha256': hashlib.sha256('\n'.join(rules).encode()).hexdigest()}
+
+def table_fingerprint(lines):
+    """Digest of the nftables table without its allow sets, which follow app.db on their own."""
+    kept, skipping = [], False
+    for line in lines:
+        stripped = line.strip()
+        if stripped.startswith('set ') and stripped.split()[1] in {sets[1] for sets in NFT_SETS.values()}:
+            skipping = True
+        if not skipping:
+            kept.append(stripped)
+        elif stripped == '}':
+            skipping = False
+    return {'lines': len(kept), 'sha256': hashlib.sha256('\n'.join(kept).encode()).hexdigest()}
+
+def record_fingerprint(backend, state):
+    """Store what the kernel should hold after an apply: the digest and entry count of every block set
+    and the GEOBLOCK rules with the position of their jump (nftables: the digest of the table)."""
+    fingerprint = {'backend': backend.name, 'enforcement': backend.enforcement}
+    if isinstance(backend, NftablesBackend):
+        table = backend.read_table()
+        fingerprint['table'] = table_fingerprint(table) if table is not None else None
+    else:
+        fingerprint['sets'] = {name: {'list_set': list_set, **set_fingerprint([canonical_entry(entry) for entry in entries])}
+                               for name, (list_set, entries) in expected_sets(state).items()}
+        fingerprint['rules'] = {family: rules_fingerprint(*rules) for family, rules in backend.read_rules().items()}
+    state['fingerprint'] = fingerprint
+
+def find_drift(backend, fingerprint, whitelist_ips):
+    """Compare the kernel with `fingerprint`, and the allow sets with the whitelist in app.db.
+
+    Reads the kernel once (one `ipset save` and one iptables-save per family, or one `nft list table`).
+    Returns (problems, live) where each problem is {'kind', 'name', 'detail'}."""
+    problems = []
+    if isinstance(backend, NftablesBackend):
+        table = backend.read_table()
+        if table is None:
+            problems.append({'kind': 'table', 'name': backend.name, 'detail': "table is missing"})
+        elif table_fingerprint(table) != fingerprint['table']:
+            problems.append({'kind': 'table', 'name': backend.name, 'detail': "table differs from the last apply"})
+        return problems, None
+
+    live_sets, live_rules = backend.read_sets(), backend.read_rules()
+    for name, expected in fingerprint['sets'].items():
+        live = live_sets.get(name)
+        actual = set_fingerprint(live[1]) if live else None
+        if live is None:
+            problems.append({'kind': 'set', 'name': name, 'detail': "set is missing"})
+        elif (live[0] == 'list:set') != expected['list_set']:
+            problems.append({'kind': 'set', 'name': name, 'detail': f"set has type {live[0]}"})
+        elif actual['entries'] != expected['entries']:
+            problems.append({'kind': 'set', 'name': name, 'detail': f"{actual['entries']} entries instead of {expected['entries']}"})
+        elif actual['sha256'] != expected['sha256']:
+            problems.append({'kind': 'set', 'name': name, 'detail': "entries differ from the last apply"})
+    for family, entries in split_by_family(whitelist_ips).items():
+        name = SET_NAMES[family]['allow']
+        wanted = {canonical_entry(str(ipaddress.ip_network(entry, strict=False))) for entry in entries}
+        live = live_sets.get(name)
+        if live is None or set(live[1]) != wanted:
+            problems.append({'kind': 'whitelist', 'name': name, 'detail': "set is missing" if live is None else "entries differ from app.db"})
+    for family, expected in fingerprint['rules'].items():
+        actual = rules_fingerprint(*live_rules[family])
+        if actual['position'] is None:
+            problems.append({'kind': 'rules', 'name': family, 'detail': f"{IPTABLES_CHAIN} jump is missing"})
+        elif actual['sha256'] != expected['sha256']:
+            problems.append({'kind': 'rules', 'name': family, 'detail': f"{IPTABLES_CHAIN} chain rules changed"})
+        elif actual['position'] != expected['position']:
+            problems.append({'kind': 'rules', 'name': family, 'detail': f"{IPTABLES_CHAIN} jump moved to position {actual['position']}"})
+    return problems, (live_sets, live_rules)
+
+def repair_drift(backend, problems, live, state):
+    """Fix only what drifted: reload or patch the affected sets, rewrite the affected chains.
+
+    nftables tables are replaced as a whole, in one transaction, from the locally cached data."""
+    countries = sorted(row[0] for row in get_from_db('SELECT code FROM countries WHERE picked == True'))
+    port_protocols = get_from_db('SELECT port_number, protocol FROM port_rules')
+    whitelist_ips = [row[0] for row in get_from_db('SELECT cidr FROM whitelisted_ips')]
+    if isinstance(backend, NftablesBackend):
+        state.get(backend.name, {}).pop('source', None)
+        update_nftables(backend, countries, port_protocols, whitelist_ips, state)
+        return
+
+    live_sets, live_rules = live
+    expected = expected_sets(state)
+    if any(problem['kind'] == 'whitelist' for problem in problems):
+        backend.sync_whitelist(whitelist_ips)
+    # Member sets before the list:set that references them, and sets before the rules that match them
+    for problem in sorted((problem for problem in problems if problem['kind'] == 'set'), key=lambda problem: problem['name'] in expected and expected[problem['name']][0]):
+        name = problem['name']
+        live = live_sets.get(name)
+        if name not in expected or (live is not None and (live[0] == 'list:set') != expected[name][0]):
+            print(f"Cannot repair {name} in place: {problem['detail']}.")
+            continue
+        list_set, entries = expected[name]
+        changes = backend.repair_set(name, managed_set_family(name), entries, live[1] if live else None, list_set)
+        current_run.entries_loaded += changes
+    for problem in problems:
+        if problem['kind'] == 'rules':
+            backend.repair_rules(problem['name'], port_protocols, live_rules[problem['name']][0])
+
+@holds_state_lock
+def verify(repair=True, run=None):
+    """Check the kernel against the fingerprint of the last apply and, with `repair`, fix only the gap.
+
+    The result is kept in state.json for the UI. Returns the problems found; raises RuntimeError
+    when drift remains after the repair, so the caller can fall back to a full update."""
+    global current_run
+    current_run = run or UpdateRun()
+    backend = get_backend()
+    state = load_state_meta()
+    fingerprint = state.get('fingerprint')
+    if not fingerprint or fingerprint['backend'] != backend.name or fingerprint['enforcement'] != backend.enforcement:
+        print("No fingerprint of the applied rules for the current settings, run an update first.")
+        return []
+    whitelist_ips = [row[0] for row in get_from_db('SELECT cidr FROM whitelisted_ips')]
+    problems, live = find_drift(backend, fingerprint, whitelist_ips)
+    remaining = problems
+    for problem in problems:
+        print(f"Drift in {problem['name']}: {problem['detail']}")
+    if problems and repair:
+        with current_run.phase('apply'):
+            repair_drift(backend, problems, live, state)
+        record_fingerprint(backend, state)
+        remaining, _ = find_drift(backend, state['fingerprint'], whitelist_ips)
+    status = 'ok' if not problems else 'drifted' if remaining else 'repaired'
+    state['drift'] = {'checked_at': datetime.now().isoformat(), 'status': status, 'problems': [f"{problem['name']}: {problem['detail']}" for problem in problems]}
+    save_state_meta(state)
+    print("Kernel state matches the last apply." if not problems else f"Drift {'remains' if remaining else 'repaired'}.")
+    if remaining and repair:
+        raise RuntimeError("Drift remains after repair: " + "; ".join(f"{problem['name']}: {problem['detail']}" for problem in remaining))
+    return problems
+
+@holds_state_lock
+def update(plan=False, engine='auto', run=None, artifact=None):
+    """Run one update and record its phase timings and counters in update_runs (plan runs are not recorded).
+
+    Pass an UpdateRun as `run` to follow the update's progress from another thread, and
+    a controller's `artifact` to apply its precompiled block lists instead of the local selection."""
+    global current_run
+    current_run = run or UpdateRun()
+    started = time.monotonic()
+    backend = get_backend()
+    try:
+        apply_update(backend, plan, engine, artifact)
+    except Exception as e:
+        if not plan:
+            current_run.record(time.monotonic() - started, backend.name, error=f"{type(e).__name__}: {e}")
+        raise
+    if plan:
+        return
+    current_run.record(time.monotonic() - started, backend.name)
     print("Country blocking rules updated.")
+    print("Phase timings: " + ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in current_run.phases.items()))
 
 
 if __name__ == "__main__":
-    update()
+    parser = argparse.ArgumentParser(description="Update GEO_BLOCK and GEO_BLOCK6 from the IP2Location databases.")
+    parser.add_argument('--plan', action='store_true', help="print the pending delta and expected apply time without touching the firewall")
+    parser.add_argument('--engine', choices=['auto', 'python', 'numpy'], default='auto', help="range compiler for IPv4; auto picks numpy when it is installed. IPv6 is always compiled in Python")
+    parser.add_argument('--list-snapshots', action='store_true', help="list the stored rule snapshots, oldest first")
+    parser.add_argument('--rollback', nargs='?', const='', metavar='SNAPSHOT', help="restore the block sets from SNAPSHOT, by default the newest one that differs from the live rules; "
+                        "a snapshot from another set layout is restored in that layout until the next update")
+    parser.add_argument('--verify', action='store_true', help="compare the kernel with the last apply and report drift")
+    parser.add_argument('--repair', action='store_true', help="like --verify, and fix only what drifted")
+    args = parser.parse_args()
+    if args.list_snapshots:
+        print("\n".join(list_snapshots(BACKUP_ZONE_DIR)))
+    elif args.rollback is not None:
+        rollback(args.rollback or None)
+    elif args.verify or args.repair:
+        raise SystemExit(1 if verify(repair=args.repair) and not args.repair else 0)
+    else:
+        update(plan=args.plan, engine=args.engine)